@@ -10,6 +10,8 @@
 # Notes:
 #   PS pin is in input mode. Should use a resistor to force it up or down to start.
 #   For reset and key pins,  you need additional hardware to do anything useful.
+#   With the key pin wired to a GPIO (through a transistor, pulling KEY to ground), FonaService
+#   can power cycle a modem that's stopped answering.
 #
 # While I wanted to do something more comprehensive, I'm just doing the text messaging part for now.
 #
@@ -18,84 +20,49 @@
 #################
 # Includes
 #################
-import RPi.GPIO as GPIO
+# Only there on the Pi. Without it we can still talk to the FONA (or the simulator), we just
+# can't watch the RI pin.
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
 import serial
 import logging
+import asyncio
 from threading import Thread
-from time import sleep
-
-
-#################
-# Text message object
-#################
-class FonaMessage(object):
-    def __init__(self, raw_text_message):
-        self.__parse(raw_text_message)
-
-    def __parse(self, raw_text_message):
-        try:
-            # raw_text_message will have two lines. The first is headers, the second the message.
-            # Headers are a comma seperated list.
-            logging.debug("Raw message: {0}".format(raw_text_message))
-            headers = raw_text_message[0].split(",")
-            logging.debug("Headers: {0}".format(headers))
-            # Response includes '+CMGL: ' before the message number. Strip that part.
-            self.__msg_number = headers[0][7:]
-            # Get rid of the "+ at the front and " at the end.
-            self.__sender_number = headers[2].replace("+", "").replace('\"', '')
-            # Date and time are separate. Join them together.
-            self.__msg_date = ", ".join(headers[4:])
-            # The text message is the second part. Replace carriage returns with carriage return + newline.
-            self.__text_message = raw_text_message[1].replace("\r", "\r\n")
-        except IndexError as err:
-            logging.warning("Fona Message message parse caught an error:")
-            logging.debug(err.args)
-            logging.debug(raw_text_message)
-
-    def __str__(self):
-        return "Message Number: {0}\r\nSender: {1}\r\nDate: {2}\r\nMessage: {3}\r\n".format(self.__msg_number,
-                                                                                            self.__sender_number,
-                                                                                            self.__msg_date,
-                                                                                            self.__text_message)
-
-    def __repr__(self):
-        return "Message Number: {0}\r\nSender: {1}\r\nDate: {2}\r\nMessage: {3}\r\n".format(self.__msg_number,
-                                                                                            self.__sender_number,
-                                                                                            self.__msg_date,
-                                                                                            self.__text_message)
-
-    @property
-    def sender_number(self):
-        return self.__sender_number
-
-    @property
-    def message_number(self):
-        return self.__msg_number
-
-    @property
-    def message_date(self):
-        return self.__msg_date
-
-    @property
-    def text_message(self):
-        return self.__text_message
+from time import sleep, monotonic
+from HighaltHardware.FonaATCommands import AtCommandEngine, RESULT_PROMPT, urc_fields
+from HighaltHardware.FonaStatus import StatusCache
+from HighaltHardware.FonaSms import FonaMessage, SmsParser, is_message_header
+from HighaltHardware.FonaDriver import AsyncFona, PRIORITY_URGENT, PRIORITY_BACKGROUND
+from HighaltHardware.FonaOutbox import SmsOutbox, KIND_POSITION
+from HighaltHardware.TelemetryCodec import encode_telemetry
+from HighaltHardware.FonaUplink import TelemetryUplink
+from HighaltHardware.HighaltRuntime import Subsystem
+from HighaltHardware.TelemetryBus import TOPIC_SENSOR, TOPIC_FONA_STATUS, TOPIC_FLIGHT
 
 
 #################
 # FONA object
 #################
 class Fona(object):
-    def __init__(self, serial_port=None, serial_connection=None):
+    def __init__(self, serial_port=None, serial_connection=None, status_ttls=None, connect=True):
         """
         Initializer for the Fona class.
         :param serial_port:  Physical port FONA is connected to.
         :param serial_connection: Existing serial connection to use.
+        :param status_ttls: Overrides for how long status values are cached, in seconds.
+        :param connect: Open the port and set the FONA up now. False leaves both to connect(),
+                        so creating one doesn't wait on the serial port.
         :return:
         """
         logging.debug("FONA: Creating FONA object.")
+        # Status values (signal strength, battery, ...) we've already asked for.
+        self.__status_cache = StatusCache(status_ttls)
+        # What AT+CSCS is set to. The SIM800 starts out in IRA.
+        self.__charset = "IRA"
         # Setup the serial connection
-        serial_settings = {"port": serial_port,
-                           "baudrate": 115200,
+        serial_settings = {"baudrate": 115200,
                            "bytesize": serial.EIGHTBITS,
                            "parity": serial.PARITY_NONE,
                            "stopbits": serial.STOPBITS_ONE,
@@ -109,6 +76,9 @@ class Fona(object):
                 # Otherwise, make our own.
                 logging.debug("FONA: Creating serial connection.")
                 self.__my_port = serial.Serial(**serial_settings)
+                self.__my_port.port = serial_port
+                if connect and serial_port:
+                    self.__my_port.open()
         except FileNotFoundError as err:
             logging.warning("FONA: Supplied port does not exist: {0}".format(serial_port))
             logging.debug("FONA: Error: {0}".format(err.args))
@@ -116,6 +86,7 @@ class Fona(object):
         finally:
             logging.debug("FONA: Connection status: {0}".format(self.__my_port.isOpen()))
             self.__connected = self.__my_port.isOpen()
+            self.__engine = AtCommandEngine(self.__my_port)
 
         # GPIO setup is up to the user. We'll warn if it's not done already, but we just care about numbers.
         # if GPIO.getmode() == GPIO.UNKNOWN:
@@ -132,22 +103,30 @@ class Fona(object):
                                       )
 
         self.__set_commands = dict(text_message_format="AT+CMGF",
+                                   character_set="AT+CSCS",
                                    error_verbosity="AT+CMEE",
                                    use_local_timestamp="AT+CLTS",
                                    ringer="AT+CFGRI",
+                                   new_message_indication="AT+CNMI",
                                    )
 
         self.__text_msg_commands = dict(list_messages="AT+CMGL",
-                                        delete_message="",
+                                        delete_message="AT+CMGD",
                                         send_message="AT+CMGS",
                                         retrieve_message="AT+CMGR"
                                         )
 
+        if self.__connected:
+            self.__status_query(self.__status_commands['AT'])
+            self.__configure()
+
+    def __configure(self):
         # Finally, some commands we're going to do simply because all we care about is text messaging
-        self.__status_query(self.__status_commands['AT'])
         self.__set_value(self.__set_commands['text_message_format'], 1)
         self.__set_value(self.__set_commands['ringer'], 1)
         self.__set_value(self.__set_commands['use_local_timestamp'], 1)
+        # Tell us (+CMTI) when a new text message has been stored, and where.
+        self.__set_value(self.__set_commands['new_message_indication'], "2,1")
 
     def __status_query(self, cmd):
         """
@@ -157,23 +136,15 @@ class Fona(object):
         # print(cmd)
         if self.__connected:
             # logging.debug("FONA: Status query: {0}".format(cmd))
-            responses = []
-            self.__my_port.write((cmd + "\n").encode("ascii"))
-            for line in self.__my_port:
-                responses.append(line.decode("ascii"))
-            # logging.debug("FONA: Query response: {0}".format(responses))
-            return responses
+            # The engine returns as soon as the modem says OK or ERROR.
+            return self.__engine.execute(cmd).lines
         else:
             raise serial.SerialException("Not connected to FONA. Can't get attribute.")
 
     def __set_value(self, key, value):
         # print("{0}: {1}".format(key, value))
         if self.__connected:
-            responses = []
-            self.__my_port.write((key + "=" + str(value) + "\n").encode("ascii"))
-            for line in self.__my_port:
-                responses.append(line.decode("ascii"))
-            return responses
+            return self.__engine.execute(key + "=" + str(value)).lines
         else:
             raise serial.SerialException("Not connected to FONA. Can't set attribute.")
 
@@ -183,8 +154,9 @@ class Fona(object):
                 self.__my_port.open()
             finally:
                 # Send a newline, then an AT to get things started.
-                self.__status_query("\n" + self.__status_commands["AT"])
                 self.__connected = self.__my_port.isOpen()
+                self.__status_query("\n" + self.__status_commands["AT"])
+            self.__configure()
 
     def disconnect(self):
         if self.__connected:
@@ -200,9 +172,13 @@ class Fona(object):
     # A neat way to handle getting attributes. It lets the user query the card for information
     # without having to provide an explicit function. Of course, this only works if I've already
     # defined the command needed.
+    # Status values come from the cache while they're fresh, so this only costs a serial round
+    # trip when they've gone stale.
     def __getattr__(self, item):
         if item in self.__status_commands:
-            return self.__status_query(self.__status_commands[item])
+            if self.__status_cache.is_fresh(item):
+                return self.__status_cache.get(item)
+            return self.refresh_status(item)
         elif item in self.__set_commands:
             return self.__status_query(self.__set_commands[item] + "?")
         else:
@@ -214,34 +190,132 @@ class Fona(object):
     def connected(self):
         return self.__connected
 
-    def get_current_text_messages(self, include_read=False, leave_unread=False):
+    # Round trip times for each command we've sent, as histograms keyed by command name.
+    @property
+    def command_latency(self):
+        return self.__engine.latency
+
+    # monotonic() time the FONA last answered a command.
+    @property
+    def last_response(self):
+        return self.__engine.last_response
+
+    def refresh_status(self, name):
+        """
+        Ask the FONA for a status value, parse it and update the cache.
+        :return: The parsed value, or None if the response couldn't be parsed.
+        """
+        value = self.__status_cache.parse(name, self.__status_query(self.__status_commands[name]))
+        if value is not None:
+            self.__status_cache.put(name, value)
+        return value
+
+    def cached_status(self, name, default=None):
+        """
+        The last value we got for a status, however old, without touching the serial port.
+        """
+        return self.__status_cache.get(name, default)
+
+    def status_age(self, name):
+        return self.__status_cache.age(name)
+
+    def add_status_listener(self, listener):
+        """
+        Call listener(name, value) whenever a status value is refreshed. Runs on the serial thread.
+        """
+        self.__status_cache.add_listener(listener)
+
+    # The status values that are due to be refreshed.
+    def stale_status(self):
+        return self.__status_cache.stale()
+
+    # Register handlers here for unsolicited result codes (+CMTI, +CMT, RING, ...).
+    @property
+    def urc_dispatcher(self):
+        return self.__engine.dispatcher
+
+    def poll_unsolicited(self):
+        """
+        Read anything the FONA sent on its own and dispatch it.
+        :return: The number of URC lines handled.
+        """
         if self.__connected:
-            cmd = [self.__text_msg_commands['list_messages'],
-                   "="]
-            if include_read:
-                cmd.append('\"ALL\",')
-            else:
-                cmd.append('\"REC UNREAD\",')
-            cmd.append(str(int(leave_unread)))
-            cmd.append("\n")
-            raw_messages = self.__status_query("".join(cmd))
-            trimmed_messages = []
-            for line in raw_messages:
-                logging.debug(line)
-                if not str.startswith(line, "AT+CMGL"):
-                    # Comes up at strange times. Discard.
-                    if not str.startswith(line, "+CMTI"):
-                        # Don't include lines that are only \r\n.
-                        if not str.isspace(line):
-                            # Strip off extra \r\n at the end of each line
-                            trimmed_messages.append(line.rstrip())
-
-            messages = []
-            for i in range(0, int((len(trimmed_messages) - 1)/2)):
-                messages.append(FonaMessage(trimmed_messages[2*i:2*i+2]))
-            return messages
-        else:
+            return self.__engine.poll()
+        return 0
+
+    @property
+    def charset(self):
+        return self.__charset
+
+    def set_charset(self, charset):
+        """
+        Change the character set (AT+CSCS): "IRA", "GSM" or "UCS2". With UCS2, numbers and
+        message bodies come over as hex, which the message parser decodes.
+        """
+        if "OK" in self.__set_value(self.__set_commands['character_set'], '"{0}"'.format(charset)):
+            self.__charset = charset.upper()
+        return self.__charset
+
+    def iter_text_messages(self, include_read=False, leave_unread=False):
+        """
+        Yield the stored messages one at a time, as they come in from the FONA, rather than
+        waiting for the whole listing. Go through all of them before sending another command.
+        """
+        if not self.__connected:
+            raise serial.SerialException("Not connected to FONA. Can't read text messages.")
+        cmd = '{0}="{1}",{2}'.format(self.__text_msg_commands['list_messages'],
+                                     "ALL" if include_read else "REC UNREAD",
+                                     int(leave_unread))
+        parser = SmsParser(self.__charset)
+        # The engine takes out the final result. URCs before the first header are dispatched, but
+        # one that arrives after it (a +CMTI in the middle of a burst) is just more message text.
+        for line in self.__engine.stream(cmd, message_header=is_message_header):
+            msg = parser.feed(line)
+            if msg is not None:
+                yield msg
+        msg = parser.finish()
+        if msg is not None:
+            yield msg
+        if parser.malformed:
+            logging.warning("FONA: {0} message(s) in the listing couldn't be parsed.".format(parser.malformed))
+
+    def get_current_text_messages(self, include_read=False, leave_unread=False, on_message=None):
+        """
+        :param on_message: Called with each message as soon as it's parsed, so handling can start
+                           before a long listing finishes.
+        :rtype : list
+        """
+        messages = []
+        for msg in self.iter_text_messages(include_read, leave_unread):
+            if on_message:
+                on_message(msg)
+            messages.append(msg)
+        return messages
+
+    def read_message(self, index, leave_unread=False):
+        """
+        Fetch a single message by its storage index, like the one a +CMTI gives us.
+        :rtype : FonaMessage
+        """
+        if not self.__connected:
             raise serial.SerialException("Not connected to FONA. Can't read text messages.")
+        cmd = "{0}={1},{2}".format(self.__text_msg_commands['retrieve_message'], index, int(leave_unread))
+        response = self.__engine.execute(cmd, message_header=is_message_header)
+        # Everything but the final result, which could otherwise pass for a line of the message.
+        lines = response.lines[:-1] if response.result else response.lines
+        messages = list(SmsParser(self.__charset, message_number=index).parse(lines))
+        if not response.ok or not messages:
+            logging.warning("FONA: No message at index {0}: {1}".format(index, response.lines))
+            return None
+        return messages[0]
+
+    def delete_message(self, index):
+        cmd = "{0}={1}".format(self.__text_msg_commands['delete_message'], index)
+        try:
+            return self.__status_query(cmd)
+        except serial.SerialException as err:
+            logging.warning(err.args[0])
+            return 0
 
     def send_text_message(self, destination_number, message):
         if len(message) > 140:
@@ -249,17 +323,122 @@ class Fona(object):
             return 0
         command = ["AT+CMGS=\"",    # send message command
                    str(destination_number),     # Destination phone number
-                   "\"",            # Close the quote on the number
-                   "\n",            # Newline
-                   message,         # The actual message
-                   "\x1A"]          # A Ctrl-Z to end.
+                   "\""]            # Close the quote on the number
 
         try:
-            return self.__status_query("".join(command))
+            if not self.__connected:
+                raise serial.SerialException("Not connected to FONA. Can't send text message.")
+            # Wait for the '>' prompt before handing over the message. The engine adds the Ctrl-Z.
+            response = self.__engine.execute("".join(command), expect_prompt=True)
+            if response.result != RESULT_PROMPT:
+                logging.warning("FONA: No prompt for message body. Got: {0}".format(response.lines))
+                return 0
+            return self.__engine.send_payload(message).lines
         except serial.SerialException as err:
             logging.warning(err.args[0])
             return 0
 
+    #################
+    # GPRS data
+    #################
+    def open_bearer(self, apn):
+        """
+        Bring up the GPRS bearer (profile 1) if it isn't already.
+        :return: True if the bearer is connected.
+        """
+        if not self.__connected:
+            raise serial.SerialException("Not connected to FONA. Can't open GPRS.")
+        self.__engine.execute('AT+SAPBR=3,1,"CONTYPE","GPRS"')
+        self.__engine.execute('AT+SAPBR=3,1,"APN","{0}"'.format(apn))
+        if self.bearer_open():
+            return True
+        self.__engine.execute("AT+SAPBR=1,1")
+        return self.bearer_open()
+
+    def bearer_open(self):
+        # +SAPBR: <cid>,<status>,<ip>, where status 1 is connected.
+        for line in self.__engine.execute("AT+SAPBR=2,1").lines:
+            if line.startswith("+SAPBR:"):
+                return urc_fields(line)[1] == "1"
+        return False
+
+    def close_bearer(self):
+        return self.__status_query("AT+SAPBR=0,1")
+
+    # A POST comes in steps, each of them quick, so whoever owns the port can fit other commands
+    # (text messages) in between: http_start, then http_result until there's an answer, then
+    # http_read if there's a body, and http_end. http_post does the lot in one go.
+    def http_start(self, url, data, content_type="application/octet-stream"):
+        """
+        Set up an HTTP session, hand over the data and send the POST. The bearer has to be open
+        already (see open_bearer). The answer comes later: see http_result.
+        :return: True if the POST went out. If it didn't, the session has been closed again.
+        """
+        if not self.__connected:
+            raise serial.SerialException("Not connected to FONA. Can't POST.")
+        engine = self.__engine
+        # In case an earlier session was left open.
+        engine.execute("AT+HTTPTERM")
+        for cmd in ("AT+HTTPINIT",
+                    'AT+HTTPPARA="CID",1',
+                    'AT+HTTPPARA="URL","{0}"'.format(url),
+                    'AT+HTTPPARA="CONTENT","{0}"'.format(content_type)):
+            if not engine.execute(cmd).ok:
+                logging.warning("FONA: HTTP setup failed at {0}".format(cmd))
+                self.http_end()
+                return False
+        # Give it 10 s to take the data.
+        prompt = engine.execute("AT+HTTPDATA={0},10000".format(len(data)), expect_prompt="DOWNLOAD")
+        if prompt.result != "DOWNLOAD" or not engine.send_data(data).ok:
+            self.http_end()
+            return False
+        engine.expect_urc("+HTTPACTION:")
+        if not engine.execute("AT+HTTPACTION=1").ok:
+            self.http_end()
+            return False
+        return True
+
+    def http_result(self, timeout=0.2):
+        """
+        See if the answer to http_start has come, waiting at most timeout seconds for it.
+        :return: (HTTP status, length of the response body), or None if it hasn't. The SIM800
+                 uses 6xx statuses for network errors.
+        """
+        # +HTTPACTION: <method>,<status>,<length>
+        action = self.__engine.wait_for_urc("+HTTPACTION:", timeout, keep_waiting=True)
+        if action is None:
+            return None
+        _, status, length = (int(x) for x in urc_fields(action)[:3])
+        return status, length
+
+    def http_read(self):
+        read = self.__engine.execute("AT+HTTPREAD")
+        # +HTTPREAD: <length>, then the body, then OK.
+        body_lines = [line for line in read.lines
+                      if not line.startswith(("AT+HTTPREAD", "+HTTPREAD:")) and line != "OK"]
+        return "\n".join(body_lines)
+
+    def http_end(self):
+        self.__engine.forget_urc("+HTTPACTION:")
+        return self.__engine.execute("AT+HTTPTERM").ok
+
+    def http_post(self, url, data, content_type="application/octet-stream", timeout=120):
+        """
+        POST data over GPRS and wait for the answer, holding the port the whole time.
+        :return: (HTTP status, response body). The status is 0 if we never got as far as a response.
+        """
+        if not self.http_start(url, data, content_type):
+            return 0, None
+        try:
+            result = self.http_result(timeout)
+            if result is None:
+                logging.warning("FONA: No answer to the POST after {0}s.".format(timeout))
+                return 0, None
+            status, length = result
+            return status, self.http_read() if length > 0 else None
+        finally:
+            self.http_end()
+
     def delete_all_messages(self):
         cmd = 'AT+CMGD=1,4'
         try:
@@ -270,80 +449,422 @@ class Fona(object):
 
 
 #################
-# FONA control thread
+# FONA control
 #################
-class FonaThread (Thread):
-    def __init__(self, serial_port, ring_indicator_pin=None, gps_coord_locaiton=None):
-        Thread.__init__(self)
+class FonaService (Subsystem):
+    name = "FONA"
+    # Ready once the modem is registered on a network.
+    reports_ready = True
+    # The status refreshes get an answer every 30 seconds or so. This is longer than the
+    # longest command (an HTTP POST) is allowed to take.
+    stall_timeout = 150
+    # How long KEY has to be held low to turn the SIM800 on or off, and how long it takes to do it.
+    KEY_PULSE = 2
+    POWER_SETTLE = 3
+    # Seconds between looks for unread messages that never got a +CMTI (or whose +CMTI was lost).
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, serial_port, ring_indicator_pin=None, gps_coord_locaiton=None, max_texts_per_minute=6,
+                 telemetry_source=None, uplink_url=None, uplink_apn=None, uplink_spool=None, bus=None,
+                 key_pin=None, power_status_pin=None, windows=None):
+        """
+        :param telemetry_source: Called to get recent SensorRecords (oldest first) for replies.
+                                 Without it, replies are the latest position on the bus, or
+                                 gps_coord_locaiton if there isn't one.
+        :param uplink_url: Where to POST batches of records over GPRS. No uplink without it.
+        :param uplink_apn: The carrier's GPRS access point name.
+        :param uplink_spool: Directory to keep unsent batches in.
+        :param bus: TelemetryBus to read the latest position from, and publish status values on.
+        :param key_pin: GPIO (BCM) that pulls the FONA's KEY pin low, to power cycle it if it stops answering.
+        :param power_status_pin: GPIO (BCM) the FONA's PS pin is on, to tell whether it's on.
+        :param windows: TelemetryWindows, for the STATS command. Without it, every text gets the position.
+        """
         logging.debug("Fona control thread: Initializing.")
         logging.debug("Fona control thread: Using port: {0}".format(serial_port))
         logging.debug("Fona control thread: RI pint: {0}".format(ring_indicator_pin))
         logging.debug("Fona control thread: GPS Coordinates: {0}".format(gps_coord_locaiton))
         self.__fona_port = serial_port
         self.__ring_pin = ring_indicator_pin
+        self.__key_pin = key_pin
+        self.__power_status_pin = power_status_pin
         self.__gps_coords = gps_coord_locaiton
+        self.__max_texts_per_minute = max_texts_per_minute
+        self.__telemetry_source = telemetry_source
+        self.__windows = windows
+        self.__bus = bus
         self.__stop = False
-        self.__fona = Fona(serial_port=self.__fona_port)
-        # Using this as a semaphore for the moment. It's not the best way, but I'll look into that later.
-        self.__ser_in_use = False
+        self.__runtime = None
+        # The port is opened, and the FONA set up, by the driver once we're running.
+        self.__fona = Fona(serial_port=self.__fona_port, connect=False)
+        if self.__bus:
+            self.__fona.add_status_listener(lambda name, value: self.__bus.publish(TOPIC_FONA_STATUS + name, value))
+        # Everything that needs the serial port goes through the driver, so nothing else
+        # has to worry about who's using it.
+        # If the RI pin isn't wired up, the driver checks for new messages whenever it's idle.
+        self.__driver = AsyncFona(self.__fona, idle_poll=1)
+        # Feed it records with uplink.add_record (e.g. as an Arduino record listener).
+        self.uplink = None
+        if uplink_url:
+            self.uplink = TelemetryUplink(self.__driver, uplink_url, uplink_apn, spool_dir=uplink_spool)
+        self.__loop = None
+        self.__wake = None
+        self.__callback_set = False
+        # Created once the event loop is running.
+        self.__outbox = None
+        # Storage indexes of messages being dealt with, until they're deleted. A message can turn
+        # up in a sweep and from its +CMTI both, and should only be answered once.
+        self.__claimed = set()
+        self.__sweep_task = None
+        self.__sweep_wanted = False
+        self.__last_sweep = None
+        # New messages are announced with +CMTI (stored, with index) or +CMT (delivered directly).
+        self.__fona.urc_dispatcher.register("+CMTI:", self.__new_message_urc)
+        self.__fona.urc_dispatcher.register("+CMT:", self.__delivered_message_urc)
 
     def stop(self):
         logging.debug("Fona control thread: Stop called.")
         self.__stop = True
+        if self.__wake:
+            self.__call_in_loop(self.__wake.set)
 
-    def __connect_to_fona(self):
-        logging.debug("Fona control thread: Connecting to Fona.")
-        self.__fona.connect()
+    # Run something on our event loop from another thread, if the loop is still there.
+    def __call_in_loop(self, func, *args):
+        try:
+            if self.__loop and not self.__loop.is_closed():
+                self.__loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:
+            # The loop closed in between. We're shutting down anyway.
+            pass
 
-    def __get_last_text_message(self):
+    async def __connect_to_fona(self):
+        logging.debug("Fona control thread: Connecting to Fona.")
+        await self.__driver.submit(self.__fona.connect, priority=PRIORITY_URGENT)
+        if self.__runtime:
+            self.__runtime.mark(self, "modem connected")
+        self.__spawn(self.__wait_for_network)
+
+    async def __wait_for_network(self):
+        # Texts can go out once the modem is on a network. That can take a while after power up.
+        while not self.__stop:
+            network = await self.__driver.submit(self.__fona.refresh_status, 'network_status',
+                                                 priority=PRIORITY_BACKGROUND)
+            if network is not None and network.operator:
+                logging.info("Fona control thread: Registered with {0}.".format(network.operator))
+                if self.__runtime:
+                    self.__runtime.ready(self)
+                return
+            await asyncio.sleep(2)
+
+    async def __get_last_text_message(self, on_message=None):
         logging.debug("Fona control thread: Retrieving messages.")
-        return self.__fona.get_current_text_messages(False, False)
+        return await self.__driver.get_messages(False, False, on_message=on_message)
 
-    def __send_response(self, destination_number, message_content):
-        logging.info("Fona control thread: Sending message to {0}.".format(destination_number))
+    async def __send_response(self, destination_number, message_content, kind=None):
+        """
+        :param kind: KIND_POSITION for a position report, which replaces one still waiting to go
+                     to the same number. Anything else is only merged with the same text.
+        """
+        logging.info("Fona control thread: Queueing message to {0}.".format(destination_number))
         logging.info("Fona control thread: Message content: {0}.".format(message_content))
-        self.__fona.send_text_message(destination_number, message_content)
+        self.__outbox.enqueue(destination_number, message_content, kind=kind)
+
+    async def __handle_message(self, msg):
+        logging.debug(msg)
+        # Kind of arbitrary, but allows for a number to be 9 or 10 digits
+        # Prevent us from sending a message to auto-texts (like from the carrier)
+        if len(msg.sender_number) > 8:
+            logging.info("Message received from: {0}. Sending reply".format(msg.sender_number))
+            stats = self.__stats_reply(msg.text_message)
+            if stats:
+                # Not a position report, so it mustn't replace one (or be replaced by one).
+                await self.__send_response(msg.sender_number, stats)
+            else:
+                await self.__send_response(msg.sender_number, self.__build_reply(), kind=KIND_POSITION)
+        else:
+            logging.info("Message received from {0} on {1}".format(msg.sender_number, msg.message_date))
+            logging.info("Message: {0}".format(msg.text_message))
+
+    def __build_reply(self):
+        # The FlightMonitor's altitude, rate and phase, if there's one running.
+        flight = self.__bus.latest(TOPIC_FLIGHT) if self.__bus else None
+        if self.__telemetry_source is None:
+            # Where we are right now, not wherever we were when we started.
+            record = self.__bus.latest(TOPIC_SENSOR) if self.__bus else None
+            if record is not None and record.has_fix:
+                reply = "{0}, {1}".format(record.latitude, record.longitude)
+                if flight is not None:
+                    reply += ", {0:.0f}m, {1}".format(flight.altitude, flight.phase)
+                return reply
+            return self.__gps_coords
+        # Pack the last few fixes and the rest of what we know into one text.
+        # The battery comes from the status cache, so this doesn't wait on the serial port.
+        battery = self.__fona.cached_status('battery_state')
+        return encode_telemetry(self.__telemetry_source(),
+                                battery_percent=battery.percent if battery else None,
+                                vrate=flight.vertical_rate if flight else None,
+                                altitude=flight.altitude if flight else None,
+                                phase=flight.phase if flight else None)
+
+    def __stats_reply(self, text):
+        # "STATS" is the last 10 minutes, "STATS 60" the last hour, "STATS BURST" since burst (or any phase).
+        words = (text or "").split()
+        if self.__windows is None or not words or words[0].upper() != "STATS":
+            return None
+        if len(words) < 2:
+            return self.__windows.summary()
+        if words[1].isdigit():
+            return self.__windows.summary(int(words[1]) * 60)
+        return self.__windows.summary(words[1].lower())
+
+    async def __fetch_message(self, index):
+        if index in self.__claimed:
+            # A sweep got to it first.
+            return
+        self.__claimed.add(index)
+        try:
+            logging.debug("Fona control thread: Fetching message {0}.".format(index))
+            msg = None
+            # The modem sometimes isn't ready to hand it over straight away. Try a few times.
+            for attempt in range(3):
+                msg = await self.__driver.submit(self.__fona.read_message, index)
+                if msg:
+                    break
+                await asyncio.sleep(1)
+            if msg:
+                await self.__answer_stored(index, msg)
+        finally:
+            self.__claimed.discard(index)
+        # Another text could have come in while we were reading this one, and its +CMTI would
+        # have been taken for part of this one's text.
+        self.__request_sweep()
+
+    async def __answer_stored(self, index, msg):
+        await self.__handle_message(msg)
+        # Once it's dealt with, get it out of storage so the SIM doesn't fill up.
+        await self.__driver.submit(self.__fona.delete_message, index, priority=PRIORITY_BACKGROUND)
+
+    async def __answer_swept(self, msg):
+        try:
+            index = int(msg.message_number)
+        except (TypeError, ValueError):
+            await self.__handle_message(msg)
+            return
+        if index in self.__claimed:
+            # Its +CMTI got there first.
+            return
+        self.__claimed.add(index)
+        try:
+            await self.__answer_stored(index, msg)
+        finally:
+            self.__claimed.discard(index)
+
+    # Go through the unread messages: after a (re)connect, as anything that arrived while we weren't
+    # listening won't get a +CMTI; after each message read, as a +CMTI that came in during it was
+    # lost; and every SWEEP_INTERVAL in case all else fails. Requests while one is running make it
+    # go round again rather than starting another.
+    def __request_sweep(self):
+        self.__sweep_wanted = True
+        if self.__sweep_task is None or self.__sweep_task.done():
+            self.__sweep_task = asyncio.ensure_future(self.__sweep())
+            self.__sweep_task.add_done_callback(self.__task_done)
+
+    async def __sweep(self):
+        while self.__sweep_wanted and not self.__stop:
+            self.__sweep_wanted = False
+            self.__last_sweep = monotonic()
+            # Each one is handled as soon as it's parsed, rather than after the whole (possibly long)
+            # listing.
+            found = await self.__get_last_text_message(
+                on_message=lambda msg: self.__call_in_loop(self.__spawn, self.__answer_swept, msg))
+            if found:
+                # Texts come in bursts, and the listing could have swallowed another one's +CMTI.
+                self.__sweep_wanted = True
+
+    # These two are called by the URC dispatcher, on the serial worker thread.
+    def __new_message_urc(self, line, body):
+        fields = urc_fields(line)
+        logging.debug("Fona control thread: New message in {0} at {1}.".format(*fields))
+        self.__call_in_loop(self.__spawn, self.__fetch_message, int(fields[1]))
+
+    def __delivered_message_urc(self, line, body):
+        for msg in SmsParser(self.__fona.charset).parse([line, body or ""]):
+            self.__call_in_loop(self.__spawn, self.__handle_message, msg)
+
+    async def __handle_ring(self):
+        # The RI pin drops when a URC comes in. Go and read it.
+        await self.__driver.submit(self.__fona.poll_unsolicited, priority=PRIORITY_URGENT)
+
+    def ring(self):
+        """
+        The RI line dropped. Safe to call from any thread (the GPIO callback, or the simulator).
+        """
+        # Don't touch the serial port here, just hand the work over to the event loop.
+        self.__call_in_loop(self.__spawn, self.__handle_ring)
+
+    # Start a coroutine as a task on our loop, logging it if it fails.
+    def __spawn(self, coroutine_function, *args):
+        asyncio.ensure_future(coroutine_function(*args)).add_done_callback(self.__task_done)
+
+    def __task_done(self, task):
+        if not task.cancelled() and task.exception():
+            logging.warning("Fona control thread: Task failed: {0}".format(task.exception()))
 
     def __ring_callback(self, channel):
+        # This runs on the RPi.GPIO thread.
         logging.debug("Fona control thread: Callback function called.")
-        # Send a keep-alive to flush some data.
-        self.__fona.keep_alive()
-        if not self.__ser_in_use:
-            for msg in self.__get_last_text_message():
-                logging.debug(msg)
-                # Kind of arbitrary, but allows for a number to be 9 or 10 digits
-                # Prevent us from sending a message to auto-texts (like from the carrier)
-                if len(msg.sender_number) > 8:
-                    logging.info("Message received from: {0}. Sending reply".format(msg.sender_number))
-                    self.__send_response(msg.sender_number, self.__gps_coords)
-                else:
-                    logging.info("Message received from {0} on {1}".format(msg.sender_number, msg.message_date))
-                    logging.info("Message: {0}".format(msg.text_message))
-        else:
-            sleep(1)
+        self.ring()
 
     def __setup_callback(self):
+        if self.__callback_set:
+            return
+        if self.__ring_pin is None or GPIO is None:
+            logging.info("Fona control thread: No RI pin. Polling for new messages instead.")
+            return
         logging.debug("Fona control thread: Setting up callback function.")
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(self.__ring_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.add_event_detect(self.__ring_pin, GPIO.FALLING, callback=self.__ring_callback)
-        pass
-
-    def run(self):
-        logging.debug("Fona control thread: Starting thread running.")
-        self.__setup_callback()
+        self.__callback_set = True
+
+    async def __supervise(self):
+        driver_task = asyncio.ensure_future(self.__driver.run())
+        refresh_task = asyncio.ensure_future(self.__driver.refresh_status())
+        self.__outbox = SmsOutbox(self.__driver, max_per_minute=self.__max_texts_per_minute)
+        outbox_task = asyncio.ensure_future(self.__outbox.run())
+        uplink_task = asyncio.ensure_future(self.uplink.run()) if self.uplink else None
         try:
+            # The sweeps run alongside, so a long inbox (or a failed listing) doesn't hold up
+            # or take down the supervisor.
+            if self.__fona.connected:
+                self.__spawn(self.__wait_for_network)
+                self.__request_sweep()
             while not self.__stop:
                 if not self.__fona.connected:
-                    self.__fona.connect()
-                # self.__ser_in_use = True
-                # self.__fona.keep_alive()
-                # self.__ser_in_use = False
-                sleep(5)
+                    await self.__connect_to_fona()
+                    self.__request_sweep()
+                elif self.__last_sweep is not None and monotonic() - self.__last_sweep >= self.SWEEP_INTERVAL:
+                    self.__request_sweep()
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), 5)
+                except asyncio.TimeoutError:
+                    pass
             logging.debug("Fona control thread: Stop was set.")
+        finally:
+            refresh_task.cancel()
+            if self.__sweep_task:
+                self.__sweep_task.cancel()
+            if uplink_task:
+                self.uplink.stop()
+                await uplink_task
+                self.uplink.log_stats()
+            self.__outbox.stop()
+            await outbox_task
+            self.__outbox.log_stats()
+            self.__driver.stop()
+            await driver_task
+
+    #################
+    # Watchdog
+    #################
+    @property
+    def last_heartbeat(self):
+        return self.__fona.last_response
+
+    async def recover(self, runtime):
+        # Stuck mid-command, or browned out. Turning it off and on again fixes either, if we can.
+        # Either way it's set up from scratch when it restarts.
+        if self.__key_pin is not None and GPIO is not None:
+            logging.warning("Fona control thread: Modem isn't answering. Power cycling it.")
+            await runtime.run_blocking(self.__power_cycle)
+        await runtime.restart(self, "modem not answering")
+
+    def __power_cycle(self):
+        # Only sleeps, but long ones, so this goes on a worker thread.
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self.__key_pin, GPIO.OUT, initial=GPIO.HIGH)
+        if self.__power_status_pin is not None:
+            GPIO.setup(self.__power_status_pin, GPIO.IN)
+        # Without PS to go by, assume it's still on: it was answering until a while ago.
+        if self.__power_status_pin is None or GPIO.input(self.__power_status_pin):
+            self.__pulse_key()
+        self.__pulse_key()
+        logging.info("Fona control thread: Power cycled{0}.".format(
+            "" if self.__power_status_pin is None else
+            ", and it's {0}".format("on" if GPIO.input(self.__power_status_pin) else "still off")))
+
+    def __pulse_key(self):
+        GPIO.output(self.__key_pin, GPIO.LOW)
+        sleep(self.KEY_PULSE)
+        GPIO.output(self.__key_pin, GPIO.HIGH)
+        sleep(self.POWER_SETTLE)
+
+    def register_metrics(self, metrics):
+        fona = self.__fona
+        metrics.histogram("fona_command_seconds", "AT command round trip time.",
+                          lambda: dict(fona.command_latency), label="command")
+        metrics.gauge("fona_driver_queue_depth", "Commands waiting for the serial port.",
+                      lambda: self.__driver.queue_depth)
+        metrics.gauge("fona_sms_queue_depth", "Texts waiting to be sent.",
+                      lambda: self.__outbox.depth if self.__outbox else None)
+        metrics.counter("fona_sms_sent_total", "Texts sent.", lambda: self.__outbox.sent if self.__outbox else None)
+        metrics.counter("fona_sms_failed_total", "Texts given up on.",
+                        lambda: self.__outbox.failed if self.__outbox else None)
+        metrics.gauge("fona_signal_dbm", "Signal strength.",
+                      lambda: getattr(fona.cached_status('signal_strength'), 'rssi_dbm', None))
+        metrics.gauge("fona_battery_percent", "FONA battery charge.",
+                      lambda: getattr(fona.cached_status('battery_state'), 'percent', None))
+        if self.uplink:
+            uplink = self.uplink
+            metrics.counter("uplink_records_total", "Records delivered over GPRS.", lambda: uplink.records_sent)
+            metrics.counter("uplink_bytes_total", "Bytes delivered over GPRS.", lambda: uplink.bytes_sent)
+            metrics.counter("uplink_retries_total", "Batches that had to be sent again.", lambda: uplink.retries)
+            metrics.gauge("uplink_spool_depth", "Batches waiting to be delivered.", lambda: uplink.spool_depth)
+
+    async def run(self, runtime):
+        logging.debug("Fona control thread: Starting.")
+        self.__runtime = runtime
+        self.__loop = asyncio.get_running_loop()
+        self.__wake = asyncio.Event()
+        self.__driver.reset()
+        if self.__stop:
+            self.__wake.set()
+        self.__setup_callback()
+        try:
+            await self.__supervise()
         finally:
             self.__fona.disconnect()
-        pass
+
+
+#################
+# FONA control thread
+#################
+class FonaThread (Thread):
+    def __init__(self, *args, **kwargs):
+        """
+        Runs a FonaService on an event loop of its own, for when the FONA is used without the
+        rest of the runtime (fona_main, the benchmarks). Takes the same arguments as FonaService.
+        """
+        Thread.__init__(self)
+        self.service = FonaService(*args, **kwargs)
+
+    @property
+    def uplink(self):
+        return self.service.uplink
+
+    def ring(self):
+        self.service.ring()
+
+    def stop(self):
+        self.service.stop()
+
+    def run(self):
+        logging.debug("Fona control thread: Starting thread running.")
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.service.run(None))
+        finally:
+            loop.close()
 
 
 #################
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# The Arduino's binary protocol.
+#
+# As text, a row is about 150 bytes, and nothing tells a corrupted or cut off line from a good
+# one. When the Pi's first byte to the sketch is 'B' (instead of the "Hello." that starts the
+# text rows), Logging_v2.ino sends frames instead:
+#
+#   frame on the wire:  COBS(type, payload..., crc low, crc high) 0x00
+#
+#   - COBS (Consistent Overhead Byte Stuffing) takes the zeros out of the frame for one extra
+#     byte, so a zero always means the end of a frame. After a dropped byte we lose one frame,
+#     not the rest of the stream.
+#   - The CRC is CRC-16/CCITT (poly 0x1021, starting at 0xFFFF) over the type and payload.
+#     That's _crc_xmodem_update on the Arduino and binascii.crc_hqx here.
+#
+# Frame types:
+#   'S' schema, one frame per field, sent at startup: version, stream, index, field count, then
+#       "name:type:scale" in ASCII. type is a struct code; the value sent is the real value
+#       times scale (latitude:i:10000000 is degrees in units of 1e-7, as an int32). stream is
+#       the frame type the records using this schema are sent as. (Version 1 has no stream
+#       byte, and its schema is always for 'R'.)
+#   'R' a record: version, then the fields, little endian and packed, in schema order.
+#   'N' a raw NMEA sentence from the GPS: millis() (uint32) when its $ came in, then the sentence.
+#   Any other type is a record of that stream, laid out the same way. Stream mode (the Pi sends
+#   'M') has a schema and stream for each sensor instead of 'R' rows. See SensorStreams. If the
+#   Pi sends 'N', the GPS stream is the raw sentences instead, for NmeaParser.
+#
+# A record is about 60 bytes on the wire. Anything that isn't a good frame (the sketch's
+# text from before it heard from us, or an old sketch that only does text) is handed back as
+# lines of text.
+#
+#####################################################################
+
+import struct
+import binascii
+from collections import namedtuple
+
+FRAME_SCHEMA = ord('S')
+FRAME_RECORD = ord('R')
+FRAME_NMEA = ord('N')
+
+# What the Pi sends to ask for frames (as the keep alive): one row at a time, or each sensor's stream.
+REQUEST_BINARY = b"B"
+REQUEST_STREAMS = b"M"
+REQUEST_NMEA = b"N"
+
+# One of the GPS's sentences, as the sketch forwarded it.
+NmeaFrame = namedtuple('NmeaFrame', ['millis', 'sentence'])
+_NMEA_MILLIS = struct.Struct("<I")
+
+# A frame is never longer than this. Anything longer without a zero in it is text.
+MAX_FRAME = 256
+
+# Bytes that can appear in the sketch's text.
+_TEXT_BYTES = frozenset(range(0x20, 0x7F)) | {ord('\r'), ord('\n'), ord('\t')}
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+#################
+# COBS
+#################
+def cobs_encode(data):
+    out = bytearray()
+    for block in bytes(data).split(b"\0"):
+        # Blocks longer than 254 bytes are split, with no zero implied between the pieces.
+        while len(block) >= 254:
+            out.append(255)
+            out += block[:254]
+            block = block[254:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(data):
+    """
+    :raises ValueError: If data isn't valid COBS.
+    """
+    out = bytearray()
+    i = 0
+    length = len(data)
+    while i < length:
+        code = data[i]
+        if code == 0:
+            raise ValueError("Zero in COBS data at {0}".format(i))
+        end = i + code
+        if end > length:
+            raise ValueError("COBS block at {0} runs past the end".format(i))
+        out += data[i + 1:end]
+        i = end
+        # Every block but a full one (and the last) stood in for a zero.
+        if code < 255 and i < length:
+            out.append(0)
+    return bytes(out)
+
+
+def encode_frame(frame_type, payload):
+    # For tests and simulators: what the sketch sends.
+    body = bytes([frame_type]) + bytes(payload)
+    return cobs_encode(body + struct.pack("<H", crc16(body))) + b"\0"
+
+
+#################
+# Schema
+#################
+class Schema(object):
+    def __init__(self, version, fields, stream=FRAME_RECORD):
+        """
+        :param version: Protocol version the sketch sent.
+        :param fields: (name, struct code, scale) for each field, in order.
+        :param stream: The frame type of the records.
+        """
+        self.version = version
+        self.stream = stream
+        self.fields = list(fields)
+        self.names = [name for name, _, _ in self.fields]
+        self.struct = struct.Struct("<B" + "".join(code for _, code, _ in self.fields))
+        # Dividing is only done for the fields that need it.
+        self.__scaled = [(i, float(scale)) for i, (_, _, scale) in enumerate(self.fields) if scale != 1]
+
+    @classmethod
+    def parse_entry(cls, text):
+        name, code, scale = text.split(":")
+        return name, code, int(scale)
+
+    def unpack(self, payload):
+        """
+        The field values (scaled back to real units) from a record payload.
+        :raises struct.error: If the payload isn't the right size.
+        :rtype : list
+        """
+        values = list(self.struct.unpack(payload))
+        if values[0] != self.version:
+            raise ValueError("Record is version {0}, schema is {1}".format(values[0], self.version))
+        del values[0]
+        for i, scale in self.__scaled:
+            values[i] /= scale
+        return values
+
+    def pack(self, values):
+        # For tests and simulators: the payload the sketch would send.
+        raw = list(values)
+        for i, scale in self.__scaled:
+            raw[i] = int(round(raw[i] * scale))
+        return self.struct.pack(self.version, *raw)
+
+    def entries(self):
+        # The schema frames' text, one per field.
+        return ["{0}:{1}:{2}".format(*field) for field in self.fields]
+
+    def frames(self):
+        # For tests and simulators: the schema frames the sketch would send.
+        return [encode_frame(FRAME_SCHEMA, bytes([self.version, self.stream, i, len(self)]) + entry.encode("ascii"))
+                for i, entry in enumerate(self.entries())]
+
+    def __len__(self):
+        return len(self.fields)
+
+
+#################
+# Decoding the stream
+#################
+class FrameDecoder(object):
+    def __init__(self, record_factory=None):
+        """
+        :param record_factory: Called with each new Schema. Returns a function that turns a list
+                               of field values into a record. Without one, records are the lists.
+        """
+        self.__record_factory = record_factory
+        self.__buffer = bytearray()
+        # (version, stream) -> schema entries received so far.
+        self.__pending = {}
+        # stream -> (Schema, function to make its records)
+        self.__streams = {}
+        # The last schema completed.
+        self.schema = None
+        # Stats
+        self.frames = 0
+        self.records = 0
+        self.text_lines = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+        self.schema_errors = 0
+
+    def reset(self):
+        # A new stream (the Arduino was reset): forget the schema and anything half read. Keeps the stats.
+        self.__buffer.clear()
+        self.__pending.clear()
+        self.__streams.clear()
+        self.schema = None
+
+    def schemas(self):
+        """
+        Stream -> Schema, for every schema received so far.
+        :rtype : dict
+        """
+        return {stream: schema for stream, (schema, _) in self.__streams.items()}
+
+    @property
+    def errors(self):
+        return dict(crc=self.crc_errors, framing=self.framing_errors, schema=self.schema_errors)
+
+    def feed(self, data):
+        """
+        :param data: Bytes off the serial port.
+        :return: Records and lines of text (str), in the order they came in.
+        :rtype : list
+        """
+        out = []
+        buffer = self.__buffer
+        buffer += data
+        while True:
+            end = buffer.find(b"\0")
+            if end < 0:
+                break
+            chunk = bytes(buffer[:end])
+            del buffer[:end + 1]
+            if chunk:
+                self.__chunk(chunk, out)
+        # No zero in a long while: it's text (an old sketch). Hand over the complete lines.
+        if len(buffer) > MAX_FRAME:
+            end = buffer.rfind(b"\n")
+            if end >= 0:
+                self.__text(bytes(buffer[:end + 1]), out)
+                del buffer[:end + 1]
+            elif len(buffer) > 4 * MAX_FRAME:
+                del buffer[:]
+        return out
+
+    def __chunk(self, chunk, out):
+        try:
+            frame = cobs_decode(chunk)
+        except ValueError:
+            frame = None
+        if frame is None or len(frame) < 3 or crc16(frame[:-2]) != frame[-2] | frame[-1] << 8:
+            if all(b in _TEXT_BYTES for b in chunk):
+                self.__text(chunk, out)
+            elif frame is None:
+                self.framing_errors += 1
+            else:
+                self.crc_errors += 1
+            return
+        self.frames += 1
+        frame_type = frame[0]
+        payload = frame[1:-2]
+        if frame_type == FRAME_SCHEMA:
+            self.__schema_entry(payload)
+            return
+        if frame_type == FRAME_NMEA:
+            if len(payload) <= _NMEA_MILLIS.size:
+                self.schema_errors += 1
+                return
+            out.append(NmeaFrame(_NMEA_MILLIS.unpack_from(payload)[0], payload[_NMEA_MILLIS.size:]))
+            return
+        stream = self.__streams.get(frame_type)
+        if stream is None:
+            # Records before their schema are no use to us.
+            self.schema_errors += 1
+            return
+        schema, make_record = stream
+        try:
+            values = schema.unpack(payload)
+        except (struct.error, ValueError):
+            self.schema_errors += 1
+            return
+        self.records += 1
+        out.append(make_record(values))
+
+    def __schema_entry(self, payload):
+        if len(payload) < 4 or (payload[0] > 1 and len(payload) < 5):
+            self.schema_errors += 1
+            return
+        if payload[0] == 1:
+            version, stream, index, count, text = payload[0], FRAME_RECORD, payload[1], payload[2], payload[3:]
+        else:
+            version, stream, index, count, text = payload[0], payload[1], payload[2], payload[3], payload[4:]
+        key = (version, stream)
+        entries = self.__pending.get(key)
+        # A new schema starts at field 0 (after a reset, say).
+        if index == 0 or entries is None or len(entries) != count:
+            entries = self.__pending[key] = [None] * count
+        if index >= count:
+            self.schema_errors += 1
+            return
+        try:
+            entries[index] = Schema.parse_entry(text.decode("ascii"))
+        except (ValueError, UnicodeDecodeError):
+            self.schema_errors += 1
+            return
+        if all(entries):
+            del self.__pending[key]
+            self.schema = Schema(version, entries, stream)
+            make_record = self.__record_factory(self.schema) if self.__record_factory else list
+            self.__streams[stream] = (self.schema, make_record)
+
+    def __text(self, data, out):
+        for line in data.decode(errors="replace").splitlines():
+            line = line.rstrip()
+            if line:
+                self.text_lines += 1
+                out.append(line)
+
+
+if __name__ == "__main__":
+    # Round trip a schema and some records through the encoder and decoder, with some damage.
+    import random
+    from time import perf_counter
+
+    schema = Schema(2, [("millis", "I", 1), ("latitude", "i", 10000000), ("longitude", "i", 10000000),
+                        ("accel_z", "h", 100), ("pressure", "I", 4), ("k_temp", "h", 4)])
+    stream = bytearray(b"Made it to setup.\r\nGPS: OK\r\n\0")
+    for frame in schema.frames():
+        stream += frame
+    frames = [encode_frame(FRAME_RECORD, schema.pack([i, 37.1234567, -122.4, 9.81, 101325.25, -3140]))
+              for i in range(10000)]
+    for frame in frames:
+        stream += frame
+    damaged = bytearray(stream)
+    rng = random.Random(1)
+    for _ in range(50):
+        damaged[rng.randrange(200, len(damaged))] ^= 1 << rng.randrange(8)
+
+    for name, data in (("clean", stream), ("damaged", damaged)):
+        decoder = FrameDecoder()
+        start = perf_counter()
+        out = []
+        for offset in range(0, len(data), 64):
+            out.extend(decoder.feed(data[offset:offset + 64]))
+        elapsed = perf_counter() - start
+        print("{0}: {1} records, {2} text lines, errors {3}, {4:.1f}us per record, {5} bytes per record".format(
+            name, decoder.records, decoder.text_lines, decoder.errors, elapsed / max(1, decoder.records) * 1e6,
+            len(frames[0])))
+    print(out[:2], out[2])
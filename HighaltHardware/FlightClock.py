@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# One clock for everything.
+#
+# There are three clocks in a flight, and they don't agree:
+#   - the Arduino's millis(), on every row. It starts over whenever the Arduino is reset (the
+#     ArduinoReader does that every time it connects), and the ceramic resonator it runs on
+#     can be off by a few tenths of a percent, which is seconds an hour.
+#   - the GPS's UTC date and time, when it has a fix.
+#   - the Pi's, both monotonic() (what the bus stamps everything with, in every process) and
+#     the wall clock the data and video file names come from. With no RTC and no network,
+#     the wall clock is wherever it was left at boot, until something sets it (and then it jumps).
+#
+# Flight time is the Pi's monotonic(), in seconds. It never jumps or starts over, and the
+# camera segments, FONA status and everything else on a TelemetryBus are already stamped
+# with it. FlightClock works out the rest from pairs of readings:
+#   millis -> flight time  a LineFit of each row's millis against when it arrived. Each
+#                          reset starts a new epoch (and a new fit): millis going backwards,
+#                          or a row arriving more than RESET_JUMP from where the fit says it
+#                          should, is a reset.
+#   flight time -> UTC     a LineFit of GPS times against when they came in.
+#   wall clock             its offset from monotonic(), and every time that jumps.
+# LineFit is a least squares line through the last few pairs, refitted without the ones too
+# far from it (a row that sat in a buffer, a GPS time from before the fix was any good).
+# Refitting is a pass or two over at most 120 pairs, for each row (a row or two a second).
+#
+# ClockMonitor runs it on the bus: each SensorRecord is published again as a TimedRecord,
+# with its flight time and UTC, and its times are written as the clock stream, so the sensor
+# files (millis), the video (wall clock names) and the logs can be lined up afterwards.
+#
+#####################################################################
+
+import asyncio
+import logging
+from time import monotonic, time
+from datetime import datetime, timezone
+from collections import deque, namedtuple
+from HighaltHardware.HighaltRuntime import Subsystem
+from HighaltHardware.SensorStreams import StreamFiles
+from HighaltHardware.TelemetryBus import TOPIC_SENSOR, TOPIC_GPS, TOPIC_TIMED_SENSOR
+
+# A row this far (seconds) from where the millis fit puts it means the Arduino was reset.
+RESET_JUMP = 5.0
+# The wall clock moving this far (seconds) against monotonic() is a jump, not drift.
+WALL_STEP = 0.5
+
+# A SensorRecord, with when it was taken. utc is POSIX seconds, None until the GPS has said.
+TimedRecord = namedtuple('TimedRecord', ['flight_time', 'utc', 'epoch', 'record'])
+# The clock stream: each record's times. epoch counts the Arduino's resets.
+ClockStamp = namedtuple('ClockStamp', ['epoch', 'millis', 'flight_time', 'utc', 'wall'])
+
+
+def posix_seconds(day, seconds):
+    # A UTC date (anything with year, month and day) and seconds since midnight, as a POSIX time.
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() + seconds
+
+
+def record_utc(record):
+    # The UTC time of a SensorRecord's GPS fix, as POSIX seconds, or None if it has no good one.
+    if not record.has_fix or record.gps_date is None:
+        return None
+    seconds = record.gps_seconds
+    if seconds is None:
+        return None
+    try:
+        day = datetime.strptime(record.gps_date, "%Y/%m/%d")
+    except ValueError:
+        return None
+    return posix_seconds(day, seconds)
+
+
+#################
+# A robust line through recent pairs
+#################
+class LineFit(object):
+    # Residuals further out than this many (robust) standard deviations are left out.
+    OUTLIER_SIGMAS = 3.0
+
+    def __init__(self, window=120, min_points=4, tolerance=0.01, max_drift=0.01, min_span=10.0):
+        """
+        y = y0 + slope * (x - x0), through the last window (x, y) pairs.
+        :param min_points: Below this, the slope is taken as 1 and only the offset is fitted.
+        :param tolerance: Residuals within this (in y units) are never outliers.
+        :param max_drift: How far from 1 the slope can be. Anything past it is the noise talking.
+        :param min_span: Don't fit a slope until the pairs cover this much x.
+        """
+        self.min_points = min_points
+        self.tolerance = tolerance
+        self.max_drift = max_drift
+        self.min_span = min_span
+        self.__points = deque(maxlen=window)
+        self.x0 = None
+        self.y0 = None
+        self.slope = 1.0
+        # From the last fit.
+        self.outliers = 0
+        self.residual = None
+
+    def __len__(self):
+        return len(self.__points)
+
+    def clear(self):
+        self.__points.clear()
+        self.x0 = self.y0 = None
+        self.slope = 1.0
+        self.outliers = 0
+        self.residual = None
+
+    def add(self, x, y):
+        self.__points.append((x, y))
+        self.__fit()
+
+    def predict(self, x):
+        # None until there's something to go on.
+        if self.x0 is None:
+            return None
+        return self.y0 + self.slope * (x - self.x0)
+
+    def inverse(self, y):
+        if self.x0 is None:
+            return None
+        return self.x0 + (y - self.y0) / self.slope
+
+    def __fit(self):
+        points = self.__points
+        keep = points
+        slope, x0, y0 = self.__line(keep)
+        residuals = sorted(abs(y - (y0 + slope * (x - x0))) for x, y in keep)
+        # The median absolute residual, scaled to a standard deviation if they're normal.
+        limit = max(self.OUTLIER_SIGMAS * 1.4826 * residuals[len(residuals) // 2], self.tolerance)
+        if residuals[-1] > limit:
+            keep = [(x, y) for x, y in points if abs(y - (y0 + slope * (x - x0))) <= limit]
+            slope, x0, y0 = self.__line(keep)
+        self.outliers = len(points) - len(keep)
+        self.slope, self.x0, self.y0 = slope, x0, y0
+        self.residual = limit / self.OUTLIER_SIGMAS
+
+    def __line(self, points):
+        # Least squares, around the means (the x and y are big numbers, their differences aren't).
+        n = len(points)
+        mean_x = sum(x for x, _ in points) / n
+        mean_y = sum(y for _, y in points) / n
+        if n < self.min_points or points[-1][0] - points[0][0] < self.min_span:
+            return 1.0, mean_x, mean_y
+        sxx = sum((x - mean_x) ** 2 for x, _ in points)
+        sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+        slope = sxy / sxx if sxx > 0 else 1.0
+        slope = min(max(slope, 1.0 - self.max_drift), 1.0 + self.max_drift)
+        return slope, mean_x, mean_y
+
+
+#################
+# The three clocks
+#################
+class FlightClock(object):
+    def __init__(self):
+        # millis (as seconds) -> flight time, for the current epoch.
+        self.arduino = LineFit(tolerance=0.02)
+        # flight time -> UTC. The Pi's clock and the GPS's barely drift apart.
+        self.gps = LineFit(tolerance=0.05, max_drift=0.001, min_span=60.0)
+        self.epoch = 0
+        self.__last_millis = None
+        self.__last_utc = None
+        # (flight time it started, wall clock minus monotonic()) for each wall clock jump.
+        self.wall_steps = []
+        # Stats
+        self.gps_pairs = 0
+
+    def add_millis(self, millis, received=None):
+        """
+        A row's millis, and when it came in (monotonic(), now if not given).
+        :return: Its flight time.
+        """
+        if received is None:
+            received = monotonic()
+        self.__check_wall(received)
+        seconds = millis / 1000.0
+        predicted = self.arduino.predict(seconds)
+        if self.__last_millis is not None and (millis < self.__last_millis or
+                                               (predicted is not None and abs(received - predicted) > RESET_JUMP)):
+            # The Arduino's been reset. Its millis() mean nothing next to the last epoch's.
+            self.epoch += 1
+            self.arduino.clear()
+            logging.info("Clock: millis() started over (epoch {0}), at {1}ms.".format(self.epoch, int(millis)))
+        self.__last_millis = millis
+        self.arduino.add(seconds, received)
+        return self.arduino.predict(seconds)
+
+    def add_gps(self, flight_time, utc):
+        """
+        A GPS time (POSIX seconds) and the flight time it was good at.
+        """
+        if utc is None or utc == self.__last_utc:
+            # The same fix turns up in more than one row.
+            return
+        self.__last_utc = utc
+        self.gps_pairs += 1
+        self.gps.add(flight_time, utc)
+
+    def flight_time(self, millis):
+        # The flight time of millis in the current epoch, or None if there's no fit yet.
+        return self.arduino.predict(millis / 1000.0)
+
+    def utc(self, flight_time):
+        # POSIX seconds, or None if the GPS hasn't given us the time yet.
+        return self.gps.predict(flight_time)
+
+    def flight_time_at_utc(self, utc):
+        return self.gps.inverse(utc)
+
+    def flight_time_at_wall(self, wall):
+        """
+        The flight time of a wall clock time (the Pi's, like the file names), allowing for the
+        clock having been set. For a time the clock went through twice, the later one.
+        """
+        for started, offset in reversed(self.wall_steps):
+            flight_time = wall - offset
+            if flight_time >= started:
+                return flight_time
+        return wall - self.wall_steps[0][1] if self.wall_steps else None
+
+    @property
+    def wall_error(self):
+        # How far the Pi's wall clock is ahead of UTC, in seconds. None without the GPS time.
+        now = monotonic()
+        utc = self.utc(now)
+        return time() - utc if utc is not None else None
+
+    @property
+    def drift_ppm(self):
+        # How much faster than the Pi the Arduino's clock runs, in parts per million.
+        return (1.0 / self.arduino.slope - 1.0) * 1e6 if self.arduino.x0 is not None else None
+
+    def __check_wall(self, now):
+        offset = time() - now
+        if self.wall_steps and abs(offset - self.wall_steps[-1][1]) <= WALL_STEP:
+            return
+        if self.wall_steps:
+            logging.info("Clock: The Pi's clock jumped {0:+.1f}s.".format(offset - self.wall_steps[-1][1]))
+        self.wall_steps.append((now, offset))
+
+
+#################
+# Running it on the bus
+#################
+class ClockMonitor(Subsystem):
+    name = "Clock"
+    stop_timeout = 2
+
+    def __init__(self, bus, stream_dir=None):
+        """
+        Times each SensorRecord on the bus (as it's published, which is as soon as it's read),
+        and publishes it again as a TimedRecord (TOPIC_TIMED_SENSOR). GPS times come from the
+        records and from TOPIC_GPS.
+        :param stream_dir: Where to write the clock stream, if anywhere.
+        """
+        self.clock = FlightClock()
+        self.latest = None
+        self.__bus = bus
+        self.__files = StreamFiles(stream_dir) if stream_dir else None
+        self.__wake = None
+        bus.listen(TOPIC_SENSOR, self.__on_record)
+        bus.listen(TOPIC_GPS, self.__on_fix)
+
+    def stop(self):
+        if self.__wake:
+            self.__wake.set()
+
+    def __on_record(self, record):
+        if record.millis is None:
+            return
+        clock = self.clock
+        received = monotonic()
+        flight_time = clock.add_millis(record.millis, received)
+        clock.add_gps(flight_time, record_utc(record))
+        utc = clock.utc(flight_time)
+        self.latest = TimedRecord(flight_time, utc, clock.epoch, record)
+        self.__bus.publish(TOPIC_TIMED_SENSOR, self.latest)
+        if self.__files:
+            self.__files.write_row('clock', ClockStamp(clock.epoch, record.millis, round(flight_time, 3),
+                                                       None if utc is None else round(utc, 3),
+                                                       round(flight_time + clock.wall_steps[-1][1], 3)))
+
+    def __on_fix(self, fix):
+        # Published as soon as its sentences are in, so now is when it was good (give or take the GPS's delay).
+        if fix.valid and fix.date is not None and fix.time is not None:
+            self.clock.add_gps(monotonic(), posix_seconds(fix.date, fix.time))
+
+    async def run(self, runtime):
+        # The work's done as the records come in. This is only here to close the files at the end.
+        self.__wake = asyncio.Event()
+        try:
+            await self.__wake.wait()
+        finally:
+            if self.__files:
+                self.__files.close()
+            clock = self.clock
+            logging.info("Clock: {0} epochs, {1} GPS times. Arduino drift {2}ppm, Pi clock off by {3}s.".format(
+                clock.epoch + 1, clock.gps_pairs, _rounded(clock.drift_ppm), _rounded(clock.wall_error, 3)))
+
+    def register_metrics(self, metrics):
+        clock = self.clock
+        metrics.counter("clock_arduino_epochs_total", "Times the Arduino's millis() started over.",
+                        lambda: clock.epoch)
+        metrics.gauge("clock_arduino_drift_ppm", "How much faster the Arduino's clock runs than the Pi's.",
+                      lambda: clock.drift_ppm)
+        metrics.gauge("clock_arduino_residual_seconds", "Spread of row arrival times around the millis fit.",
+                      lambda: clock.arduino.residual)
+        metrics.gauge("clock_arduino_outliers", "Rows left out of the millis fit.", lambda: clock.arduino.outliers)
+        metrics.counter("clock_gps_times_total", "GPS times used to set the UTC fit.", lambda: clock.gps_pairs)
+        metrics.gauge("clock_wall_error_seconds", "How far the Pi's wall clock is ahead of the GPS's UTC.",
+                      lambda: clock.wall_error)
+
+
+def _rounded(value, digits=0):
+    return None if value is None else round(value, digits)
+
+
+if __name__ == "__main__":
+    # An Arduino running 0.3% fast, rows arriving with jitter (and the odd one stuck in a
+    # buffer), a reset half way through, and a GPS that only gets the time after a minute.
+    import random
+    from time import perf_counter
+
+    rng = random.Random(1)
+    clock = FlightClock()
+    worst = 0.0
+    start = perf_counter()
+    rows = 0
+    for epoch, (boot, length) in enumerate(((1000.0, 3600.0), (4610.0, 1800.0))):
+        t = boot
+        while t < boot + length:
+            t += 0.7
+            millis = int((t - boot) * 1003.0)
+            received = t + 0.02 + abs(rng.gauss(0, 0.005)) + (0.5 if rng.random() < 0.01 else 0)
+            flight_time = clock.add_millis(millis, received)
+            if t - boot > 60:
+                clock.add_gps(flight_time, 1.7e9 + t + 0.3 + rng.gauss(0, 0.02))
+            if len(clock.arduino) > 20:
+                worst = max(worst, abs(flight_time - (t + 0.02)))
+            rows += 1
+    elapsed = perf_counter() - start
+    print("{0} rows, {1} epochs, drift {2:.0f}ppm, worst {3:.1f}ms, UTC offset {4:.3f}s, {5:.0f}us per row".format(
+        rows, clock.epoch + 1, clock.drift_ppm, worst * 1000, clock.utc(t) - 1.7e9 - t,
+        elapsed / rows * 1e6))
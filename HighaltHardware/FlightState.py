@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Where the balloon is in its flight.
+#
+# Each SensorRecord goes through a small Kalman filter that fuses the barometer's altitude and
+# the GPS's into one, with the vertical rate. The state is
+#   altitude   metres, GPS (WGS84 ellipsoid-ish, as the GPS reports it)
+#   rate       metres per second, up is positive
+#   baro bias  how far the barometer's altitude is off the GPS's (the weather moves it)
+# The barometer measures altitude + bias, the GPS measures altitude. Between them:
+#   - on the pad and low down, the barometer gives a smooth altitude and rate, and the GPS
+#     keeps it honest;
+#   - above about 11.4 km the MPL3115A2 is at the bottom of its range (20 kPa), so its
+#     readings are ignored and the GPS carries on alone;
+#   - if the GPS stops reporting (many stop at 18 km, and a fix is easy to lose at burst), the
+#     barometer carries on with the last bias.
+# Measurements too far from what the filter expects (more than GATE standard deviations) are
+# thrown away, unless it keeps happening: if a sensor is rejected REJECT_LIMIT times in a row,
+# the filter has most likely lost track (a burst is a big jump in rate) and takes it anyway.
+#
+# The rate and altitude then drive the flight phase:
+#   pad -> ascent     going up faster than ASCENT_RATE for ASCENT_HOLD seconds, and at least
+#                     ASCENT_HEIGHT above where we started
+#   ascent -> burst   coming down faster than BURST_RATE for BURST_HOLD seconds
+#   burst -> descent  BURST_SECONDS later (burst is a moment, not a phase, but it's worth a text)
+#   ascent -> descent coming down slowly for DESCENT_HOLD seconds (a leak, rather than a burst)
+#   descent -> landed barely moving for LANDED_HOLD seconds
+# All of it is a few dozen arithmetic operations per record, whatever the flight's length.
+#
+#####################################################################
+
+import asyncio
+import logging
+from collections import namedtuple
+from HighaltHardware.HighaltRuntime import Subsystem
+from HighaltHardware.SensorStreams import StreamFiles
+from HighaltHardware.TelemetryBus import TOPIC_SENSOR, TOPIC_FLIGHT
+
+PHASE_PAD = "pad"
+PHASE_ASCENT = "ascent"
+PHASE_BURST = "burst"
+PHASE_DESCENT = "descent"
+PHASE_LANDED = "landed"
+# In order. The SMS telemetry sends the index.
+PHASES = (PHASE_PAD, PHASE_ASCENT, PHASE_BURST, PHASE_DESCENT, PHASE_LANDED)
+
+# The MPL3115A2 doesn't measure below 20 kPa (about 11.8 km up), and near there it sticks at
+# the bottom of its range. Below this (Pa, about 11.4 km) its readings are ignored.
+BARO_MIN_PRESSURE = 21000
+# Standard atmosphere, for an altitude from the pressure when the barometer didn't give one.
+SEA_LEVEL_PRESSURE = 101325.0
+
+FlightEstimate = namedtuple('FlightEstimate', ['millis', 'altitude', 'vertical_rate', 'baro_bias', 'altitude_sigma',
+                                               'phase', 'max_altitude'])
+
+
+def pressure_altitude(pressure):
+    # Metres, in the standard atmosphere (the same formula the MPL3115A2 uses).
+    return 44330.77 * (1 - (pressure / SEA_LEVEL_PRESSURE) ** 0.190263)
+
+
+#################
+# The filter
+#################
+class AltitudeFilter(object):
+    # How far a measurement can be from what's expected, in standard deviations.
+    GATE = 5.0
+    # After this many rejections in a row, a sensor's measurement is taken anyway.
+    REJECT_LIMIT = 3
+
+    def __init__(self, accel_noise=0.5, bias_noise=0.01, baro_noise=2.0, gps_noise=6.0):
+        """
+        :param accel_noise: Standard deviation of the vertical acceleration we don't model, m/s^2.
+        :param bias_noise: How fast the barometer's bias can wander, m per root second.
+        :param baro_noise: Standard deviation of the barometer's altitude, m.
+        :param gps_noise: Standard deviation of the GPS's altitude, m.
+        """
+        self.accel_variance = accel_noise ** 2
+        self.bias_variance = bias_noise ** 2
+        self.baro_variance = baro_noise ** 2
+        self.gps_variance = gps_noise ** 2
+        # altitude, rate, baro bias, and their covariance.
+        self.x = None
+        self.p = None
+        self.__rejected_in_a_row = {}
+        # Stats
+        self.updates = {}
+        self.rejections = {}
+
+    @property
+    def ready(self):
+        return self.x is not None
+
+    def start(self, altitude, from_gps):
+        # The first measurement. From the barometer, the bias is unknown until the GPS says.
+        self.x = [altitude, 0.0, 0.0]
+        self.p = [[25.0 if from_gps else 100.0, 0.0, 0.0],
+                  [0.0, 25.0, 0.0],
+                  [0.0, 0.0, 10000.0]]
+
+    def predict(self, dt):
+        if dt <= 0:
+            return
+        x, p = self.x, self.p
+        x[0] += x[1] * dt
+        # P = F P F' + Q, with F = [[1, dt, 0], [0, 1, 0], [0, 0, 1]], written out.
+        p00 = p[0][0] + dt * (p[0][1] + p[1][0]) + dt * dt * p[1][1]
+        p01 = p[0][1] + dt * p[1][1]
+        p02 = p[0][2] + dt * p[1][2]
+        q = self.accel_variance
+        p[0][0] = p00 + q * dt ** 4 / 4
+        p[0][1] = p[1][0] = p01 + q * dt ** 3 / 2
+        p[0][2] = p[2][0] = p02
+        p[1][1] += q * dt * dt
+        p[2][2] += self.bias_variance * dt
+
+    def loosen(self):
+        # After a gap (or an Arduino reset), the rate could be anything by now.
+        self.p[1][1] += 100.0
+
+    def update(self, name, measured, h, variance):
+        """
+        One measurement: measured = h . state, plus noise.
+        :param name: Which sensor, for the stats and rejection counts.
+        :return: Whether it was used.
+        """
+        x, p = self.x, self.p
+        innovation = measured - sum(h[i] * x[i] for i in range(3))
+        ph, s = self.__project(h, variance)
+        if innovation * innovation > self.GATE * self.GATE * s:
+            rejected = self.__rejected_in_a_row.get(name, 0) + 1
+            if rejected < self.REJECT_LIMIT:
+                self.__rejected_in_a_row[name] = rejected
+                self.rejections[name] = self.rejections.get(name, 0) + 1
+                return False
+            # Lost track. Believe the sensor, and don't be so sure about the altitude or rate.
+            self.loosen()
+            p[0][0] += innovation * innovation
+            ph, s = self.__project(h, variance)
+        self.__rejected_in_a_row[name] = 0
+        k = [ph[i] / s for i in range(3)]
+        for i in range(3):
+            x[i] += k[i] * innovation
+        # P = (I - K H) P. ph is P H', and P is symmetric, so H P is ph too.
+        for i in range(3):
+            for j in range(3):
+                p[i][j] -= k[i] * ph[j]
+        self.updates[name] = self.updates.get(name, 0) + 1
+        return True
+
+    def __project(self, h, variance):
+        # P H', and the innovation's variance H P H' + R.
+        p = self.p
+        ph = [p[i][0] * h[0] + p[i][1] * h[1] + p[i][2] * h[2] for i in range(3)]
+        return ph, h[0] * ph[0] + h[1] * ph[1] + h[2] * ph[2] + variance
+
+
+#################
+# The flight phase
+#################
+class FlightPhase(object):
+    ASCENT_RATE = 1.0
+    ASCENT_HOLD = 10
+    ASCENT_HEIGHT = 50
+    BURST_RATE = -4.0
+    BURST_HOLD = 3
+    BURST_SECONDS = 15
+    DESCENT_RATE = -1.0
+    DESCENT_HOLD = 60
+    LANDED_RATE = 0.5
+    LANDED_HOLD = 60
+
+    def __init__(self):
+        self.phase = PHASE_PAD
+        self.pad_altitude = None
+        self.max_altitude = None
+        self.burst_altitude = None
+        # millis when the phase started, and when each condition we're waiting on started holding.
+        self.__entered = None
+        self.__holding = {}
+        # (millis, from, to, altitude) for each change.
+        self.changes = []
+
+    def restart_timers(self):
+        # millis() started over.
+        self.__holding.clear()
+        self.__entered = None
+
+    def update(self, millis, altitude, rate, measured=True):
+        """
+        :param measured: Whether a sensor backed up the altitude. If not (both out of range), it's
+                         only the filter's guess, and doesn't count for the highest altitude.
+        :return: The phase it's changed to, or None if it hasn't.
+        """
+        if self.__entered is None:
+            self.__entered = millis
+        if measured and (self.max_altitude is None or altitude > self.max_altitude):
+            self.max_altitude = altitude
+        phase = self.phase
+        if phase == PHASE_PAD:
+            if self.pad_altitude is None or altitude < self.pad_altitude:
+                self.pad_altitude = altitude
+            if (self.__held('ascent', millis, rate > self.ASCENT_RATE, self.ASCENT_HOLD) and
+                    altitude - self.pad_altitude > self.ASCENT_HEIGHT):
+                return self.__change(millis, PHASE_ASCENT, altitude)
+        elif phase == PHASE_ASCENT:
+            if self.__held('burst', millis, rate < self.BURST_RATE, self.BURST_HOLD):
+                self.burst_altitude = self.max_altitude
+                return self.__change(millis, PHASE_BURST, altitude)
+            if self.__held('descent', millis, rate < self.DESCENT_RATE, self.DESCENT_HOLD):
+                return self.__change(millis, PHASE_DESCENT, altitude)
+        elif phase == PHASE_BURST:
+            if millis - self.__entered >= self.BURST_SECONDS * 1000:
+                return self.__change(millis, PHASE_DESCENT, altitude)
+        elif phase == PHASE_DESCENT:
+            if self.__held('landed', millis, abs(rate) < self.LANDED_RATE, self.LANDED_HOLD):
+                return self.__change(millis, PHASE_LANDED, altitude)
+        return None
+
+    def __held(self, name, millis, condition, seconds):
+        # Whether condition has been true for the last seconds.
+        if not condition:
+            self.__holding.pop(name, None)
+            return False
+        since = self.__holding.setdefault(name, millis)
+        return millis - since >= seconds * 1000
+
+    def __change(self, millis, phase, altitude):
+        self.changes.append((millis, self.phase, phase, altitude))
+        self.phase = phase
+        self.__entered = millis
+        self.__holding.clear()
+        return phase
+
+
+#################
+# Records in, estimates out
+#################
+class FlightEstimator(object):
+    # More than this many seconds between records and the filter doesn't trust its rate.
+    MAX_GAP = 30
+
+    def __init__(self, altitude_filter=None):
+        self.filter = altitude_filter or AltitudeFilter()
+        self.phase = FlightPhase()
+        self.__millis = None
+        self.__gps_time = None
+        self.latest = None
+        # Stats
+        self.records = 0
+        self.baro_out_of_range = 0
+
+    def update(self, record):
+        """
+        :param record: A SensorRecord.
+        :return: The FlightEstimate after it, or None if there's nothing to go on yet.
+        :rtype : FlightEstimate
+        """
+        self.records += 1
+        if record.millis is None:
+            return self.latest
+        baro = self.__baro_altitude(record)
+        gps = None
+        # The same fix can turn up in more than one record. It only counts once.
+        if record.has_fix and record.gps_altitude is not None and record.gps_time != self.__gps_time:
+            gps = record.gps_altitude
+            self.__gps_time = record.gps_time
+        f = self.filter
+        if not f.ready:
+            if gps is None and baro is None:
+                return None
+            f.start(gps if gps is not None else baro, gps is not None)
+        else:
+            dt = (record.millis - self.__millis) / 1000.0
+            if dt < 0 or dt > self.MAX_GAP:
+                # The Arduino was reset, or we've not heard from it in a while.
+                f.loosen()
+                self.phase.restart_timers()
+            else:
+                f.predict(dt)
+        self.__millis = record.millis
+        # The barometer measures altitude + bias, the GPS just the altitude.
+        measured = False
+        if baro is not None:
+            measured |= f.update('baro', baro, (1.0, 0.0, 1.0), f.baro_variance)
+        if gps is not None:
+            measured |= f.update('gps', gps, (1.0, 0.0, 0.0), f.gps_variance)
+        altitude, rate, bias = f.x
+        changed = self.phase.update(record.millis, altitude, rate, measured)
+        if changed:
+            logging.info("Flight: Now {0}, at {1:.0f}m ({2:+.1f}m/s).".format(changed, altitude, rate))
+        self.latest = FlightEstimate(record.millis, altitude, rate, bias, f.p[0][0] ** 0.5, self.phase.phase,
+                                     self.phase.max_altitude)
+        return self.latest
+
+    def __baro_altitude(self, record):
+        if record.pressure is not None:
+            if record.pressure < BARO_MIN_PRESSURE:
+                # Past the bottom of its range. Whatever it says is wrong.
+                self.baro_out_of_range += 1
+                return None
+            if record.baro_altitude is None:
+                return pressure_altitude(record.pressure)
+        return record.baro_altitude
+
+
+#################
+# Running it on the bus
+#################
+class FlightMonitor(Subsystem):
+    name = "Flight"
+    stop_timeout = 2
+
+    def __init__(self, bus, stream_dir=None):
+        """
+        Runs each SensorRecord on the bus through a FlightEstimator, and publishes the estimates
+        (TOPIC_FLIGHT).
+        :param stream_dir: Where to write the estimates (as the flight stream), if anywhere.
+        """
+        self.estimator = FlightEstimator()
+        self.__bus = bus
+        self.__files = StreamFiles(stream_dir) if stream_dir else None
+        self.__wake = None
+        self.__stop = False
+        bus.listen(TOPIC_SENSOR, self.__on_record)
+
+    def stop(self):
+        self.__stop = True
+        if self.__wake:
+            self.__wake.set()
+
+    def __on_record(self, record):
+        estimate = self.estimator.update(record)
+        if estimate is None:
+            return
+        self.__bus.publish(TOPIC_FLIGHT, estimate)
+        if self.__files:
+            self.__files.write_row('flight', estimate)
+
+    async def run(self, runtime):
+        # The work's done as the records come in. This is only here to close the files at the end.
+        self.__stop = False
+        self.__wake = asyncio.Event()
+        try:
+            await self.__wake.wait()
+        finally:
+            if self.__files:
+                self.__files.close()
+            phase = self.estimator.phase
+            logging.info("Flight: {0} records. Phase {1}, highest {2}, burst at {3}. Changes: {4}".format(
+                self.estimator.records, phase.phase, phase.max_altitude, phase.burst_altitude, phase.changes))
+
+    def register_metrics(self, metrics):
+        estimator = self.estimator
+
+        def latest(name):
+            return lambda: getattr(estimator.latest, name) if estimator.latest else None
+        metrics.gauge("flight_altitude_meters", "Filtered altitude.", latest('altitude'))
+        metrics.gauge("flight_vertical_rate", "Filtered vertical rate, m/s.", latest('vertical_rate'))
+        metrics.gauge("flight_baro_bias_meters", "Barometer altitude minus GPS altitude.", latest('baro_bias'))
+        metrics.gauge("flight_phase", "Flight phase: 0 pad, 1 ascent, 2 burst, 3 descent, 4 landed.",
+                      lambda: PHASES.index(estimator.phase.phase))
+        metrics.counter("flight_measurements_total", "Measurements the altitude filter used, by sensor.",
+                        lambda: dict(estimator.filter.updates), label="sensor")
+        metrics.counter("flight_rejections_total", "Measurements the altitude filter threw away, by sensor.",
+                        lambda: dict(estimator.filter.rejections), label="sensor")
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# AT command engine for the FONA (SIM800).
+#
+# Reading the serial port until the read timeout runs out means every command costs at
+# least a second. Instead, the engine reads whatever has arrived, splits it into lines as
+# it goes, and returns as soon as the modem sends a final result code:
+#   OK, ERROR, +CME ERROR: <n>, +CMS ERROR: <n>
+# or, for commands that want more input (AT+CMGS), the '>' prompt.
+#
+# Every command has a timeout (with longer ones for the slow commands) and the round trip
+# time of each one is kept, per command, in a latency histogram. Long responses (a full
+# inbox listing) can be streamed a line at a time instead of collected.
+#
+# Unsolicited result codes (URCs, like +CMTI when a text arrives) can show up in the middle
+# of anything. They're pulled out of the response and handed to a UrcDispatcher instead.
+#
+# Text message listings are the exception: a body line can say anything, OK and RING included.
+# Once a message header has gone by, lines are passed along as they are, and an OK or ERROR
+# only ends the response if nothing else follows it. A URC that turns up after that point ends
+# up in the message text instead of being dispatched, so whoever lists or reads messages has to
+# look for unread ones again afterwards (FonaService sweeps for them).
+#
+#####################################################################
+
+import logging
+from time import perf_counter, monotonic
+from HighaltHardware.HighaltStorage import LatencyHistogram
+
+# Result codes that end a response.
+RESULT_OK = "OK"
+RESULT_ERROR = "ERROR"
+RESULT_PROMPT = ">"
+ERROR_PREFIXES = ("+CME ERROR", "+CMS ERROR")
+
+# Ctrl-Z ends the body of a text message.
+CTRL_Z = "\x1A"
+
+# How long to wait on most commands, in seconds. The SIM800 usually answers within a few
+# hundred milliseconds.
+DEFAULT_TIMEOUT = 2
+# Commands that are known to take longer.
+COMMAND_TIMEOUTS = {"AT+CMGS": 60,
+                    "AT+CMGL": 10,
+                    "AT+CMGD": 25,
+                    "AT+COPS": 10,
+                    "AT+SAPBR": 85,
+                    "AT+HTTPDATA": 15,
+                    "AT+HTTPACTION": 120,
+                    "AT+HTTPREAD": 10,
+                    }
+
+# Unsolicited result codes we know about. +CMT is followed by a line with the message body.
+URC_PREFIXES = ("+CMTI:", "+CMT:", "+CLIP:", "+CDS:", "+CPIN:", "+CFUN:", "+HTTPACTION:")
+# These have to match the whole line, so a text message that happens to start with one
+# isn't mistaken for it.
+URC_LINES = ("RING", "Call Ready", "SMS Ready", "UNDER-VOLTAGE WARNNING", "UNDER-VOLTAGE POWER DOWN",
+             "OVER-VOLTAGE WARNNING", "OVER-VOLTAGE POWER DOWN", "NORMAL POWER DOWN")
+URC_WITH_BODY = ("+CMT:",)
+
+# How long a single read on the port blocks. Short, so we notice the final result code quickly.
+POLL_INTERVAL = 0.05
+
+
+# The command name, without any arguments. Used to look up timeouts and to group latencies.
+# "AT+CMGL=\"ALL\",1" -> "AT+CMGL", "AT+COPS?" -> "AT+COPS"
+def command_name(cmd):
+    name = cmd.strip()
+    for sep in ("=", "?"):
+        name = name.split(sep, 1)[0]
+    return name
+
+
+def is_final_result(line):
+    return line == RESULT_OK or line == RESULT_ERROR or line.startswith(ERROR_PREFIXES)
+
+
+def is_urc(line):
+    return line in URC_LINES or line.startswith(URC_PREFIXES)
+
+
+# Split the parameters of a response line into fields, leaving commas inside quotes alone
+# and taking the quotes off.
+# '+CMTI: "SM",3' -> ['SM', '3']
+def urc_fields(line):
+    params = line.split(":", 1)[1] if ":" in line else ""
+    fields = []
+    current = []
+    quoted = False
+    for c in params.strip():
+        if c == '"':
+            quoted = not quoted
+        elif c == "," and not quoted:
+            fields.append("".join(current))
+            current = []
+        else:
+            current.append(c)
+    fields.append("".join(current))
+    return fields
+
+
+#################
+# Unsolicited result code dispatcher
+#################
+class UrcDispatcher(object):
+    def __init__(self):
+        self.__handlers = {}
+
+    def register(self, prefix, handler):
+        """
+        Call handler(line, body) whenever a URC starting with prefix arrives. body is the line
+        after the URC for the ones that have one (+CMT), otherwise None.
+        Handlers run on whatever thread is using the serial port, so they shouldn't use it themselves.
+        """
+        self.__handlers.setdefault(prefix, []).append(handler)
+
+    def dispatch(self, line, body=None):
+        handled = False
+        for prefix, handlers in self.__handlers.items():
+            if line.startswith(prefix):
+                for handler in handlers:
+                    handled = True
+                    try:
+                        handler(line, body)
+                    except Exception as err:
+                        logging.warning("URC dispatcher: Handler for {0} failed: {1}".format(prefix, err))
+        if not handled:
+            logging.debug("URC dispatcher: Unhandled URC: %s", line)
+
+
+#################
+# Response to a single command
+#################
+class AtResponse(object):
+    def __init__(self, command, lines, result, rtt):
+        self.command = command
+        # Every line we got back, including the echo and the final result code.
+        self.lines = lines
+        # The final result code, or None if the command timed out.
+        self.result = result
+        # Round trip time in seconds.
+        self.rtt = rtt
+
+    @property
+    def ok(self):
+        return self.result == RESULT_OK
+
+    @property
+    def timed_out(self):
+        return self.result is None
+
+    def __repr__(self):
+        return "AtResponse({0!r}, result={1!r}, rtt={2:.3f}s, lines={3!r})".format(self.command,
+                                                                                   self.result,
+                                                                                   self.rtt,
+                                                                                   self.lines)
+
+
+#################
+# The engine itself
+#################
+class AtCommandEngine(object):
+    def __init__(self, serial_connection, terminator="\n", dispatcher=None):
+        """
+        :param serial_connection: An open (or openable) serial.Serial talking to the FONA.
+        :param terminator: What to put at the end of each command.
+        :param dispatcher: UrcDispatcher to hand unsolicited result codes to.
+        """
+        self.__port = serial_connection
+        self.__terminator = terminator
+        self.__buffer = bytearray()
+        self.dispatcher = dispatcher if dispatcher is not None else UrcDispatcher()
+        # A URC that's still waiting on its body line.
+        self.__pending_urc = None
+        # prefix -> the URC line once it's arrived (None until then). See expect_urc.
+        self.__expected = {}
+        # Round trip times, one histogram per command name.
+        self.latency = {}
+        # monotonic() time the modem last answered a command.
+        self.last_response = None
+
+    def execute(self, cmd, timeout=None, expect_prompt=False, message_header=None):
+        """
+        Send a command and wait for its final result code.
+        :param cmd: The command, without a terminator.
+        :param timeout: Seconds to wait. Defaults to the command's entry in COMMAND_TIMEOUTS.
+        :param expect_prompt: Also finish on a prompt. True means the '>' prompt (AT+CMGS),
+                              a string means a line that says exactly that ("DOWNLOAD" for AT+HTTPDATA).
+        :param message_header: For AT+CMGL/AT+CMGR, tells whether a line is a message header. The
+                               lines after one are message text, blank ones included, not URCs.
+        :rtype : AtResponse
+        """
+        name = command_name(cmd)
+        if timeout is None:
+            timeout = COMMAND_TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+        start = perf_counter()
+        self.__write(cmd + self.__terminator)
+        return self.__finish(name, cmd, start, timeout, expect_prompt, message_header)
+
+    def stream(self, cmd, timeout=None, message_header=None):
+        """
+        Send a command and yield the lines of its response as they arrive, instead of collecting
+        them all first. The final result code isn't yielded: the generator returns an AtResponse
+        (with no lines) for "yield from" to pick up. Read it to the end before sending anything else.
+        :param message_header: As for execute.
+        """
+        name = command_name(cmd)
+        if timeout is None:
+            timeout = COMMAND_TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+        start = perf_counter()
+        self.__write(cmd + self.__terminator)
+        result = None
+        # A message can have OK in it, so only the last line can be the final result. Stay a line behind.
+        last = None
+        for line in self.__response_lines(start + timeout, False, message_header):
+            if last is not None:
+                yield last
+            last = line
+        if last is not None and is_final_result(last):
+            result = last.split(":", 1)[0]
+        elif last is not None:
+            yield last
+        return AtResponse(cmd, [], result, self.__record(name, start, timeout, result))
+
+    def send_payload(self, payload, timeout=None, name="AT+CMGS"):
+        """
+        Send the body that follows a '>' prompt, ended with Ctrl-Z, and wait for the result.
+        :rtype : AtResponse
+        """
+        return self.send_data((payload + CTRL_Z).encode("ascii"), timeout, name)
+
+    def send_data(self, data, timeout=None, name="AT+HTTPDATA"):
+        """
+        Send raw bytes after a prompt (e.g. DOWNLOAD) and wait for the result.
+        :rtype : AtResponse
+        """
+        if timeout is None:
+            timeout = COMMAND_TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+        start = perf_counter()
+        self.__discard_pending()
+        self.__port.write(data)
+        return self.__finish(name, "<{0} bytes>".format(len(data)), start, timeout, False)
+
+    def expect_urc(self, prefix):
+        """
+        Hold on to the next URC starting with prefix for wait_for_urc, instead of dispatching it.
+        Call this before sending the command, as the URC can arrive along with its OK.
+        """
+        self.__expected[prefix] = None
+
+    def forget_urc(self, prefix):
+        # Stop holding on to a URC we've given up on. If it turns up now it's dispatched as usual.
+        self.__expected.pop(prefix, None)
+
+    def wait_for_urc(self, prefix, timeout, keep_waiting=False):
+        """
+        Wait for a particular URC (like +HTTPACTION after AT+HTTPACTION). Other URCs that turn up
+        meanwhile are dispatched as usual.
+        :param keep_waiting: If it doesn't arrive in time, keep holding on to it for a later call
+                             (until forget_urc), so it can be checked for a little at a time.
+        :return: The URC line, or None if it didn't arrive in time.
+        """
+        if prefix not in self.__expected:
+            self.expect_urc(prefix)
+        deadline = perf_counter() + timeout
+        self.__port.timeout = POLL_INTERVAL
+        while True:
+            # Lines left over from the last command's response come first.
+            for line in self.__take_lines():
+                if not self.__route_urc(line):
+                    logging.debug("AT engine: Discarding unclaimed line: %s", line)
+            if self.__expected[prefix] is not None:
+                return self.__expected.pop(prefix)
+            if perf_counter() >= deadline:
+                break
+            waiting = self.__port.in_waiting
+            self.__buffer.extend(self.__port.read(waiting if waiting else 1))
+        if keep_waiting:
+            return None
+        del self.__expected[prefix]
+        logging.warning("AT engine: No {0} after {1}s.".format(prefix, timeout))
+        return None
+
+    def poll(self):
+        """
+        Read whatever has arrived without a command and dispatch any URCs in it.
+        :return: The number of URC lines handled.
+        """
+        dispatched = 0
+        self.__port.timeout = POLL_INTERVAL
+        waiting = self.__port.in_waiting
+        while waiting:
+            self.__buffer.extend(self.__port.read(waiting))
+            for line in self.__take_lines():
+                if self.__route_urc(line):
+                    dispatched += 1
+                else:
+                    logging.debug("AT engine: Discarding unclaimed line: %s", line)
+            waiting = self.__port.in_waiting
+        return dispatched
+
+    def __write(self, text):
+        # Anything left over in the buffer belongs to an earlier command (or arrived on its own).
+        # Don't let it be mistaken for the answer to this one, but don't lose any URCs either.
+        self.__discard_pending()
+        self.__port.write(text.encode("ascii"))
+
+    def __discard_pending(self):
+        for line in self.__take_lines():
+            if not self.__route_urc(line):
+                logging.debug("AT engine: Discarding unclaimed line: %s", line)
+        if self.__buffer:
+            logging.debug("AT engine: Discarding unclaimed input: %s", bytes(self.__buffer))
+            self.__buffer.clear()
+
+    # Pull out every complete, non-blank line in the buffer (blank ones too with keep_blank).
+    def __take_lines(self, keep_blank=False):
+        while True:
+            end = self.__buffer.find(b"\n")
+            if end < 0:
+                return
+            line = self.__buffer[:end].decode("ascii", errors="replace").strip("\r")
+            del self.__buffer[:end + 1]
+            if line or keep_blank:
+                yield line
+
+    # If the line is (or finishes) a URC, dispatch it and return True.
+    def __route_urc(self, line):
+        if self.__pending_urc is not None:
+            urc, self.__pending_urc = self.__pending_urc, None
+            self.dispatcher.dispatch(urc, line)
+            return True
+        if not is_urc(line):
+            return False
+        for prefix, caught in self.__expected.items():
+            if caught is None and line.startswith(prefix):
+                self.__expected[prefix] = line
+                return True
+        if line.startswith(URC_WITH_BODY):
+            self.__pending_urc = line
+        else:
+            self.dispatcher.dispatch(line)
+        return True
+
+    def __finish(self, name, cmd, start, timeout, expect_prompt, message_header=None):
+        lines = list(self.__response_lines(start + timeout, expect_prompt, message_header))
+        result = None
+        if lines and is_final_result(lines[-1]):
+            result = lines[-1].split(":", 1)[0]
+        elif lines and expect_prompt and lines[-1] == (RESULT_PROMPT if expect_prompt is True else expect_prompt):
+            result = lines[-1]
+        return AtResponse(cmd, lines, result, self.__record(name, start, timeout, result))
+
+    def __record(self, name, start, timeout, result):
+        rtt = perf_counter() - start
+        self.latency.setdefault(name, LatencyHistogram()).record(rtt)
+        if result is None:
+            logging.warning("AT engine: {0} timed out after {1}s.".format(name, timeout))
+        else:
+            self.last_response = monotonic()
+        return rtt
+
+    # Yield the lines of a response as they arrive, up to and including the final result (or prompt).
+    def __response_lines(self, deadline, expect_prompt, message_header=None):
+        self.__port.timeout = POLL_INTERVAL
+        in_message = False
+        # An OK or ERROR in the middle of a message, and any blank lines after it. Whatever comes
+        # next decides whether it was the text or the end of the response.
+        held = []
+        while True:
+            # Go through every complete line we have so far.
+            for line in self.__take_lines(keep_blank=message_header is not None):
+                if in_message:
+                    if held and not line:
+                        held.append(line)
+                        continue
+                    if held and len(held) > 1 and is_urc(line):
+                        # The modem puts a blank line in front of a URC, so that was the end after all.
+                        self.__route_urc(line)
+                        yield held[0]
+                        return
+                    # More of the listing: it was part of the message.
+                    yield from held
+                    held = []
+                    if is_final_result(line):
+                        held.append(line)
+                    else:
+                        yield line
+                    continue
+                if not line or self.__route_urc(line):
+                    continue
+                yield line
+                if message_header is not None and message_header(line):
+                    in_message = True
+                    continue
+                if is_final_result(line):
+                    return
+                if expect_prompt and expect_prompt is not True and line == expect_prompt:
+                    return
+            # The '>' prompt doesn't come with a newline after it.
+            if expect_prompt is True and self.__buffer.strip().startswith(b">"):
+                self.__buffer.clear()
+                yield RESULT_PROMPT
+                return
+            if perf_counter() >= deadline:
+                if held:
+                    yield held[0]
+                return
+            waiting = self.__port.in_waiting
+            data = self.__port.read(waiting if waiting else 1)
+            if held and not data and not self.__buffer:
+                # Nothing else is coming, so it was the final result.
+                yield held[0]
+                return
+            self.__buffer.extend(data)
+
+    def log_latency(self):
+        for name in sorted(self.latency):
+            logging.info("AT engine: {0} round trip: {1}".format(name, self.latency[name]))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Asyncio driver for the FONA.
+#
+# Only one task ever talks to the serial port. Everything else (ring events, keep-alives,
+# text messages, status queries) submits a command to a priority queue and awaits the
+# result. Since the serial calls themselves block, the owning task runs them one at a time
+# on a single worker thread, which keeps the event loop free to accept more requests while
+# one is in flight.
+#
+#####################################################################
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+# Lower numbers go first.
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BACKGROUND = 10
+
+
+class AsyncFona(object):
+    def __init__(self, fona, idle_poll=None):
+        """
+        :param fona: The Fona object to drive. Nothing else should use it once the driver is running.
+        :param idle_poll: If set, check for unsolicited result codes after this many idle seconds.
+        """
+        self.__fona = fona
+        self.__idle_poll = idle_poll
+        self.__queue = None
+        self.__loop = None
+        # Keeps commands with the same priority in the order they were submitted.
+        self.__sequence = count()
+        # The one thread the serial port is used from. Started by run().
+        self.__executor = None
+        self.__stop = False
+
+    @property
+    def fona(self):
+        return self.__fona
+
+    @property
+    def queue_depth(self):
+        return self.__queue.qsize() if self.__queue else 0
+
+    async def submit(self, func, *args, priority=PRIORITY_NORMAL):
+        """
+        Queue up a call that needs the serial port and wait for its result.
+        :param func: Called with args on the serial worker. Usually a Fona method.
+        :param priority: PRIORITY_URGENT, PRIORITY_NORMAL or PRIORITY_BACKGROUND.
+        """
+        self.__bind()
+        future = self.__loop.create_future()
+        self.__queue.put_nowait((priority, next(self.__sequence), func, args, future))
+        return await future
+
+    # The queue belongs to whichever loop gets to it first, the owner task or a caller. Callers
+    # can queue commands before run() has had a chance to start.
+    def __bind(self):
+        if self.__queue is None:
+            self.__loop = asyncio.get_running_loop()
+            self.__queue = asyncio.PriorityQueue()
+
+    def submit_threadsafe(self, func, *args, priority=PRIORITY_NORMAL):
+        """
+        Same as submit, but for use from other threads (like GPIO callbacks).
+        :rtype : concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(self.submit(func, *args, priority=priority), self.__loop)
+
+    # Shortcuts for the things we do all the time.
+    async def keep_alive(self, priority=PRIORITY_BACKGROUND):
+        return await self.submit(self.__fona.keep_alive, priority=priority)
+
+    async def get_messages(self, include_read=False, leave_unread=False, priority=PRIORITY_NORMAL, on_message=None):
+        # on_message is called on the serial thread, as each message is parsed.
+        return await self.submit(self.__fona.get_current_text_messages, include_read, leave_unread, on_message,
+                                 priority=priority)
+
+    async def send_text_message(self, destination_number, message, priority=PRIORITY_NORMAL):
+        return await self.submit(self.__fona.send_text_message, destination_number, message,
+                                 priority=priority)
+
+    async def status(self, name, priority=PRIORITY_BACKGROUND):
+        return await self.submit(getattr, self.__fona, name, priority=priority)
+
+    async def refresh_status(self, interval=5):
+        """
+        Keep the Fona's status cache fresh. Refreshes go in at background priority, so they
+        never hold up text messages.
+        """
+        while not self.__stop:
+            for name in self.__fona.stale_status() if self.__fona.connected else []:
+                try:
+                    await self.submit(self.__fona.refresh_status, name, priority=PRIORITY_BACKGROUND)
+                except Exception as err:
+                    logging.warning("FONA driver: Refreshing {0} failed: {1}".format(name, err))
+            await asyncio.sleep(interval)
+
+    def reset(self):
+        # Let a stopped driver run again (when its owner is restarted).
+        self.__stop = False
+
+    def stop(self):
+        self.__stop = True
+        if self.__loop and self.__queue is not None:
+            # Wake the owner up so it notices.
+            self.__loop.call_soon_threadsafe(self.__queue.put_nowait,
+                                             (PRIORITY_URGENT, -1, None, (), None))
+
+    async def run(self):
+        logging.debug("FONA driver: Starting.")
+        self.__bind()
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            while not self.__stop:
+                try:
+                    priority, _, func, args, future = await asyncio.wait_for(self.__queue.get(),
+                                                                             self.__idle_poll)
+                except asyncio.TimeoutError:
+                    # Nothing to do, so see if the FONA has told us anything.
+                    try:
+                        await self.__loop.run_in_executor(self.__executor, self.__fona.poll_unsolicited)
+                    except Exception as err:
+                        logging.warning("FONA driver: Polling for URCs failed: {0}".format(err))
+                    continue
+                if func is None or future.cancelled():
+                    continue
+                try:
+                    result = await self.__loop.run_in_executor(self.__executor, func, *args)
+                except Exception as err:
+                    if not future.cancelled():
+                        future.set_exception(err)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+        finally:
+            # Anyone still waiting isn't going to get an answer.
+            while not self.__queue.empty():
+                _, _, func, _, future = self.__queue.get_nowait()
+                if future and not future.done():
+                    future.cancel()
+            # Don't wait for a job that's still on the worker: it could be an HTTP post with minutes
+            # left to go, and waiting here would hold up the whole loop, everyone else's shutdown too.
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            logging.debug("FONA driver: Stopped.")
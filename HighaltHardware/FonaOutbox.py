@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Outbound text message queue for the FONA.
+#
+# Replies are queued instead of being sent straight away, which lets us:
+#   - Drop a reply if the same text is already waiting to go to the same number.
+#   - Replace a waiting position report with a newer one, so nobody gets stale coordinates.
+#   - Retry failed sends, backing off a bit more each time.
+#   - Keep to a send rate the network (and our budget) is happy with.
+#
+# How long messages wait in the queue, and how many get sent, fail or are coalesced, are
+# kept as stats.
+#
+#####################################################################
+
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic
+from HighaltHardware.HighaltStorage import LatencyHistogram
+from HighaltHardware.FonaDriver import PRIORITY_NORMAL
+
+# Kind of message for position reports. Only the newest one for each number is kept.
+KIND_POSITION = "position"
+
+
+#################
+# A message waiting to be sent
+#################
+class OutboundMessage(object):
+    def __init__(self, number, text, kind=None):
+        self.number = number
+        self.text = text
+        self.kind = kind
+        self.queued_at = monotonic()
+        self.attempts = 0
+        # Don't try to send before this (used for backing off after a failure).
+        self.not_before = self.queued_at
+
+    @property
+    def key(self):
+        # Messages with the same key are coalesced. A kind replaces the older text, otherwise
+        # only identical texts are merged.
+        return self.number, self.kind if self.kind else self.text
+
+
+#################
+# The queue
+#################
+class SmsOutbox(object):
+    def __init__(self, driver, max_per_minute=6, burst=3, max_attempts=4, retry_delay=5):
+        """
+        :param driver: AsyncFona to send through.
+        :param max_per_minute: Long term send rate limit.
+        :param burst: How many can go out back to back before the rate limit kicks in.
+        :param max_attempts: Give up on a message after this many failed sends.
+        :param retry_delay: Seconds to wait before the first retry. Doubles each time after that.
+        """
+        self.__driver = driver
+        self.__interval = 60.0 / max_per_minute
+        self.__burst = burst
+        self.__tokens = float(burst)
+        self.__last_refill = monotonic()
+        self.__max_attempts = max_attempts
+        self.__retry_delay = retry_delay
+        self.__pending = OrderedDict()
+        self.__wake = asyncio.Event()
+        self.__stop = False
+        # Stats
+        self.queue_latency = LatencyHistogram((1, 5, 10, 30, 60, 120, 300, 600))
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.coalesced = 0
+
+    @property
+    def depth(self):
+        return len(self.__pending)
+
+    def enqueue(self, number, text, kind=None):
+        """
+        Queue a message. Has to be called from the event loop's thread.
+        :param kind: KIND_POSITION (or any other kind) to replace an older message of the same
+                     kind to the same number instead of sending both.
+        """
+        msg = OutboundMessage(number, text, kind)
+        waiting = self.__pending.get(msg.key)
+        if waiting is not None:
+            # Keep its place in line (and its queue time), but send the newest text.
+            logging.debug("SMS outbox: Coalescing message to {0}.".format(number))
+            waiting.text = text
+            self.coalesced += 1
+        else:
+            self.__pending[msg.key] = msg
+        self.__wake.set()
+
+    def stop(self):
+        self.__stop = True
+        self.__wake.set()
+
+    def __refill(self):
+        now = monotonic()
+        self.__tokens = min(self.__burst, self.__tokens + (now - self.__last_refill) / self.__interval)
+        self.__last_refill = now
+
+    # The first message that's allowed to go now, and how long until the next one is.
+    def __next_ready(self):
+        now = monotonic()
+        wait = None
+        for msg in self.__pending.values():
+            if msg.not_before <= now:
+                return msg, 0
+            if wait is None or msg.not_before - now < wait:
+                wait = msg.not_before - now
+        return None, wait
+
+    async def __send(self, msg):
+        msg.attempts += 1
+        try:
+            result = await self.__driver.send_text_message(msg.number, msg.text, priority=PRIORITY_NORMAL)
+        except Exception as err:
+            logging.warning("SMS outbox: Send to {0} raised: {1}".format(msg.number, err))
+            result = None
+        # The FONA finishes a good send with OK.
+        return bool(result) and "OK" in result
+
+    async def run(self):
+        logging.debug("SMS outbox: Starting.")
+        while not self.__stop:
+            msg, wait = self.__next_ready()
+            if msg is None:
+                self.__wake.clear()
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Rate limit.
+            self.__refill()
+            if self.__tokens < 1:
+                await asyncio.sleep((1 - self.__tokens) * self.__interval)
+                continue
+            self.__tokens -= 1
+
+            # Take it out while it's being sent, so anything queued meanwhile is a new message.
+            del self.__pending[msg.key]
+            if await self.__send(msg):
+                self.sent += 1
+                self.queue_latency.record(monotonic() - msg.queued_at)
+                logging.info("SMS outbox: Sent to {0} after {1} attempt(s).".format(msg.number, msg.attempts))
+            elif msg.attempts < self.__max_attempts:
+                self.retries += 1
+                msg.not_before = monotonic() + self.__retry_delay * 2 ** (msg.attempts - 1)
+                logging.warning("SMS outbox: Send to {0} failed. Retrying.".format(msg.number))
+                # A newer one may have been queued while we were trying. If so, it wins.
+                self.__pending.setdefault(msg.key, msg)
+            else:
+                self.failed += 1
+                logging.warning("SMS outbox: Giving up on message to {0}.".format(msg.number))
+        logging.debug("SMS outbox: Stopped.")
+
+    def log_stats(self):
+        logging.info("SMS outbox: depth={0} sent={1} failed={2} retries={3} coalesced={4} "
+                     "queue latency: {5}".format(self.depth, self.sent, self.failed, self.retries,
+                                                 self.coalesced, self.queue_latency))
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# A pretend FONA (SIM800) on a pseudo-terminal.
+#
+# Lets the FONA driver run, and be benchmarked or soak tested, on any Linux machine
+# without a real modem. Point Fona (or FonaThread) at simulator.port_name and it behaves
+# like /dev/ttyAMA0 with a SIM800 on the other end.
+#
+# Supports the AT subset the driver uses:
+#   AT, ATI, ATE0/1, AT+CMGF, AT+CNMI, AT+CFGRI, AT+CLTS, AT+CMEE, AT+CSCS, AT+CMGL, AT+CMGR,
+#   AT+CMGS, AT+CMGD, AT+CSQ, AT+CBC, AT+COPS?, AT+CCLK?, AT+CCID, AT&V
+# and, for the GPRS uplink, AT+SAPBR and the AT+HTTP* commands. An HTTP POST really is
+# made, from this machine, to whatever URL was set (e.g. uplink_receiver.py).
+# New messages are announced with +CMTI and a pulse on the (pretend) RI line, which is
+# just a callback.
+#
+# Responses can be delayed, and errors, dropped responses or GPRS link drops injected at random.
+#
+#####################################################################
+
+import os
+import tty
+import random
+import select
+import logging
+from urllib import request, error
+from datetime import datetime
+from time import monotonic
+from threading import Thread, Timer, Lock
+
+CTRL_Z = b"\x1A"
+ESC = b"\x1B"
+
+
+#################
+# A message in the simulated SIM storage
+#################
+class SimMessage(object):
+    def __init__(self, sender, text, status="REC UNREAD", date=None):
+        self.sender = sender
+        self.text = text
+        self.status = status
+        self.date = date or datetime.now().strftime("%y/%m/%d,%H:%M:%S") + "-28"
+
+
+#################
+# The simulator
+#################
+class FonaSimulator(Thread):
+    def __init__(self, response_delay=0.0, error_rate=0.0, drop_rate=0.0, ri_callback=None,
+                 storage_size=255, seed=None, gprs_drop_rate=0.0):
+        """
+        :param response_delay: Seconds to wait before answering. Either a number, or a dict of
+                               command name (e.g. "AT+CMGS") to seconds, with "default" for the rest.
+        :param error_rate: Chance (0-1) that a command answers ERROR instead.
+        :param drop_rate: Chance (0-1) that a command gets no answer at all.
+        :param ri_callback: Called (with no arguments) whenever the RI line would pulse.
+        :param storage_size: How many messages the SIM can hold.
+        :param seed: Seed for the error injection, so runs can be repeated.
+        :param gprs_drop_rate: Chance (0-1) that the GPRS link drops during an HTTP request.
+        """
+        Thread.__init__(self, daemon=True)
+        self.__delay = response_delay
+        self.__error_rate = error_rate
+        self.__drop_rate = drop_rate
+        self.__gprs_drop_rate = gprs_drop_rate
+        self.__random = random.Random(seed)
+        self.ri_callback = ri_callback
+        self.__storage_size = storage_size
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__slave)
+        self.port_name = os.ttyname(self.__slave)
+        self.__stop = False
+        self.__write_lock = Lock()
+        self.__buffer = bytearray()
+        # Set when we're waiting on the body of a text message.
+        self.__cmgs_number = None
+        self.__echo = True
+        self.__settings = {"AT+CMGF": "0", "AT+CNMI": "2,1,0,0,0", "AT+CFGRI": "0",
+                           "AT+CLTS": "0", "AT+CMEE": "0", "AT+CSCS": '"IRA"'}
+        self.messages = {}
+        # (number, text, monotonic() when sent) for everything the driver has sent.
+        self.sent = []
+        self.__message_reference = 0
+        self.command_count = 0
+        # GPRS/HTTP state.
+        self.bearer_open = False
+        self.__http = None
+        self.__http_remaining = 0
+        self.__http_data = bytearray()
+        self.http_posts = 0
+        # Things the tests can change on the fly.
+        self.rssi = 20
+        self.battery = (0, 85, 4012)
+        self.operator = "Simulated"
+
+    def stop(self):
+        self.__stop = True
+
+    def close(self):
+        self.stop()
+        self.join(1)
+        os.close(self.__master)
+        os.close(self.__slave)
+
+    #################
+    # Things a test can do to the "network"
+    #################
+    def deliver_message(self, sender, text):
+        """
+        A text message arrives: store it, send +CMTI and pulse RI.
+        :return: The storage index it went to, or None if the SIM is full.
+        """
+        index = self.store_message(sender, text)
+        if index is None:
+            return None
+        if self.__settings["AT+CNMI"].split(",")[1:2] == ["1"]:
+            self.__send('\r\n+CMTI: "SM",{0}\r\n'.format(index))
+        self.pulse_ri()
+        return index
+
+    def store_message(self, sender, text, status="REC UNREAD"):
+        # Put a message in storage without telling anyone. Handy for filling the inbox.
+        for index in range(1, self.__storage_size + 1):
+            if index not in self.messages:
+                self.messages[index] = SimMessage(sender, text, status)
+                return index
+        return None
+
+    def pulse_ri(self):
+        if self.ri_callback:
+            # The SIM800 holds RI low for 120 ms on a new message.
+            Timer(0.12, self.ri_callback).start()
+
+    #################
+    # Serial side
+    #################
+    def __send(self, text):
+        with self.__write_lock:
+            os.write(self.__master, text.encode("ascii", errors="replace") if isinstance(text, str) else text)
+
+    def __reply(self, name, lines, result="OK"):
+        delay = self.__delay.get(name, self.__delay.get("default", 0)) if isinstance(self.__delay, dict) \
+            else self.__delay
+        if self.__random.random() < self.__drop_rate:
+            logging.debug("FONA simulator: Dropping response to {0}.".format(name))
+            return
+        if self.__random.random() < self.__error_rate:
+            lines, result = [], "+CMS ERROR: 500" if name in ("AT+CMGS", "AT+CMGR", "AT+CMGL") else "ERROR"
+        # Like the SIM800: the lines of the response as one block, then the result on its own.
+        out = ("\r\n" + "\r\n".join(lines) + "\r\n" if lines else "") + "\r\n" + result + "\r\n"
+        if delay:
+            Timer(delay, self.__send, (out,)).start()
+        else:
+            self.__send(out)
+
+    def run(self):
+        logging.debug("FONA simulator: Listening on {0}.".format(self.port_name))
+        while not self.__stop:
+            ready, _, _ = select.select([self.__master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.__master, 4096)
+            except OSError:
+                break
+            self.__buffer.extend(data)
+            self.__process()
+
+    def __process(self):
+        while self.__buffer:
+            if self.__http_remaining:
+                # Raw data after DOWNLOAD. Not echoed.
+                take = self.__buffer[:self.__http_remaining]
+                del self.__buffer[:len(take)]
+                self.__http_data.extend(take)
+                self.__http_remaining -= len(take)
+                if not self.__http_remaining:
+                    self.__reply("AT+HTTPDATA", [])
+                continue
+            if self.__cmgs_number is not None:
+                # Collecting the body of a text message.
+                end = min((i for i in (self.__buffer.find(CTRL_Z), self.__buffer.find(ESC)) if i >= 0),
+                          default=-1)
+                if end < 0:
+                    return
+                body = bytes(self.__buffer[:end]).decode("ascii", errors="replace")
+                cancelled = self.__buffer[end:end + 1] == ESC
+                del self.__buffer[:end + 1]
+                if self.__echo:
+                    self.__send(body)
+                number, self.__cmgs_number = self.__cmgs_number, None
+                if cancelled:
+                    self.__reply("AT+CMGS", [])
+                    continue
+                self.__message_reference = (self.__message_reference + 1) % 256
+                self.sent.append((number, body, monotonic()))
+                self.__reply("AT+CMGS", ["+CMGS: {0}".format(self.__message_reference)])
+                continue
+
+            ends = [i for i in (self.__buffer.find(b"\r"), self.__buffer.find(b"\n")) if i >= 0]
+            if not ends:
+                return
+            end = min(ends)
+            line = bytes(self.__buffer[:end]).decode("ascii", errors="replace").strip()
+            if self.__echo:
+                self.__send(bytes(self.__buffer[:end + 1]))
+            del self.__buffer[:end + 1]
+            if line:
+                self.__command(line)
+
+    def __command(self, line):
+        self.command_count += 1
+        upper = line.upper()
+        name = upper.split("=", 1)[0].split("?", 1)[0]
+        args = line.split("=", 1)[1] if "=" in line else ""
+
+        if upper == "AT":
+            self.__reply(name, [])
+        elif upper == "ATI":
+            self.__reply(name, ["SIM800 R13.08 (simulated)"])
+        elif upper in ("ATE0", "ATE1"):
+            self.__echo = upper == "ATE1"
+            self.__reply(name, [])
+        elif upper == "AT+CSQ":
+            self.__reply(name, ["+CSQ: {0},0".format(self.rssi)])
+        elif upper == "AT+CBC":
+            self.__reply(name, ["+CBC: {0},{1},{2}".format(*self.battery)])
+        elif upper == "AT+COPS?":
+            self.__reply(name, ['+COPS: 0,0,"{0}"'.format(self.operator)])
+        elif upper == "AT+CCLK?":
+            self.__reply(name, ['+CCLK: "{0}-28"'.format(datetime.now().strftime("%y/%m/%d,%H:%M:%S"))])
+        elif upper == "AT+CCID":
+            self.__reply(name, ["8901260000000000000"])
+        elif upper == "AT&V":
+            self.__reply(name, ["{0}: {1}".format(k, v) for k, v in sorted(self.__settings.items())])
+        elif name in self.__settings:
+            if upper.endswith("?"):
+                self.__reply(name, ["{0}: {1}".format(name[2:], self.__settings[name])])
+            else:
+                self.__settings[name] = args
+                self.__reply(name, [])
+        elif name == "AT+CMGL":
+            self.__list_messages(args)
+        elif name == "AT+CMGR":
+            self.__read_message(args)
+        elif name == "AT+CMGD":
+            self.__delete_messages(args)
+        elif name == "AT+CMGS":
+            self.__cmgs_number = args.strip('"')
+            self.__send("\r\n> ")
+        elif name == "AT+SAPBR":
+            self.__bearer(args)
+        elif name.startswith("AT+HTTP"):
+            self.__http_command(name, args)
+        else:
+            self.__reply(name, [], "ERROR")
+
+    #################
+    # GPRS and HTTP
+    #################
+    def __bearer(self, args):
+        fields = args.split(",")
+        if fields[0] == "3":
+            self.__reply("AT+SAPBR", [])
+        elif fields[0] == "1":
+            self.bearer_open = True
+            self.__reply("AT+SAPBR", [])
+        elif fields[0] == "0":
+            self.bearer_open = False
+            self.__reply("AT+SAPBR", [])
+        elif fields[0] == "2":
+            state = '1,1,"10.64.0.1"' if self.bearer_open else '1,3,"0.0.0.0"'
+            self.__reply("AT+SAPBR", ["+SAPBR: " + state])
+        else:
+            self.__reply("AT+SAPBR", [], "ERROR")
+
+    def __http_command(self, name, args):
+        if name == "AT+HTTPINIT":
+            if self.__http is not None or not self.bearer_open:
+                self.__reply(name, [], "ERROR")
+                return
+            self.__http = {"params": {}, "status": 0, "body": b""}
+            self.__http_data = bytearray()
+            self.__reply(name, [])
+        elif name == "AT+HTTPTERM":
+            ok = self.__http is not None
+            self.__http = None
+            self.__reply(name, [], "OK" if ok else "ERROR")
+        elif self.__http is None:
+            self.__reply(name, [], "ERROR")
+        elif name == "AT+HTTPPARA":
+            key, _, value = args.partition(",")
+            self.__http["params"][key.strip('"')] = value.strip('"')
+            self.__reply(name, [])
+        elif name == "AT+HTTPDATA":
+            self.__http_data = bytearray()
+            self.__http_remaining = int(args.split(",")[0])
+            self.__send("\r\nDOWNLOAD\r\n")
+        elif name == "AT+HTTPACTION":
+            self.__reply(name, [])
+            # The real thing answers OK straight away and the result comes later as a URC.
+            Thread(target=self.__http_post, daemon=True).start()
+        elif name == "AT+HTTPREAD":
+            body = self.__http["body"]
+            self.__reply(name, ["+HTTPREAD: {0}".format(len(body)), body.decode("ascii", errors="replace")])
+        else:
+            self.__reply(name, [], "ERROR")
+
+    def __http_post(self):
+        session = self.__http
+        status, body = 601, b""
+        if self.bearer_open and self.__random.random() >= self.__gprs_drop_rate:
+            req = request.Request(session["params"].get("URL", ""), data=bytes(self.__http_data),
+                                  headers={"Content-Type": session["params"].get("CONTENT", "")})
+            try:
+                with request.urlopen(req, timeout=30) as response:
+                    status, body = response.status, response.read()
+            except error.HTTPError as err:
+                status, body = err.code, b""
+            except (error.URLError, OSError, ValueError) as err:
+                logging.debug("FONA simulator: POST failed: {0}".format(err))
+                status = 603
+        else:
+            # The link dropped.
+            self.bearer_open = False
+        self.http_posts += 1
+        session["status"], session["body"] = status, body
+        self.__send("\r\n+HTTPACTION: 1,{0},{1}\r\n".format(status, len(body)))
+
+    # With AT+CSCS="UCS2", numbers and bodies go out as hex.
+    def __encode(self, text):
+        if self.__settings["AT+CSCS"].strip('"').upper() == "UCS2":
+            return text.encode("utf-16-be").hex().upper()
+        return text
+
+    def __list_messages(self, args):
+        fields = args.split(",")
+        wanted = fields[0].strip('"') if fields[0] else "REC UNREAD"
+        leave_unread = len(fields) > 1 and fields[1] == "1"
+        lines = []
+        for index in sorted(self.messages):
+            msg = self.messages[index]
+            if wanted != "ALL" and msg.status != wanted:
+                continue
+            lines.append('+CMGL: {0},"{1}","{2}","","{3}"'.format(index, msg.status, self.__encode(msg.sender),
+                                                                  msg.date))
+            lines.append(self.__encode(msg.text))
+            if not leave_unread and msg.status == "REC UNREAD":
+                msg.status = "REC READ"
+        self.__reply("AT+CMGL", lines)
+
+    def __read_message(self, args):
+        fields = args.split(",")
+        try:
+            msg = self.messages.get(int(fields[0]))
+        except ValueError:
+            msg = None
+        if msg is None:
+            # Empty slot: just OK, like the real thing.
+            self.__reply("AT+CMGR", [])
+            return
+        lines = ['+CMGR: "{0}","{1}","","{2}"'.format(msg.status, self.__encode(msg.sender), msg.date),
+                 self.__encode(msg.text)]
+        if not (len(fields) > 1 and fields[1] == "1") and msg.status == "REC UNREAD":
+            msg.status = "REC READ"
+        self.__reply("AT+CMGR", lines)
+
+    def __delete_messages(self, args):
+        fields = args.split(",")
+        try:
+            index = int(fields[0])
+            flag = int(fields[1]) if len(fields) > 1 else 0
+        except ValueError:
+            self.__reply("AT+CMGD", [], "ERROR")
+            return
+        if flag == 4:
+            self.messages.clear()
+        elif flag == 1:
+            for i in [i for i, m in self.messages.items() if m.status == "REC READ"]:
+                del self.messages[i]
+        else:
+            self.messages.pop(index, None)
+        self.__reply("AT+CMGD", [])
+
+
+if __name__ == "__main__":
+    import sys
+    from time import sleep
+
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s:%(message)s',
+                        level=logging.DEBUG)
+    sim = FonaSimulator()
+    sim.start()
+    print("Simulated FONA on {0}. Ctrl-C to stop.".format(sim.port_name))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        sim.close()
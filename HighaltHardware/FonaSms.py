@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Text messages, and parsing them out of AT+CMGL/AT+CMGR responses.
+#
+# A listing is a header line for each message followed by its body:
+#   +CMGL: 1,"REC UNREAD","+14155551234","","16/03/12,10:11:12-28"
+#   Where are you?
+#   +CMGL: 2,"REC READ","+14155550000","","16/03/12,10:15:40-28"
+#   First line
+#   second line
+#   OK
+# Bodies can run over several lines, and quoted fields can have commas in them, so we can't
+# just take the lines two at a time. SmsParser is a small state machine instead: feed it the
+# lines as they come off the serial port and it hands back each message as soon as the next
+# header (or the end of the response) shows where its body ends.
+#
+# A body can also be a line that says OK, ERROR or RING, so the parser never treats those as
+# anything but text. Working out where the response really ends is the AT engine's job: pass
+# is_message_header to it, and leave the final result code off the lines handed in here.
+#
+# With the character set at UCS2 (AT+CSCS="UCS2"), the number and body come as hex, four
+# digits per character. They're decoded here.
+#
+#####################################################################
+
+import re
+import logging
+from HighaltHardware.FonaATCommands import urc_fields
+
+# A header has to look like this to count, so a body line that happens to start with
+# "+CMGL:" isn't taken for one.
+_header_patterns = {"+CMGL:": re.compile(r'^\+CMGL: \d+,"[A-Z ]+",'),
+                    "+CMGR:": re.compile(r'^\+CMGR: "[A-Z ]+",'),
+                    "+CMT:": re.compile(r'^\+CMT: "'),
+                    }
+_hex_digits = set("0123456789ABCDEFabcdef")
+
+
+def decode_ucs2(text):
+    """
+    "00480069" -> "Hi". Raises ValueError if it isn't UCS2 hex.
+    """
+    if len(text) % 4 or not set(text) <= _hex_digits:
+        raise ValueError("Not UCS2 hex: {0}".format(text))
+    return bytes.fromhex(text).decode("utf-16-be", errors="replace")
+
+
+def is_message_header(line):
+    for prefix, pattern in _header_patterns.items():
+        if line.startswith(prefix):
+            return pattern.match(line) is not None
+    return False
+
+
+#################
+# Text message object
+#################
+class FonaMessage(object):
+    def __init__(self, raw_text_message, message_number=None):
+        """
+        :param raw_text_message: The header line, then the body line(s).
+        :param message_number: Storage index, if the header doesn't have it (+CMGR).
+        Raises ValueError if the header can't be made sense of.
+        """
+        self.__msg_number = message_number
+        self.__sender_number = None
+        self.__msg_date = None
+        self.__text_message = None
+        self.__parse(raw_text_message)
+
+    def __parse(self, raw_text_message):
+        # Headers are a comma seperated list, and depend on where the message came from:
+        #   +CMGL: <index>,<stat>,<sender>,<alpha>,<date>
+        #   +CMGR: <stat>,<sender>,<alpha>,<date>
+        #   +CMT: <sender>,<alpha>,<date>
+        logging.debug("Raw message: %s", raw_text_message)
+        if not raw_text_message:
+            raise ValueError("Empty message.")
+        headers = urc_fields(raw_text_message[0])
+        logging.debug("Headers: %s", headers)
+        if raw_text_message[0].startswith("+CMGL"):
+            self.__msg_number = headers[0]
+            headers = headers[2:]
+        elif raw_text_message[0].startswith("+CMGR"):
+            headers = headers[1:]
+        if len(headers) < 3:
+            raise ValueError("Can't parse message header: {0}".format(raw_text_message[0]))
+        # Get rid of the + at the front.
+        self.__sender_number = headers[0].replace("+", "")
+        # Date and time come as one field. Space them out a bit.
+        self.__msg_date = headers[2].replace(",", ", ")
+        # The rest is the message, however many lines it takes.
+        self.__text_message = "\n".join(raw_text_message[1:])
+
+    def __str__(self):
+        return "Message Number: {0}\r\nSender: {1}\r\nDate: {2}\r\nMessage: {3}\r\n".format(self.__msg_number,
+                                                                                            self.__sender_number,
+                                                                                            self.__msg_date,
+                                                                                            self.__text_message)
+
+    def __repr__(self):
+        return "Message Number: {0}\r\nSender: {1}\r\nDate: {2}\r\nMessage: {3}\r\n".format(self.__msg_number,
+                                                                                            self.__sender_number,
+                                                                                            self.__msg_date,
+                                                                                            self.__text_message)
+
+    @property
+    def sender_number(self):
+        return self.__sender_number
+
+    @property
+    def message_number(self):
+        return self.__msg_number
+
+    @property
+    def message_date(self):
+        return self.__msg_date
+
+    @property
+    def text_message(self):
+        return self.__text_message
+
+
+#################
+# Streaming parser
+#################
+class SmsParser(object):
+    def __init__(self, charset="IRA", message_number=None):
+        """
+        :param charset: The FONA's character set (AT+CSCS). "UCS2" means hex numbers and bodies.
+        :param message_number: Storage index to give a +CMGR message, which doesn't say.
+        """
+        self.__ucs2 = charset.upper() == "UCS2"
+        self.__message_number = message_number
+        # The message we're in the middle of: its header, then body lines.
+        self.__current = None
+        self.parsed = 0
+        self.malformed = 0
+
+    def feed(self, line):
+        """
+        Take the next line of the response.
+        :return: A FonaMessage if this line finished one, otherwise None.
+        """
+        if is_message_header(line):
+            done = self.__complete()
+            self.__current = [line]
+            return done
+        if self.__current is None:
+            # The command echo, or anything else before the first header.
+            logging.debug("SMS parser: Skipping %s", line)
+            return None
+        self.__current.append(line)
+        return None
+
+    def finish(self):
+        """
+        The response ended (or was cut off). Hand back the last message, if there is one.
+        """
+        return self.__complete()
+
+    def parse(self, lines):
+        """
+        Parse a whole response, yielding each message as soon as it's done.
+        """
+        for line in lines:
+            msg = self.feed(line)
+            if msg is not None:
+                yield msg
+        msg = self.finish()
+        if msg is not None:
+            yield msg
+
+    def __complete(self):
+        if self.__current is None:
+            return None
+        raw, self.__current = self.__current, None
+        # The modem puts a blank line before the final result (and sometimes between messages).
+        while len(raw) > 1 and not raw[-1]:
+            raw.pop()
+        try:
+            if self.__ucs2:
+                raw = self.__decode(raw)
+            msg = FonaMessage(raw, message_number=self.__message_number)
+        except ValueError as err:
+            self.malformed += 1
+            logging.warning("SMS parser: Skipping a message: {0}".format(err))
+            return None
+        self.parsed += 1
+        return msg
+
+    # Put the number and the body back into plain text.
+    def __decode(self, raw):
+        header = raw[0]
+        fields = urc_fields(header)
+        position = {"+CMGL": 2, "+CMGR": 1, "+CMT:": 0}[header[:5]]
+        number = fields[position]
+        header = header.replace('"{0}"'.format(number), '"{0}"'.format(decode_ucs2(number)), 1)
+        # A body split over lines was one string of hex to start with.
+        return [header, decode_ucs2("".join(raw[1:]))]
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Cached, parsed FONA status.
+#
+# Asking the FONA for its signal strength or battery state costs a serial round trip, and
+# the serial port is also what the text messages go through. So each status value is kept
+# here with its own time to live. Fona answers attribute lookups from the cache while the
+# value is fresh, and the driver refreshes stale entries in the background at low priority.
+#
+# Values are parsed into named tuples instead of being handed back as raw response lines.
+#
+#####################################################################
+
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from HighaltHardware.FonaATCommands import urc_fields
+
+# How long (in seconds) each status value stays fresh. None means it never goes stale, and
+# 0 means it's never cached. Only the ones with a positive TTL are refreshed in the background.
+STATUS_TTLS = dict(AT=0,
+                   ATI=None,
+                   sim_card_number=None,
+                   network_status=120,
+                   signal_strength=30,
+                   battery_state=60,
+                   network_clock=60,
+                   current_settings=0,
+                   )
+
+# +CSQ: rssi in dBm (None if unknown) and the bit error rate (0-7, None if unknown).
+SignalStrength = namedtuple('SignalStrength', ['rssi_dbm', 'bit_error_rate'])
+# +CBC: charging is 0 (not charging), 1 (charging) or 2 (finished).
+BatteryState = namedtuple('BatteryState', ['charging', 'percent', 'millivolts'])
+# +COPS: registration mode, operator name format and the operator itself.
+NetworkStatus = namedtuple('NetworkStatus', ['mode', 'format', 'operator'])
+
+
+# Find the line that holds the answer, e.g. the "+CSQ: ..." line in ['AT+CSQ', '+CSQ: 20,0', 'OK'].
+def _find_line(lines, prefix):
+    for line in lines:
+        if line.startswith(prefix):
+            return line
+    return None
+
+
+def parse_signal_strength(lines):
+    line = _find_line(lines, "+CSQ:")
+    if line is None:
+        return None
+    rssi, ber = (int(x) for x in urc_fields(line)[:2])
+    # 0 is -115 dBm or less, 31 is -52 dBm or more, 99 is unknown.
+    return SignalStrength(None if rssi == 99 else -113 + 2 * rssi,
+                          None if ber == 99 else ber)
+
+
+def parse_battery_state(lines):
+    line = _find_line(lines, "+CBC:")
+    if line is None:
+        return None
+    return BatteryState(*(int(x) for x in urc_fields(line)[:3]))
+
+
+def parse_network_status(lines):
+    line = _find_line(lines, "+COPS:")
+    if line is None:
+        return None
+    fields = urc_fields(line)
+    # Without a network, we only get the mode back.
+    fields += [None] * (3 - len(fields))
+    return NetworkStatus(int(fields[0]), int(fields[1]) if fields[1] else None, fields[2])
+
+
+def parse_network_clock(lines):
+    line = _find_line(lines, "+CCLK:")
+    if line is None:
+        return None
+    # "yy/MM/dd,hh:mm:ss+zz", where the zone is in quarter hours.
+    stamp = urc_fields(line)[0]
+    offset = int(stamp[17:]) if len(stamp) > 17 else 0
+    when = datetime.strptime(stamp[:17], "%y/%m/%d,%H:%M:%S")
+    return when.replace(tzinfo=timezone(timedelta(minutes=15 * offset)))
+
+
+# Parsers for the values we know how to read. Anything else is kept as the raw lines.
+STATUS_PARSERS = dict(signal_strength=parse_signal_strength,
+                      battery_state=parse_battery_state,
+                      network_status=parse_network_status,
+                      network_clock=parse_network_clock,
+                      )
+
+
+#################
+# The cache itself
+#################
+class StatusCache(object):
+    def __init__(self, ttls=None):
+        self.__ttls = dict(STATUS_TTLS)
+        if ttls:
+            self.__ttls.update(ttls)
+        # name -> (value, time stored). Each entry is replaced whole, so readers on other
+        # threads never see half an update.
+        self.__entries = {}
+        # Called with (name, value) whenever a value is stored.
+        self.__listeners = []
+
+    @property
+    def names(self):
+        return list(self.__ttls)
+
+    def parse(self, name, lines):
+        parser = STATUS_PARSERS.get(name)
+        if parser is None:
+            return lines
+        try:
+            return parser(lines)
+        except (ValueError, IndexError):
+            return None
+
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    def put(self, name, value):
+        self.__entries[name] = (value, monotonic())
+        for listener in self.__listeners:
+            listener(name, value)
+
+    def get(self, name, default=None):
+        # The last value we have, however old it is.
+        entry = self.__entries.get(name)
+        return entry[0] if entry else default
+
+    def age(self, name):
+        entry = self.__entries.get(name)
+        return monotonic() - entry[1] if entry else None
+
+    def is_fresh(self, name):
+        age = self.age(name)
+        if age is None:
+            return False
+        ttl = self.__ttls.get(name)
+        return ttl is None or age < ttl
+
+    def stale(self):
+        # Everything that has a TTL and is due for a refresh.
+        return [name for name, ttl in self.__ttls.items() if ttl and not self.is_fresh(name)]
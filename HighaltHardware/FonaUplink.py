@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Bulk telemetry uplink over the FONA's GPRS connection.
+#
+# A text message only carries one short reply. When there's coverage, this pushes batches
+# of recent SensorRecords to a server instead:
+#   - Records are collected into batches, each with its own sequence number, and
+#     compressed with zlib.
+#   - Batches wait in a spool (optionally on disk) until the server acknowledges them, so
+#     a dropped link (or a restart) just means picking up where we left off.
+#   - Each batch is sent with an HTTP POST through the SIM800's HTTP AT commands. The POST is
+#     queued on the FONA driver a step at a time, at background priority, and the wait for the
+#     server's answer happens here rather than on the serial thread. So a text message waits
+#     for one quick step at most, not for the whole POST.
+#
+# The server answers "ACK <sequence>". uplink_receiver.py is a stand-in server for testing,
+# and FonaSimulator knows enough of the HTTP commands to forward POSTs to it.
+#
+#####################################################################
+
+import os
+import zlib
+import struct
+import asyncio
+import logging
+from collections import deque, OrderedDict
+from time import monotonic
+from HighaltHardware.FonaDriver import PRIORITY_BACKGROUND
+
+# Batch header: magic, version, sequence number, record count.
+BATCH_MAGIC = b"HAUP"
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct(">4sBIH")
+
+# Longest to wait for the server's answer to a POST, in seconds.
+HTTP_ANSWER_TIMEOUT = 60
+# How often to check for it. Each check holds the serial port for at most HTTP_ANSWER_CHECK seconds.
+HTTP_ANSWER_INTERVAL = 0.5
+HTTP_ANSWER_CHECK = 0.2
+
+
+def encode_batch(sequence, records):
+    """
+    Pack records into a compressed batch. Records are written as CSV lines, with blank
+    fields for None, the same as the Arduino sends them.
+    :rtype : bytes
+    """
+    lines = "\n".join(",".join("" if v is None else str(v) for v in record) for record in records)
+    return BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, sequence, len(records)) + \
+        zlib.compress(lines.encode("utf-8"), 9)
+
+
+def decode_batch(payload):
+    """
+    :return: (sequence number, list of CSV lines)
+    """
+    magic, version, sequence, count = BATCH_HEADER.unpack_from(payload)
+    if magic != BATCH_MAGIC or version != BATCH_VERSION:
+        raise ValueError("Not an uplink batch.")
+    text = zlib.decompress(payload[BATCH_HEADER.size:]).decode("utf-8")
+    lines = text.split("\n") if text else []
+    if len(lines) != count:
+        raise ValueError("Batch {0} says {1} records, has {2}.".format(sequence, count, len(lines)))
+    return sequence, lines
+
+
+def parse_ack(body):
+    # "ACK 12" -> 12
+    try:
+        word, sequence = body.split()[:2]
+        return int(sequence) if word == "ACK" else None
+    except (AttributeError, ValueError):
+        return None
+
+
+#################
+# The uplink
+#################
+class TelemetryUplink(object):
+    def __init__(self, driver, url, apn, batch_size=50, max_batch_age=60, spool_dir=None, max_spool=500):
+        """
+        :param driver: AsyncFona to send through.
+        :param url: Where to POST the batches.
+        :param apn: The carrier's GPRS access point name.
+        :param batch_size: Records per batch.
+        :param max_batch_age: Send a partial batch once its oldest record is this many seconds old.
+        :param spool_dir: Keep unacknowledged batches here, so they survive a restart.
+        :param max_spool: Most batches to hold. The oldest are dropped past this.
+        """
+        self.__driver = driver
+        self.__url = url
+        self.__apn = apn
+        self.__batch_size = batch_size
+        self.__max_batch_age = max_batch_age
+        self.__spool_dir = spool_dir
+        self.__max_spool = max_spool
+        # Records waiting to be put in a batch. Appended from the ingest thread.
+        self.__pending = deque()
+        self.__pending_since = None
+        # sequence -> encoded batch, oldest first.
+        self.__spool = OrderedDict()
+        self.__next_sequence = 0
+        self.__retry_delay = 0
+        self.__stop = False
+        self.__wake = None
+        # Stats
+        self.batches_sent = 0
+        self.records_sent = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self.dropped = 0
+        self.send_time = 0.0
+        if self.__spool_dir:
+            self.__load_spool()
+
+    @property
+    def spool_depth(self):
+        return len(self.__spool)
+
+    @property
+    def throughput(self):
+        # Bytes per second while actually sending.
+        return self.bytes_sent / self.send_time if self.send_time else 0.0
+
+    def add_record(self, record):
+        # Safe to call from any thread.
+        if self.__pending_since is None:
+            self.__pending_since = monotonic()
+        self.__pending.append(record)
+
+    def stop(self):
+        self.__stop = True
+        if self.__wake:
+            self.__wake.set()
+
+    #################
+    # Spool
+    #################
+    def __spool_path(self, sequence):
+        return os.path.join(self.__spool_dir, "{0:010d}.bin".format(sequence))
+
+    def __load_spool(self):
+        os.makedirs(self.__spool_dir, exist_ok=True)
+        for name in sorted(os.listdir(self.__spool_dir)):
+            if name.endswith(".bin"):
+                with open(os.path.join(self.__spool_dir, name), "rb") as f:
+                    payload = f.read()
+                sequence = BATCH_HEADER.unpack_from(payload)[2]
+                self.__spool[sequence] = payload
+        sequence_file = os.path.join(self.__spool_dir, "sequence")
+        if os.path.exists(sequence_file):
+            with open(sequence_file) as f:
+                self.__next_sequence = int(f.read().strip() or 0)
+        if self.__spool:
+            self.__next_sequence = max(self.__next_sequence, max(self.__spool) + 1)
+            logging.info("Uplink: Resuming with {0} unsent batches.".format(len(self.__spool)))
+
+    def __make_batch(self):
+        records = []
+        while self.__pending and len(records) < self.__batch_size:
+            records.append(self.__pending.popleft())
+        self.__pending_since = monotonic() if self.__pending else None
+        sequence = self.__next_sequence
+        self.__next_sequence += 1
+        payload = encode_batch(sequence, records)
+        self.__spool[sequence] = payload
+        if self.__spool_dir:
+            with open(self.__spool_path(sequence), "wb") as f:
+                f.write(payload)
+            with open(os.path.join(self.__spool_dir, "sequence"), "w") as f:
+                f.write(str(self.__next_sequence))
+        while len(self.__spool) > self.__max_spool:
+            self.__forget(next(iter(self.__spool)))
+            self.dropped += 1
+
+    def __forget(self, sequence):
+        self.__spool.pop(sequence, None)
+        if self.__spool_dir:
+            try:
+                os.remove(self.__spool_path(sequence))
+            except FileNotFoundError:
+                pass
+
+    def __batch_due(self):
+        if len(self.__pending) >= self.__batch_size:
+            return True
+        return self.__pending_since is not None and monotonic() - self.__pending_since >= self.__max_batch_age
+
+    #################
+    # Sending
+    #################
+    async def __send(self, sequence, payload):
+        fona = self.__driver.fona
+        start = monotonic()
+        try:
+            if not await self.__driver.submit(fona.open_bearer, self.__apn, priority=PRIORITY_BACKGROUND):
+                logging.info("Uplink: No GPRS bearer.")
+                return False
+            status, body = await self.__post(payload)
+        except Exception as err:
+            logging.warning("Uplink: Sending batch {0} raised: {1}".format(sequence, err))
+            return False
+        self.send_time += monotonic() - start
+        acked = parse_ack(body) if status == 200 else None
+        if acked is None:
+            logging.info("Uplink: Batch {0} not acknowledged (HTTP {1}).".format(sequence, status))
+            return False
+        # Everything up to and including the acknowledged one made it.
+        for done in [s for s in self.__spool if s <= acked]:
+            self.__forget(done)
+        self.batches_sent += 1
+        self.bytes_sent += len(payload)
+        self.records_sent += BATCH_HEADER.unpack_from(payload)[3]
+        return True
+
+    # The POST, one driver job per step, so texts can go in between.
+    async def __post(self, payload):
+        fona = self.__driver.fona
+        if not await self.__driver.submit(fona.http_start, self.__url, payload, priority=PRIORITY_BACKGROUND):
+            return 0, None
+        status, body = 0, None
+        cancelled = False
+        try:
+            deadline = monotonic() + HTTP_ANSWER_TIMEOUT
+            answer = None
+            while not self.__stop:
+                answer = await self.__driver.submit(fona.http_result, HTTP_ANSWER_CHECK,
+                                                    priority=PRIORITY_BACKGROUND)
+                if answer is not None or monotonic() >= deadline:
+                    break
+                await asyncio.sleep(HTTP_ANSWER_INTERVAL)
+            if answer is None:
+                logging.info("Uplink: No answer from the server after {0:.0f}s.".format(
+                    HTTP_ANSWER_TIMEOUT - max(0, deadline - monotonic())))
+            else:
+                status, length = answer
+                if length > 0:
+                    body = await self.__driver.submit(fona.http_read, priority=PRIORITY_BACKGROUND)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # If we're being cancelled the driver may be gone too. The next http_start closes the
+            # session instead.
+            if not cancelled:
+                await self.__driver.submit(fona.http_end, priority=PRIORITY_BACKGROUND)
+        return status, body
+
+    async def run(self, interval=10):
+        logging.debug("Uplink: Starting.")
+        self.__wake = asyncio.Event()
+        while not self.__stop:
+            while self.__batch_due():
+                self.__make_batch()
+            while self.__spool and not self.__stop:
+                sequence, payload = next(iter(self.__spool.items()))
+                if await self.__send(sequence, payload):
+                    self.__retry_delay = 0
+                    continue
+                # Link's down (or the server is). Back off, up to five minutes.
+                self.retries += 1
+                self.__retry_delay = min(300, max(interval, self.__retry_delay * 2))
+                break
+            try:
+                await asyncio.wait_for(self.__wake.wait(), self.__retry_delay or interval)
+            except asyncio.TimeoutError:
+                pass
+        logging.debug("Uplink: Stopped.")
+
+    def log_stats(self):
+        logging.info("Uplink: batches={0} records={1} bytes={2} retries={3} dropped={4} spooled={5} "
+                     "throughput={6:.0f} B/s".format(self.batches_sent, self.records_sent, self.bytes_sent,
+                                                     self.retries, self.dropped, self.spool_depth,
+                                                     self.throughput))
@@ -5,122 +5,223 @@
 ##############################
 
 import logging
+import asyncio
 import os
-from time import sleep
-from threading import Thread
+from time import monotonic
 from datetime import datetime
-from serial import Serial, SerialException, SerialTimeoutException, STOPBITS_ONE, EIGHTBITS, PARITY_NONE
+from collections import namedtuple, deque
+from serial import Serial, SerialException, STOPBITS_ONE, EIGHTBITS, PARITY_NONE
+from HighaltHardware.HighaltStorage import SegmentStore
+from HighaltHardware.HighaltRuntime import Subsystem
+from HighaltHardware.TelemetryBus import TOPIC_SENSOR, TOPIC_STREAM, TOPIC_GPS
+from HighaltHardware.ArduinoProtocol import FrameDecoder, NmeaFrame, REQUEST_BINARY, REQUEST_STREAMS, REQUEST_NMEA
+from HighaltHardware.SensorStreams import (StreamAligner, StreamFiles, GpsSample, format_row, STREAM_TYPES,
+                                           STREAM_NAMES, STREAM_OF, STREAM_BARO, STREAM_GPS, MAX_GAP)
+from HighaltHardware.NmeaParser import NmeaParser
 
+# How many lines go into each sensor file, and roughly how long a line gets. Used to
+# preallocate each file.
+LINES_PER_FILE = 100
+BYTES_PER_LINE = 200
 
-# Define our data thread.
-class ArduinoDataThread (Thread):
-    def __init__(self, serial_connection, output_directory, headers):
-        Thread.__init__(self)
-        self.__ser = serial_connection
-        self.__out = output_directory
-        self.headers = headers
-        self.headers_parsed = False
-        # Keep alive, basically.
-        # Have to encode it because the serial stream only takes bytes.
-        self.__keep_alive = "Hello.".encode('ascii')
-        self.last_received_line = None
-        self.__stop = False
-        logging.debug('Data Thread: New logging thread created.')
+# How many parsed records to keep around for things like the SMS replies.
+RECENT_RECORDS = 50
 
-    def stop(self):
-        self.__stop = True
+# The columns the Arduino sends, in order. See run_once_connected() in Logging_v2.ino.
+SENSOR_FIELDS = ['millis',
+                 'gps_date', 'gps_time', 'gps_fix', 'latitude', 'longitude', 'speed', 'angle', 'gps_altitude',
+                 'accel_x', 'accel_y', 'accel_z', 'mag_x', 'mag_y', 'mag_z', 'gyro_x', 'gyro_y', 'gyro_z',
+                 'lsm_temp',
+                 'pressure', 'baro_altitude', 'baro_temp',
+                 'k_temp']
+# These stay as strings, everything else is a number.
+TEXT_FIELDS = ('gps_date', 'gps_time')
+# What sensor stream samples look like (in stream mode).
+STREAM_SAMPLES = tuple(STREAM_TYPES.values())
+# What the sketch sends when the thermocouple read fails.
+BAD_TEMP = -3.14E03
+# The binary protocol sends the GPS date and time as numbers. These go into gps_date and gps_time.
+GPS_TIME_FIELDS = ('gps_year', 'gps_month', 'gps_day', 'gps_hour', 'gps_minute', 'gps_second', 'gps_millis')
+# Blank without a fix, as they are in the text rows.
+FIX_FIELDS = ('latitude', 'longitude', 'speed', 'angle', 'gps_altitude')
+# What a GPS fix fills in.
+GPS_FIELDS = ('gps_date', 'gps_time', 'gps_fix') + FIX_FIELDS
+
+
+#################
+# One parsed line from the Arduino
+#################
+class SensorRecord (namedtuple('SensorRecord', SENSOR_FIELDS)):
+    __slots__ = ()
 
-    def run(self):
+    @classmethod
+    def from_line(cls, line):
+        """
+        Parse a line of sensor data. Blank fields (like the GPS ones without a fix) become None.
+        :return: A SensorRecord, or None if the line isn't sensor data (headers, status messages).
+        """
+        values = line.split(",")
+        if len(values) != len(SENSOR_FIELDS):
+            return None
         try:
-            # If we haven't been told to shut down:
-            while not self.__stop:
-                # Open a file to write data to and write 100 lines.
-                line_count = 0
-                with open(self.gen_filename(), 'wt', encoding='utf-8') as f:
-                    logging.debug('Data Thread: Opened new file for sensor data: {0}'.format(f.name))
-                    while line_count < 100:
-                        # We have to send this to start the data flowing
-                        # Also keep writing to it just to make sure the buffer on the other
-                        # end stays active.
-                        self.__ser.write(self.__keep_alive)
-
-                        # Take the line we read, strip off end characters and convert it from
-                        # a series of bytes into a string.
-                        response = self.__ser.readline().rstrip().decode()
-                        logging.debug(str(line_count) + " : " + response)
-
-                        # In case we haven't already done so, separate out the headers.
-                        # We're going to want them for each file. Maybe.
-                        if not self.headers_parsed and len(response.split(",")) > 1:
-                            logging.debug("Data Thread: Don't have headers, trying to parse.")
-                            self.get_headers(response)
-                            logging.debug(self.headers)
-                            logging.debug("Data Thread: Supposedly we got headers.")
-                            if len(self.headers) > 1:
-                                self.headers_parsed = True
-
-                        # If we just opened a new file and we have headers, print them to the file.
-                        if line_count == 0 and self.headers_parsed:
-                            logging.debug("Data Thread: We have headers, line count is zero. Writing headers to file.")
-                            # Joins the headers using a comma to separate them.
-                            f.write(','.join(str(x) for x in self.headers))
-                            f.write('\n')
-
-                        # Make sure the response actually has data in it
-                        if len(response) > 0:
-                            logging.debug("Data Thread: Writing response to file.")
-                            # Write our response and attach an endline.
-                            self.last_received_line = response
-                            f.write(response)
-                            f.write('\n')
-                            f.flush()
-                            # We wrote another line, increment the counter.
-                            line_count += 1
-
-                        if self.__stop:
-                            break
-        except SerialException or SerialTimeoutException as err:
-            logging.debug("Data Thread: Problem with serial connection. Trying to re-start one.")
-            logging.debug("Error: {0}".format(err.args))
-            logging.debug("Exiting thread.")
+            parsed = [v if name in TEXT_FIELDS else (float(v) if v.strip() else None)
+                      for name, v in zip(SENSOR_FIELDS, values)]
+        except ValueError:
+            return None
+        return cls(*parsed)
 
-    # A small function to generate the name of the file we'll log to.
-    # Format for the filename is: YYYYMMDD.HHMMSS.csv
-    def gen_filename(self):
-        d = datetime.today()
-        fn = os.path.join(self.__out, d.strftime('%Y%m%d') + "." + d.strftime('%H%M%S') + ".csv")
-        assert isinstance(fn, str)
-        return fn
+    def to_line(self):
+        # Back to a line like the sketch's text ones, for the data files.
+        return format_row(self)
+
+    @property
+    def has_fix(self):
+        return bool(self.gps_fix) and self.latitude is not None and self.longitude is not None
+
+    @property
+    def gps_seconds(self):
+        # GPS time as seconds since midnight UTC. The sketch doesn't zero pad: "14:5:3.250".
+        try:
+            hours, minutes, seconds = self.gps_time.split(":")
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        except (ValueError, AttributeError):
+            return None
+
+    @property
+    def altitude(self):
+        # GPS altitude if we have a fix, otherwise what the barometer thinks.
+        if self.has_fix and self.gps_altitude is not None:
+            return self.gps_altitude
+        return self.baro_altitude
+
+    @property
+    def temperature(self):
+        # Outside (thermocouple) temperature if it read properly, otherwise the barometer's.
+        if self.k_temp is not None and self.k_temp != BAD_TEMP:
+            return self.k_temp
+        return self.baro_temp
 
-    def get_headers(self, to_parse):
-        # Separate out the headers so we can include them in future files
-        x = to_parse.split(",")
-        for l in x:
-            self.headers.append(l)
-        logging.debug('Data Thread: Parsing headers.')
-        logging.debug('Data Thread: Before: {0}'.format(to_parse))
-        logging.debug('Data Thread: After: {0}'.format(self.headers))
 
+def record_builder(schema, record_type=None):
+    """
+    For the binary protocol's FrameDecoder: a function that turns the field values of one of
+    schema's records into a record_type (a SensorRecord, unless it's one of the sensor streams'
+    samples). Works out where everything goes once, up front.
+    """
+    if record_type is None:
+        record_type = STREAM_TYPES.get(schema.stream, SensorRecord)
+    fields = record_type._fields
+    index = {name: i for i, name in enumerate(schema.names)}
+    missing = [name for name in fields if name not in index and name not in TEXT_FIELDS]
+    if missing:
+        logging.warning("Arduino: Schema version {0} ({1}) has no {2}.".format(
+            schema.version, chr(schema.stream), ", ".join(missing)))
+    positions = [index.get(name) for name in fields]
+    gps_time = None
+    if 'gps_time' in fields and all(name in index for name in GPS_TIME_FIELDS):
+        gps_time = [index[name] for name in GPS_TIME_FIELDS]
+        date_position, time_position = fields.index('gps_date'), fields.index('gps_time')
+    fix = index.get('gps_fix')
+    fix_positions = [fields.index(name) for name in FIX_FIELDS if name in fields]
 
-class ArduinoThreadSupervisor (Thread):
-    def __init__(self, port, output_dir):
-        Thread.__init__(self)
+    def build(values):
+        record = [None if i is None else float(values[i]) for i in positions]
+        if gps_time:
+            year, month, day, hour, minute, second, millis = [values[i] for i in gps_time]
+            # The same as the text rows, except the milliseconds are zero padded.
+            record[date_position] = "20{0}/{1}/{2}".format(year, month, day)
+            record[time_position] = "{0}:{1}:{2}.{3:03d}".format(hour, minute, second, millis)
+        if fix is not None and not values[fix]:
+            for i in fix_positions:
+                record[i] = None
+        return record_type(*record)
+    return build
+
+
+#################
+# Reading the Arduino
+#################
+class ArduinoReader (Subsystem):
+    name = "Arduino"
+    # Ready once the first good record is in.
+    reports_ready = True
+    # A record comes in about every 0.7s. Ten seconds without one and something's wrong.
+    stall_timeout = 10
+
+    def __init__(self, port, output_dir, bus=None, binary=False, stream_dir=None, nmea=False, gps_from_bus=False):
+        """
+        :param port: Serial port the Arduino is on.
+        :param output_dir: Where the sensor data files go.
+        :param bus: TelemetryBus to publish each SensorRecord on (TOPIC_SENSOR).
+        :param binary: Ask the sketch for binary frames (see ArduinoProtocol) instead of text.
+                       The data files are the same either way.
+        :param stream_dir: Ask the sketch for each sensor's stream (see SensorStreams), and write them
+                           here. The rows in output_dir are then put together from the streams, one
+                           for each barometer sample. Implies binary.
+        :param nmea: In stream mode, have the sketch forward the GPS's sentences instead of parsing
+                     them itself. They're kept in stream_dir/nmea, and parsed here (NmeaParser) into
+                     the gps stream and TOPIC_GPS.
+        :param gps_from_bus: Fill in each row's GPS fields from the bus's latest GpsFix (TOPIC_GPS), for
+                             when the GPS is on the Pi (HighaltGps) rather than the Arduino.
+        """
         self.__serial_connection = Serial()
         # Place to store headers
         self.sensor_headers = []
         # Have we parsed the headers already?
         self.headers_parsed = False
+        # The last few parsed records, kept across restarts.
+        self.__recent_records = deque(maxlen=RECENT_RECORDS)
+        self.__bus = bus
         self.__port = port
-        self.__out_dir = output_dir
-        self.__current_thread = None
+        self.__store = SegmentStore(output_dir, LINES_PER_FILE * BYTES_PER_LINE, "Arduino")
+        # Keep alive, basically.
+        # Have to encode it because the serial stream only takes bytes.
+        # The sketch only looks at the first byte it gets: 'B' for binary frames, 'M' for streams.
+        if stream_dir:
+            binary = True
+            self.__keep_alive = REQUEST_NMEA if nmea else REQUEST_STREAMS
+        else:
+            self.__keep_alive = REQUEST_BINARY if binary else "Hello.".encode('ascii')
+        self.__decoder = FrameDecoder(record_builder) if binary else None
+        # Stream mode: where each stream goes, and what puts them back together into rows.
+        self.__stream_files = StreamFiles(stream_dir) if stream_dir else None
+        self.__aligner = StreamAligner() if stream_dir else None
+        # A row for each sample of this stream.
+        self.row_stream = STREAM_BARO
+        self.__nmea = NmeaParser() if stream_dir and nmea else None
+        self.__gps_from_bus = gps_from_bus and bus is not None
+        if binary:
+            # No header row comes with the frames. The files get the field names instead.
+            self.sensor_headers = list(SENSOR_FIELDS)
+            self.headers_parsed = True
+        self.last_received_line = None
+        # Lines (or the error that ended the connection) as they come in off the port.
+        self.__lines = None
+        self.__buffer = bytearray()
+        self.__runtime = None
+        self.__watching = False
         self.__stop = False
+        self.__announced = False
+        # Stats
+        self.lines_read = 0
+        self.bytes_read = 0
+        self.bad_lines = 0
 
     def stop(self):
         self.__stop = True
-        self.__current_thread.stop()
+        if self.__lines is not None:
+            # Wake up whoever's waiting for a line.
+            self.__lines.put_nowait(None)
 
     def last_line(self):
-        return self.__current_thread.last_received_line
+        return self.last_received_line
+
+    def recent_records(self):
+        """
+        The last few SensorRecords, oldest first.
+        :rtype : list
+        """
+        return list(self.__recent_records)
 
     @property
     def current_gps_coords(self):
@@ -128,28 +229,39 @@ class ArduinoThreadSupervisor (Thread):
         # We should probably check to see if we're actually sending numbers, but the only other option
         # is that we happen to time it right after the Arduino is reset, in which case it'll probably be either
         # blank or "Latitude, Longitude". In either case it's not harmful.
+        if self.last_line() is None:
+            return None
         data_array = str.split(self.last_line(), ',')
         # That's really only two parts out of the array (spots 4 and 5). Slices go up to the last number, not
         # including it.
         return "{0}, {1}".format(*data_array[4:6])
 
     # If we have a connection, reset the Arduino by toggling DTR
-    def __reset_arduino(self):
+    async def __reset_arduino(self):
         if self.__serial_connection.isOpen():
-            logging.debug('Arduino Supervisor: Resetting connection to Arduino.')
+            logging.debug('Arduino: Resetting connection to Arduino.')
+            # The reset line is capacitor coupled to DTR, so it's the edge that resets the
+            # board. Holding it any longer only holds up the first record.
             self.__serial_connection.setDTR(True)
-            sleep(1)
+            await asyncio.sleep(0.1)
             self.__serial_connection.setDTR(False)
             # Flush any data there at the moment
             self.__serial_connection.flushInput()
             self.__serial_connection.flushOutput()
 
-    # Define a function to actually establish a connection. That way, if we don't
-    # get one immediately, we can try to get one any time we would try to establish
-    # a new thread.
+    async def recover(self, runtime):
+        # The sketch has hung, most likely (or the Arduino browned out). A reset fixes that, and
+        # is quicker than reopening the port. If it doesn't, the watchdog restarts us.
+        if self.__serial_connection.isOpen():
+            logging.warning("Arduino: No data. Resetting the Arduino.")
+            await self.__reset_arduino()
+        else:
+            await runtime.restart(self, "no data")
+
+    # Set up the connection's settings. Opening it is up to run(), each time it starts.
     def __setup_serial_connection(self):
         try:
-            logging.debug('Arduino Supervisor: Setting up connection on {0}'.format(self.__port))
+            logging.debug('Arduino: Setting up connection on {0}'.format(self.__port))
             self.__serial_connection.port = self.__port
             self.__serial_connection.baudrate = 115200
             self.__serial_connection.stopbits = STOPBITS_ONE
@@ -157,45 +269,278 @@ class ArduinoThreadSupervisor (Thread):
             self.__serial_connection.parity = PARITY_NONE
             self.__serial_connection.timeout = 2
         except SerialException as err:
-            logging.warning("Arduino Supervisor: Serial Error: {0}".format(err))
+            logging.warning("Arduino: Serial Error: {0}".format(err))
 
-    def run(self):
-        # Try to establish a connection to the Arduino
+    async def run(self, runtime):
+        self.__runtime = runtime
+        self.__stop = False
+        self.__announced = False
         self.__setup_serial_connection()
-        # So long as we're not told to stop
-        while not self.__stop:
-            try:
-                self.__serial_connection.open()
-                if self.__serial_connection.isOpen():
-                    logging.debug("Arduino Supervisor: Connection open.")
-                    # Reset the Arduino:
-                    self.__reset_arduino()
-                    # Set up a data thread:
-                    self.__current_thread = ArduinoDataThread(self.__serial_connection,
-                                                              self.__out_dir,
-                                                              self.sensor_headers)
-                    # Start the thread
-                    self.__current_thread.start()
-                    # Join
-                    # The while not part here is so we can test this and give the join a timeout.
-                    # That way a keyboard interrupt actually works on it.
-                    while not self.__stop:
-                        # Checking every five seconds works for testing. I'll probably boost this later.
-                        self.__current_thread.join(5)
-                else:
-                    logging.debug("Arduino Supervisor: Connection failed to open.")
-            except KeyboardInterrupt:
-                logging.warning('Arduino Supervisor: Received keyboard interrupt.')
-                self.__stop = True
-                self.__current_thread.stop()
-            finally:
-                logging.info("Arduino Supervisor: Closing the serial connection before exiting.")
-                self.__serial_connection.close()
+        # If this fails, the runtime tries again later.
+        self.__serial_connection.open()
+        try:
+            logging.debug("Arduino: Connection open.")
+            runtime.mark(self, "serial open")
+            # Reset the Arduino:
+            await self.__reset_arduino()
+            runtime.mark(self, "reset")
+            self.__lines = asyncio.Queue()
+            self.__buffer.clear()
+            if self.__decoder:
+                # The Arduino's been reset, so a new schema's on its way (and millis() has started over).
+                self.__decoder.reset()
+            if self.__aligner:
+                self.__aligner.clear()
+            if self.__nmea:
+                self.__nmea.reset()
+            self.__watch()
+            # If we haven't been told to shut down:
+            while not self.__stop:
+                # Open a file to write data to and write 100 lines.
+                with self.__store.open_segment(self.gen_filename()) as f:
+                    logging.debug('Arduino: Opened new file for sensor data: %s', f.name)
+                    await self.__fill_segment(f)
+                    if self.__stop:
+                        self.__drain(f)
+                # Every so often, put the write times in the log.
+                if self.__store.segment_count % 10 == 0:
+                    self.__store.log_histogram()
+        finally:
+            self.__unwatch()
+            self.__lines = None
+            if self.__stream_files:
+                self.__stream_files.close()
+            logging.info("Arduino: Closing the serial connection.")
+            self.__serial_connection.close()
+
+    async def __fill_segment(self, f):
+        line_count = 0
+        while line_count < LINES_PER_FILE and not self.__stop:
+            # We have to send this to start the data flowing
+            # Also keep writing to it just to make sure the buffer on the other
+            # end stays active.
+            self.__serial_connection.write(self.__keep_alive)
+
+            response = await self.__next_line()
+            if isinstance(response, NmeaFrame):
+                response = self.__take_nmea(response)
+            elif isinstance(response, STREAM_SAMPLES):
+                # Only the row stream's samples make a row for the file.
+                response = self.__take_sample(response)
+            if response is None:
+                continue
+            # Arguments rather than a built string: it's only formatted if it gets written out.
+            logging.debug("Arduino: %s : %s", line_count, response)
+
+            # In case we haven't already done so, separate out the headers.
+            # We're going to want them for each file. Maybe.
+            if not self.headers_parsed and isinstance(response, str) and len(response.split(",")) > 1:
+                logging.debug("Arduino: Don't have headers, trying to parse.")
+                self.get_headers(response)
+                logging.debug(self.sensor_headers)
+                if len(self.sensor_headers) > 1:
+                    self.headers_parsed = True
+
+            # If we just opened a new file and we have headers, print them to the file.
+            if line_count == 0 and self.headers_parsed:
+                logging.debug("Arduino: We have headers, line count is zero. Writing headers to file.")
+                # Joins the headers using a comma to separate them.
+                f.write(','.join(str(x) for x in self.sensor_headers))
+                f.write('\n')
+
+            self.__write_line(f, response)
+            # We wrote another line, increment the counter.
+            line_count += 1
+
+    def __write_line(self, f, response):
+        # Write our response and attach an endline. Binary frames arrive already parsed.
+        if isinstance(response, SensorRecord):
+            record = response
+        else:
+            record = SensorRecord.from_line(response)
+        if record and self.__gps_from_bus:
+            # The file gets the GPS fields too.
+            record = self.__with_bus_gps(record)
+            response = record.to_line()
+        elif isinstance(response, SensorRecord):
+            response = record.to_line()
+        self.last_received_line = response
+        self.lines_read += 1
+        if record:
+            self.last_heartbeat = monotonic()
+            self.__recent_records.append(record)
+            if self.__bus:
+                self.__bus.publish(TOPIC_SENSOR, record)
+            if not self.__announced:
+                self.__announced = True
+                self.__runtime.ready(self)
+        else:
+            self.bad_lines += 1
+        f.write(response)
+        f.write('\n')
+        f.flush()
+
+    def __take_sample(self, sample):
+        # One sensor's sample, in stream mode. Returns the row it completes, if it's a row stream sample.
+        stream = STREAM_OF[type(sample)]
+        self.__stream_files.write(stream, sample)
+        self.__aligner.add(stream, sample)
+        # Any stream coming in means the sketch is alive.
+        self.last_heartbeat = monotonic()
+        if self.__bus:
+            self.__bus.publish(TOPIC_STREAM + STREAM_NAMES[stream], sample)
+        if stream == self.row_stream:
+            return self.__aligner.aligned(sample.millis, SensorRecord)
+        return None
+
+    def __take_nmea(self, frame):
+        # One of the GPS's sentences, forwarded by the sketch. Kept as is, and parsed into the gps stream.
+        self.__stream_files.write_text('nmea', frame.sentence.decode('ascii', errors='replace'), ".nmea")
+        for fix in self.__nmea.add(frame.sentence, frame.millis):
+            if self.__bus:
+                self.__bus.publish(TOPIC_GPS, fix)
+            self.__take_sample(GpsSample.from_fix(fix, fix.stamp))
+        return None
+
+    def __with_bus_gps(self, record):
+        # The record with the GPS fields from the latest fix, if it's recent enough to count.
+        latest = self.__bus.latest_entry(TOPIC_GPS)
+        if latest is None or monotonic() - latest.timestamp > MAX_GAP[STREAM_GPS] / 1000:
+            return record
+        sample = GpsSample.from_fix(latest.value, record.millis)
+        return record._replace(**{name: getattr(sample, name) for name in GPS_FIELDS})
+
+    # We're stopping. Whatever's already come in off the port goes in the file before it's
+    # closed, rather than being lost with the connection.
+    def __drain(self, f):
+        try:
+            if self.__watching and self.__serial_connection.in_waiting:
+                self.__on_readable()
+        except (SerialException, OSError):
+            pass
+        drained = 0
+        while not self.__lines.empty():
+            line = self.__lines.get_nowait()
+            if isinstance(line, NmeaFrame):
+                line = self.__take_nmea(line)
+            elif isinstance(line, STREAM_SAMPLES):
+                line = self.__take_sample(line)
+            if isinstance(line, (str, SensorRecord)):
+                self.__write_line(f, line)
+                drained += 1
+        logging.info("Arduino: Wrote {0} buffered line(s) on the way out.".format(drained))
+
+    #################
+    # Serial input
+    #################
+    # Have the loop tell us when there's something to read. Where it can't (no file
+    # descriptor, as on Windows), __next_line reads on a worker thread instead.
+    # Either way, what's read goes through __take, and lines (or records) come out of the queue.
+    def __watch(self):
+        try:
+            self.__runtime.loop.add_reader(self.__serial_connection.fileno(), self.__on_readable)
+            self.__watching = True
+        except (AttributeError, NotImplementedError):
+            self.__watching = False
+
+    def __unwatch(self):
+        if self.__watching:
+            self.__runtime.loop.remove_reader(self.__serial_connection.fileno())
+            self.__watching = False
+
+    def __on_readable(self):
+        try:
+            data = self.__serial_connection.read(self.__serial_connection.in_waiting or 1)
+        except (SerialException, OSError) as err:
+            # Unplugged, most likely. Hand the error to run(), which gives up on this connection.
+            self.__unwatch()
+            self.__lines.put_nowait(err)
+            return
+        self.__take(data)
+
+    def __take(self, data):
+        self.bytes_read += len(data)
+        if self.__decoder:
+            for item in self.__decoder.feed(data):
+                self.__lines.put_nowait(item)
+            return
+        self.__buffer.extend(data)
+        while True:
+            end = self.__buffer.find(b"\n")
+            if end < 0:
+                break
+            line = self.__buffer[:end].decode(errors="replace").rstrip()
+            del self.__buffer[:end + 1]
+            # Make sure the line actually has data in it
+            if line:
+                self.__lines.put_nowait(line)
+
+    # The next non-blank line (or record), or None if nothing came within the serial timeout (or
+    # we're stopping).
+    async def __next_line(self):
+        if not self.__watching:
+            if self.__lines.empty():
+                self.__take(await self.__runtime.run_blocking(self.__read_available))
+            return None if self.__lines.empty() else self.__lines.get_nowait()
+        try:
+            line = await asyncio.wait_for(self.__lines.get(), self.__serial_connection.timeout)
+        except asyncio.TimeoutError:
+            return None
+        if isinstance(line, Exception):
+            raise line
+        return line
+
+    # Whatever's there, or wait (up to the serial timeout) for at least a byte.
+    def __read_available(self):
+        return self.__serial_connection.read(self.__serial_connection.in_waiting or 1)
+
+    def register_metrics(self, metrics):
+        metrics.counter("arduino_lines_total", "Lines read from the Arduino.", lambda: self.lines_read)
+        metrics.counter("arduino_bad_lines_total", "Lines that weren't sensor records (headers, status).",
+                        lambda: self.bad_lines)
+        metrics.counter("arduino_serial_bytes_total", "Bytes read from the Arduino's serial port.",
+                        lambda: self.bytes_read)
+        metrics.counter("arduino_segments_total", "Sensor files started.", lambda: self.__store.segment_count)
+        metrics.histogram("arduino_write_seconds", "Time taken by each sensor file write and flush.",
+                          lambda: self.__store.histogram)
+        if self.__decoder:
+            decoder = self.__decoder
+            metrics.counter("arduino_frames_total", "Good binary frames from the Arduino.", lambda: decoder.frames)
+            metrics.counter("arduino_frame_errors_total", "Binary frames thrown away, by what was wrong with them.",
+                            lambda: decoder.errors, label="error")
+        if self.__nmea:
+            nmea = self.__nmea
+            metrics.counter("arduino_nmea_sentences_total", "Good NMEA sentences forwarded by the Arduino.",
+                            lambda: nmea.sentences)
+            metrics.counter("arduino_nmea_errors_total", "Forwarded NMEA sentences thrown away, by what was wrong.",
+                            lambda: nmea.errors, label="error")
+        if self.__stream_files:
+            stream_files = self.__stream_files
+            metrics.counter("arduino_stream_samples_total", "Samples of each sensor stream written.",
+                            lambda: dict(stream_files.samples), label="stream")
+
+    # A small function to generate the name of the file we'll log to.
+    # Format for the filename is: YYYYMMDD.HHMMSS.csv
+    def gen_filename(self):
+        d = datetime.today()
+        fn = d.strftime('%Y%m%d') + "." + d.strftime('%H%M%S') + ".csv"
+        assert isinstance(fn, str)
+        return fn
+
+    def get_headers(self, to_parse):
+        # Separate out the headers so we can include them in future files
+        x = to_parse.split(",")
+        for l in x:
+            self.sensor_headers.append(l)
+        logging.debug('Arduino: Parsing headers.')
+        logging.debug('Arduino: Before: {0}'.format(to_parse))
+        logging.debug('Arduino: After: {0}'.format(self.sensor_headers))
 
 
 if __name__ == "__main__":
     import getopt
     import sys
+    from HighaltHardware.HighaltRuntime import Runtime
 
     debugLevel = logging.INFO
     logging.basicConfig(stream=sys.stderr,
@@ -240,13 +585,18 @@ if __name__ == "__main__":
         return out, port
 
     out_dir, serial_port = process_args(sys.argv[1:])
-    sup = ArduinoThreadSupervisor(serial_port, out_dir)
-    try:
-        sup.start()
-        sleep(3)
-        for i in range(1, 5):
-            print("{0}: {1}".format(i, sup.current_gps_coords))
-            sleep(10)
-        sup.stop()
-    except KeyboardInterrupt:
-        sup.stop()
+    runtime = Runtime()
+    reader = runtime.add(ArduinoReader(serial_port, out_dir))
+
+    # Print where we are every ten seconds, four times, then stop.
+    ticks = []
+
+    def show_coords():
+        ticks.append(None)
+        print("{0}: {1}".format(len(ticks), reader.current_gps_coords if reader.last_line() else None))
+        if len(ticks) >= 4:
+            runtime.stop()
+
+    runtime.call_every(10, show_coords)
+    # Ctrl-C stops it too.
+    runtime.run()
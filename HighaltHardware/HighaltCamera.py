@@ -2,98 +2,165 @@
 
 import os
 import sys
-import threading
 import logging
-import picamera
+from time import monotonic
+from HighaltHardware.HighaltStorage import SegmentStore, LatencyHistogram, next_directory_number
+from HighaltHardware.HighaltRuntime import Subsystem
+from HighaltHardware.TelemetryBus import TOPIC_CAMERA_SEGMENT, CameraSegment
 
+# picamera's default H.264 bitrate. Used to work out how big each segment will get.
+DEFAULT_BITRATE = 17000000
 
-# Define our camera thread
-class CameraThread (threading.Thread):
-    def __init__(self, output_directory, video_duration, video_count):
-        logging.debug('Camera Thread: Creating new camera thread.')
-        threading.Thread.__init__(self)
-        self.__threadPath, self.__video_duration, self.__video_count = output_directory, video_duration, video_count
-        self.__stop = False
-        # self.threadPath = os.path.join(output_directory, '{:04d}'.format(instance_num))
-        logging.info('Camera Thread: Creating new directory for video: {0}'.format(self.__threadPath))
-        os.mkdir(self.__threadPath)
-
-    def stop(self):
-        self.__stop = True
-
-    def gen_paths(self, file_list):
-        tmp_array = []
-        for i in file_list:
-            tmp_array.append(os.path.join(self.__threadPath, i))
-        return list(tmp_array)
-
-    def run(self):
-        # Start a camera instance
-        logging.debug('Camera Thread: Camera thread running.')
-        try:
-            with picamera.PiCamera() as camera:
-                logging.debug('Camera Thread: Camera instance created. Setting options.')
-                # Setup basic options
-                camera.vflip = True
-                camera.hflip = True
-                # 480p
-                # camera.resolution = (720, 480)
-                # 720p
-                camera.resolution = (1280, 720)
-                # 1080p
-                # camera.resolution = (1920, 1080)
-                camera.framerate = 30
-                # Record a sequence of videos
-                for filename in camera.record_sequence(
-                        (self.gen_paths('%08d.h264' % i for i in range(0, int(self.__video_count)))),
-                        quality=20):
-                    logging.debug('Camera Thread: Recording to file: {0}'.format(filename))
-                    if self.__stop:
-                        break
-                    else:
-                        camera.wait_recording(int(self.__video_duration))
-        except threading.ThreadError as err:
-            logging.warning('Camera Thread: Caught an exception. Closing thread.')
-            logging.warning('Camera Thread: Exception: {0}'.format(err.args[0]))
 
+# Define our camera subsystem
+class CameraRecorder (Subsystem):
+    name = "Camera"
+    # Ready once the first segment is recording.
+    reports_ready = True
+    # The recording loop checks in every second. If it hasn't for this long, the watchdog
+    # restarts us, which starts a new camera session.
+    stall_timeout = 30
 
-class CamThreadSupervisor (threading.Thread):
-    def __init__(self, video_directory, video_duration, video_count):
-        threading.Thread.__init__(self)
+    def __init__(self, video_directory, video_duration, video_count, bitrate=DEFAULT_BITRATE, bus=None):
+        """
+        Records video_count segments of video_duration seconds into a numbered directory under
+        video_directory, then moves on to the next directory, until stopped.
+        :param bus: TelemetryBus to publish a CameraSegment on as each file is finished.
+        """
         self.video_directory = video_directory
         self.video_duration = video_duration
         self.video_count = video_count
+        self.bitrate = bitrate
+        self.__bus = bus
         self.__stop = False
-        self.__curThread = None
-        self.__curThreadNum = 0
+        self.__runtime = None
+        # The open PiCamera, while record() has one.
+        self.__camera = None
+        self.__cur_dir_num = 0
+        # When the last segment stopped recording, to time the gap before the next one.
+        self.__last_end = None
+        # Stats, kept across directories.
+        self.write_latency = LatencyHistogram()
+        self.segment_gaps = LatencyHistogram((0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60))
+        self.segments = 0
+        self.bytes_written = 0
 
     def stop(self):
+        # The recording thread checks this at least once a second.
         self.__stop = True
-        if self.__curThread:
-            self.__curThread.stop()
 
-    def run(self):
+    async def run(self, runtime):
+        self.__runtime = runtime
+        self.__stop = False
+        # Carry on after whatever's already there, so a restart (of us, or of the whole camera
+        # process) doesn't record over the video from before it.
+        self.__cur_dir_num = max(self.__cur_dir_num, next_directory_number(self.video_directory))
         while not self.__stop:
             # Create a new directory
-            path = os.path.join(self.video_directory, '{:04d}'.format(self.__curThreadNum))
-            logging.info("Cam Supervisor: Using directory: {0}".format(path))
-            # Create a thread
-            logging.info("Cam Supervisor: Starting new thread, number {0}".format(self.__curThreadNum))
-            self.__curThread = CameraThread(path, self.video_duration, self.video_count)
-            # Start the thread
-            logging.info("Cam Supervisor: Starting thread.")
-            self.__curThread.start()
-            # Increment our thread number
-            self.__curThreadNum += 1
-            # Join
-            logging.info("Cam Supervisor: Joining thread.")
-            self.__curThread.join()
-            logging.info("Cam Supervisor: Thread ended.")
+            path = os.path.join(self.video_directory, '{:04d}'.format(self.__cur_dir_num))
+            logging.info("Camera: Using directory: {0}".format(path))
+            # Increment our directory number
+            self.__cur_dir_num += 1
+            # picamera blocks while it records, so it gets a thread. One of its own, as it keeps
+            # it for the whole directory, and could hang on to it for good if the camera does.
+            await runtime.run_in_thread(self.record, path)
+            logging.info("Camera: Finished directory {0}.".format(path))
+
+    async def recover(self, runtime):
+        # A stop won't get through to a recording thread that's stuck inside picamera, and it
+        # keeps the camera held so the restart can't open it. Closing the camera from here makes
+        # whatever call it's stuck in raise, so record() lets go and returns.
+        camera = self.__camera
+        if camera is not None:
+            logging.warning("Camera: Recording has stalled. Closing the camera.")
+            try:
+                camera.close()
+            except Exception as err:
+                logging.warning("Camera: Closing the camera raised: {0!r}".format(err))
+        await runtime.restart(self, "stalled")
+
+    # Open each segment as picamera asks for it. picamera doesn't close outputs it didn't
+    # open itself, so record() takes care of that.
+    def gen_segments(self, store, file_list):
+        for i in file_list:
+            yield store.open_segment(i)
+
+    def record(self, path):
+        logging.info('Camera: Creating new directory for video: {0}'.format(path))
+        # Each segment is preallocated to what the bitrate says it'll reach.
+        expected_size = int(self.bitrate * int(self.video_duration) / 8)
+        store = SegmentStore(path, expected_size, 'Camera', self.write_latency)
+        # Imported here, on the recording thread, so loading it doesn't hold up everything
+        # else starting. Only the first time costs anything.
+        import picamera
+        # Start a camera instance
+        with picamera.PiCamera() as camera:
+            self.__camera = camera
+            logging.debug('Camera: Camera instance created. Setting options.')
+            if self.__runtime:
+                self.__runtime.mark(self, "camera open")
+            # Setup basic options
+            camera.vflip = True
+            camera.hflip = True
+            # 480p
+            # camera.resolution = (720, 480)
+            # 720p
+            camera.resolution = (1280, 720)
+            # 1080p
+            # camera.resolution = (1920, 1080)
+            camera.framerate = 30
+            # Record a sequence of videos
+            previous = None
+            started = None
+            try:
+                for segment in camera.record_sequence(
+                        self.gen_segments(store, ('%08d.h264' % i for i in range(0, int(self.video_count)))),
+                        quality=20, bitrate=self.bitrate):
+                    logging.debug('Camera: Recording to file: %s', segment.name)
+                    # By the time we get the new segment, picamera has finished with the old one.
+                    if previous:
+                        self.__finish_segment(previous, started)
+                    previous = segment
+                    started = self.last_heartbeat = monotonic()
+                    # Video we didn't get: switching files, a new directory, or a restart.
+                    if self.__last_end is not None:
+                        self.segment_gaps.record(started - self.__last_end)
+                    if self.__runtime:
+                        self.__runtime.ready(self)
+                    # Wait a second at a time, so a stop doesn't have to wait out the segment.
+                    for second in range(int(self.video_duration)):
+                        if self.__stop:
+                            break
+                        camera.wait_recording(1)
+                        self.last_heartbeat = monotonic()
+                    self.__last_end = monotonic()
+                    if self.__stop:
+                        break
+            finally:
+                self.__camera = None
+                # record_sequence has stopped recording by now, so the last one is done too.
+                if previous:
+                    self.__finish_segment(previous, started)
+                store.log_histogram()
+
+    def __finish_segment(self, segment, started):
+        segment.close()
+        self.segments += 1
+        self.bytes_written += segment.size
+        if self.__bus:
+            self.__bus.publish(TOPIC_CAMERA_SEGMENT, CameraSegment(segment.name, segment.size, monotonic() - started))
+
+    def register_metrics(self, metrics):
+        metrics.counter("camera_segments_total", "Video segments finished.", lambda: self.segments)
+        metrics.counter("camera_bytes_total", "Bytes of video written.", lambda: self.bytes_written)
+        metrics.histogram("camera_write_seconds", "Time taken by each video write.", lambda: self.write_latency)
+        metrics.histogram("camera_gap_seconds", "Time between one segment stopping and the next starting.",
+                          lambda: self.segment_gaps)
 
 
 if __name__ == "__main__":
     import getopt
-    from time import sleep
+    from HighaltHardware.HighaltRuntime import Runtime
 
     debugLevel = logging.DEBUG
     logging.basicConfig(stream=sys.stderr,
@@ -142,7 +209,8 @@ if __name__ == "__main__":
         return out, dur, num
 
     output, duration, count = process_args(sys.argv[1:])
-    sup = CamThreadSupervisor(output, duration, count)
-    sup.start()
-    sleep(30)
-    sup.stop()
+    runtime = Runtime()
+    runtime.add(CameraRecorder(output, duration, count))
+    # Record for 30 seconds.
+    runtime.call_every(30, runtime.stop)
+    runtime.run()
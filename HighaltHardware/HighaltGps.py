@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# A GPS wired straight to one of the Pi's UARTs.
+#
+# The Arduino doesn't need to see the GPS at all: its sentences come in on /dev/serial0 (or a
+# USB adapter), go through NmeaParser and are published as GpsFixes (TOPIC_GPS). The
+# ArduinoReader fills its rows' GPS fields from those (see gps_from_bus). The sentences
+# themselves are kept, as they came, in the streams directory.
+#
+#####################################################################
+
+import asyncio
+import logging
+from time import monotonic
+from serial import Serial, SerialException
+from HighaltHardware.HighaltRuntime import Subsystem
+from HighaltHardware.NmeaParser import NmeaParser, make_sentence
+from HighaltHardware.SensorStreams import StreamFiles
+from HighaltHardware.TelemetryBus import TOPIC_GPS
+
+# Set up an MTK GPS (the Adafruit Ultimate GPS) the way the sketch does, plus a GSA once a second:
+# 5 fixes a second, each with an RMC and a GGA. More doesn't fit in 9600 baud.
+GPS_SETUP = ("PMTK220,200",
+             "PMTK300,200,0,0,0,0",
+             "PMTK314,0,1,0,1,5,0,0,0,0,0,0,0,0,0,0,0,0,0,0")
+
+
+class GpsReader (Subsystem):
+    name = "GPS"
+    # Ready once the first fix (good or not) is in.
+    reports_ready = True
+    # Fixes come five times a second, with or without a position.
+    stall_timeout = 5
+
+    def __init__(self, port, stream_dir=None, bus=None, baudrate=9600, setup=GPS_SETUP):
+        """
+        :param port: Serial port the GPS is on.
+        :param stream_dir: Where to keep the raw sentences (in nmea/), if anywhere.
+        :param bus: TelemetryBus to publish each GpsFix on (TOPIC_GPS).
+        :param setup: PMTK commands (without the $ or checksum) to send the GPS when we start.
+        """
+        self.__serial_connection = Serial()
+        self.__port = port
+        self.__baudrate = baudrate
+        self.__setup = setup
+        self.__bus = bus
+        self.__files = StreamFiles(stream_dir) if stream_dir else None
+        self.__raw = bytearray()
+        self.parser = NmeaParser()
+        self.last_fix = None
+        self.__runtime = None
+        self.__data = None
+        self.__watching = False
+        self.__stop = False
+        # Stats
+        self.bytes_read = 0
+
+    def stop(self):
+        self.__stop = True
+        if self.__data is not None:
+            self.__data.put_nowait(None)
+
+    async def run(self, runtime):
+        self.__runtime = runtime
+        self.__stop = False
+        self.__serial_connection.port = self.__port
+        self.__serial_connection.baudrate = self.__baudrate
+        self.__serial_connection.timeout = 1
+        # If this fails, the runtime tries again later.
+        self.__serial_connection.open()
+        announced = False
+        try:
+            runtime.mark(self, "serial open")
+            for command in self.__setup:
+                self.__serial_connection.write(make_sentence(command))
+            self.parser.reset()
+            self.__raw.clear()
+            self.__data = asyncio.Queue()
+            self.__watch()
+            while not self.__stop:
+                data = await self.__next_data()
+                if not data:
+                    continue
+                self.bytes_read += len(data)
+                if self.__files:
+                    self.__keep(data)
+                for fix in self.parser.feed(data, monotonic()):
+                    self.last_fix = fix
+                    self.last_heartbeat = monotonic()
+                    if self.__bus:
+                        self.__bus.publish(TOPIC_GPS, fix)
+                    if not announced:
+                        announced = True
+                        runtime.ready(self)
+        finally:
+            self.__unwatch()
+            self.__data = None
+            logging.info("GPS: Closing the serial connection. {0} fixes from {1} sentences, errors {2}.".format(
+                self.parser.fixes, self.parser.sentences, self.parser.errors))
+            self.__serial_connection.close()
+            if self.__files:
+                self.__files.close()
+
+    def __keep(self, data):
+        # The sentences as they came, a line at a time.
+        self.__raw += data
+        end = self.__raw.rfind(b"\n")
+        if end < 0:
+            return
+        for line in self.__raw[:end].decode('ascii', errors='replace').splitlines():
+            if line.strip():
+                self.__files.write_text('nmea', line.rstrip(), ".nmea")
+        del self.__raw[:end + 1]
+
+    #################
+    # Serial input, the same way as the ArduinoReader
+    #################
+    def __watch(self):
+        try:
+            self.__runtime.loop.add_reader(self.__serial_connection.fileno(), self.__on_readable)
+            self.__watching = True
+        except (AttributeError, NotImplementedError):
+            self.__watching = False
+
+    def __unwatch(self):
+        if self.__watching:
+            self.__runtime.loop.remove_reader(self.__serial_connection.fileno())
+            self.__watching = False
+
+    def __on_readable(self):
+        try:
+            data = self.__serial_connection.read(self.__serial_connection.in_waiting or 1)
+        except (SerialException, OSError) as err:
+            self.__unwatch()
+            data = err
+        self.__data.put_nowait(data)
+
+    async def __next_data(self):
+        if not self.__watching:
+            return await self.__runtime.run_blocking(self.__read_available)
+        try:
+            data = await asyncio.wait_for(self.__data.get(), self.__serial_connection.timeout)
+        except asyncio.TimeoutError:
+            return None
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    def __read_available(self):
+        return self.__serial_connection.read(self.__serial_connection.in_waiting or 1)
+
+    def register_metrics(self, metrics):
+        parser = self.parser
+        metrics.counter("gps_sentences_total", "Good NMEA sentences from the GPS.", lambda: parser.sentences)
+        metrics.counter("gps_fixes_total", "Fixes put together from them.", lambda: parser.fixes)
+        metrics.counter("gps_sentence_errors_total", "NMEA sentences thrown away, by what was wrong with them.",
+                        lambda: parser.errors, label="error")
+        metrics.counter("gps_serial_bytes_total", "Bytes read from the GPS's serial port.", lambda: self.bytes_read)
+        metrics.gauge("gps_satellites", "Satellites used in the last fix.",
+                      lambda: self.last_fix.satellites if self.last_fix else None)
+        metrics.gauge("gps_hdop", "Horizontal dilution of precision of the last fix.",
+                      lambda: self.last_fix.hdop if self.last_fix else None)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Logging that stays out of the way of the data.
+#
+# A plain FileHandler formats and writes every record on the thread that logged it, on the
+# same SD card the sensor data goes to. With debug turned on, that's several writes per
+# sensor line. AsyncLogging splits it up:
+#   - Records at the log level (INFO, say) are put on a queue and a background thread
+#     formats and writes them to the log file.
+#   - Everything, debug included, goes into an in-memory ring of the last few thousand
+#     records. That's only an append: nothing is formatted and nothing touches the disk.
+#   - The ring is written out to its own file when an error is logged, or when asked (dump(),
+#     which highalt.py hooks up to SIGUSR1), so the lead up to a problem is there to look at.
+# So debug tracing can stay on for a flight without slowing the ingest down.
+#
+# To get the most out of it, log with arguments instead of building the string first:
+#   logging.debug("Arduino: %s : %s", line_count, response)
+# That way the message is only ever put together if the record is written out.
+#
+#####################################################################
+
+import os
+import queue
+import logging
+from time import monotonic
+from datetime import datetime
+from threading import Thread
+from collections import deque
+
+DEFAULT_FORMAT = '%(asctime)s %(levelname)s:%(message)s'
+
+# Format fields that need the (slow) caller lookup, and the ones that need thread or process info.
+_CALLER_FIELDS = ('%(pathname)', '%(filename)', '%(module)', '%(funcName)', '%(lineno)')
+_THREAD_FIELDS = ('%(thread)', '%(threadName)')
+_PROCESS_FIELDS = ('%(process)', '%(processName)')
+
+
+def trim_records(fmt):
+    """
+    Stop logging filling in the parts of each record that fmt doesn't use. Finding the caller
+    alone is about a third of the cost of a record. See "Optimization" in the logging HOWTO.
+    """
+    if not any(field in fmt for field in _CALLER_FIELDS):
+        logging._srcfile = None
+    if not any(field in fmt for field in _THREAD_FIELDS):
+        logging.logThreads = False
+    if not any(field in fmt for field in _PROCESS_FIELDS):
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+
+
+#################
+# In-memory ring of recent records
+#################
+class RingBufferHandler(logging.Handler):
+    def __init__(self, capacity=10000, on_error=None):
+        """
+        :param capacity: How many records to keep.
+        :param on_error: Called with the record when one at ERROR or above comes in.
+        """
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.__records = deque(maxlen=capacity)
+        self.__on_error = on_error
+
+    def handle(self, record):
+        # No lock and no formatting: appending to a deque is safe from any thread.
+        self.__records.append(record)
+        if record.levelno >= logging.ERROR and self.__on_error:
+            self.__on_error(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+    def records(self):
+        """
+        The records in the ring right now, oldest first.
+        :rtype : list
+        """
+        return list(self.__records)
+
+    def __len__(self):
+        return len(self.__records)
+
+
+#################
+# Hands records to the writer thread
+#################
+class DeferredQueueHandler(logging.Handler):
+    def __init__(self, record_queue, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.__queue = record_queue
+
+    def handle(self, record):
+        if record.levelno < self.level:
+            return False
+        # A traceback has to be turned into text now, while it still means something. The
+        # message itself waits until the writer gets to it.
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.__queue.put(record)
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+
+#################
+# The whole setup
+#################
+class AsyncLogging(object):
+    def __init__(self, filename, level=logging.INFO, fmt=DEFAULT_FORMAT, ring_size=10000, dump_dir=None,
+                 min_dump_interval=60):
+        """
+        :param filename: The log file.
+        :param level: Records at this level and up go to the log file.
+        :param fmt: Format for the log file and the ring dumps.
+        :param ring_size: How many records (of any level) to keep in memory.
+        :param dump_dir: Where to write ring dumps. Defaults to the log file's directory.
+        :param min_dump_interval: Don't dump for errors more often than this many seconds.
+        """
+        self.filename = filename
+        self.level = level
+        self.dump_dir = dump_dir or os.path.dirname(os.path.abspath(filename))
+        self.min_dump_interval = min_dump_interval
+        self.__format = fmt
+        self.__formatter = logging.Formatter(fmt)
+        # SimpleQueue's put is safe to use from a signal handler.
+        self.__queue = queue.SimpleQueue()
+        self.ring = RingBufferHandler(ring_size, on_error=self.__error_logged)
+        self.__file_handler = None
+        self.__queue_handler = None
+        self.__writer = None
+        self.__last_error_dump = None
+        self.dumps = 0
+
+    def start(self):
+        """
+        Replace the root logger's handlers with ours and start writing.
+        """
+        self.__file_handler = logging.FileHandler(self.filename)
+        self.__file_handler.setFormatter(self.__formatter)
+        self.__queue_handler = DeferredQueueHandler(self.__queue, self.level)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        # Everything reaches the ring. Only the handlers decide what goes further.
+        root.setLevel(logging.DEBUG)
+        root.addHandler(self.ring)
+        root.addHandler(self.__queue_handler)
+        trim_records(self.__format)
+        self.__writer = Thread(target=self.__write, name="LogWriter", daemon=True)
+        self.__writer.start()
+
+    def stop(self):
+        """
+        Write out what's queued and stop the writer. Records logged after this are only kept
+        in the ring.
+        """
+        if self.__writer is None:
+            return
+        logging.getLogger().removeHandler(self.__queue_handler)
+        self.__queue.put(None)
+        self.__writer.join()
+        self.__writer = None
+        # On the card before the power goes, not just in the page cache.
+        self.__file_handler.flush()
+        try:
+            os.fsync(self.__file_handler.stream.fileno())
+        except (AttributeError, OSError):
+            pass
+        self.__file_handler.close()
+
+    def dump(self, reason="requested"):
+        """
+        Write the ring out to a file of its own. Safe from any thread, or a signal handler:
+        the writer thread does the actual work.
+        """
+        # What's in the ring now, not whatever it's moved on to by the time it's written.
+        records = self.ring.records()
+        self.__queue.put(lambda: self.__dump_ring(records, reason))
+
+    def __error_logged(self, record):
+        now = monotonic()
+        if self.__last_error_dump is not None and now - self.__last_error_dump < self.min_dump_interval:
+            return
+        self.__last_error_dump = now
+        self.dump("error: {0}".format(record.getMessage()))
+
+    #################
+    # Writer thread
+    #################
+    def __write(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            try:
+                if callable(item):
+                    item()
+                else:
+                    self.__file_handler.handle(item)
+            except Exception as err:
+                # Nowhere else to say it.
+                print("Logging: {0!r}".format(err))
+
+    def __dump_ring(self, records, reason):
+        path = os.path.join(self.dump_dir, "debug-{0}.log".format(datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+        start = monotonic()
+        with open(path, "w") as f:
+            f.write("# Last {0} log records ({1})\n".format(len(records), reason))
+            for record in records:
+                f.write(self.__formatter.format(record))
+                f.write("\n")
+        self.dumps += 1
+        # This goes through the queue too, so it lands after anything already waiting.
+        logging.info("Logging: Wrote {0} debug records to {1} in {2:.3f}s ({3}).".format(
+            len(records), path, monotonic() - start, reason))
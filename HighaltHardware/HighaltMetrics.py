@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Flight metrics: counters, gauges and histograms, in the Prometheus text format.
+#
+# Most of the numbers already exist as stats on the objects that produce them (lines read,
+# segment write times, AT command round trips, the SMS queue). Rather than have the hot
+# paths also update a second copy, a metric can be given a source: something it reads when
+# the metrics are rendered. So counting a line is still just `self.lines_read += 1`, and the
+# cost of turning it into a metric is only paid every few seconds by the exporter.
+# Metrics without a source keep their own value (inc(), set(), observe()).
+#
+# A source can also return a dict, for a metric with one label. {"Arduino": 3, "FONA": 1}
+# for label "subsystem" becomes:
+#   highalt_restarts_total{subsystem="Arduino"} 3
+#   highalt_restarts_total{subsystem="FONA"} 1
+#
+# The MetricsExporter subsystem makes them available:
+#   - as a text file, rewritten every few seconds (point node_exporter's textfile collector
+#     at it, or just cat it),
+#   - on a Unix socket, which writes out the current metrics to anyone who connects
+#     (socat - UNIX-CONNECT:/tmp/highalt_metrics.sock),
+#   - and as a JSON line appended to a snapshot file every minute or so, with per second
+#     rates for the counters, so there's a record of the whole flight to look at afterwards.
+#
+#####################################################################
+
+import os
+import json
+import shutil
+import asyncio
+import logging
+from time import time, monotonic
+from HighaltHardware.HighaltStorage import LatencyHistogram
+from HighaltHardware.HighaltRuntime import Subsystem
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Where the Pi reports its CPU temperature, in thousandths of a degree.
+CPU_TEMP_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+
+#################
+# System readings
+#################
+def cpu_temperature(path=CPU_TEMP_PATH):
+    # Degrees C, or None if this machine doesn't say.
+    try:
+        with open(path) as f:
+            return int(f.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+
+def free_disk(path):
+    # Bytes free on the file system path is on, or None if it isn't there.
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
+
+
+#################
+# Metrics
+#################
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help_text, source=None, label=None):
+        """
+        :param name: Metric name, e.g. highalt_arduino_lines_total.
+        :param help_text: One line description.
+        :param source: Called for the value when rendering. Without one, the metric keeps its own.
+        :param label: Label name, if source returns a dict of label value -> value.
+        """
+        self.name = name
+        self.help = help_text
+        self.source = source
+        self.label = label
+        self.value = 0
+
+    def samples(self):
+        """
+        (label value, value) pairs. The label value is None for a metric without a label.
+        Values of None (nothing to report yet) are left out.
+        :rtype : list
+        """
+        value = self.source() if self.source else self.value
+        if self.label:
+            return [(k, v) for k, v in sorted(value.items()) if v is not None]
+        return [(None, value)] if value is not None else []
+
+
+class Counter(Metric):
+    kind = COUNTER
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(Metric):
+    kind = GAUGE
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(Metric):
+    kind = HISTOGRAM
+
+    def __init__(self, name, help_text, source=None, label=None, bounds=None):
+        """
+        source (or its dict values) should give a LatencyHistogram.
+        """
+        Metric.__init__(self, name, help_text, source, label)
+        self.value = LatencyHistogram(bounds)
+
+    def observe(self, value):
+        self.value.record(value)
+
+
+#################
+# Registry
+#################
+class MetricsRegistry(object):
+    def __init__(self, prefix="highalt_"):
+        self.prefix = prefix
+        self.__metrics = []
+
+    def __add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.__metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, source=None, label=None):
+        """
+        :rtype : Counter
+        """
+        return self.__add(Counter(name, help_text, source, label))
+
+    def gauge(self, name, help_text, source=None, label=None):
+        """
+        :rtype : Gauge
+        """
+        return self.__add(Gauge(name, help_text, source, label))
+
+    def histogram(self, name, help_text, source=None, label=None, bounds=None):
+        """
+        :rtype : Histogram
+        """
+        return self.__add(Histogram(name, help_text, source, label, bounds))
+
+    def __samples(self, metric):
+        try:
+            return metric.samples()
+        except Exception as err:
+            # Whatever it reads from might not be there yet (or any more).
+            logging.debug("Metrics: Couldn't read {0}: {1!r}".format(metric.name, err))
+            return []
+
+    def render(self):
+        """
+        Everything, in the Prometheus text exposition format.
+        :rtype : str
+        """
+        lines = []
+        for metric in self.__metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+            for label, value in self.__samples(metric):
+                labels = '{0}="{1}"'.format(metric.label, label) if label is not None else ""
+                if metric.kind == HISTOGRAM:
+                    lines.extend(self.__histogram_lines(metric.name, labels, value))
+                else:
+                    lines.append("{0}{1} {2}".format(metric.name, "{" + labels + "}" if labels else "", value))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __histogram_lines(name, labels, histogram):
+        # Prometheus buckets are cumulative, and the overflow bucket is +Inf.
+        prefix = labels + "," if labels else ""
+        total = 0
+        for bound, count in histogram.buckets():
+            total += count
+            le = "+Inf" if bound is None else "{0:g}".format(bound)
+            yield '{0}_bucket{{{1}le="{2}"}} {3}'.format(name, prefix, le, total)
+        labels = "{" + labels + "}" if labels else ""
+        yield "{0}_sum{1} {2}".format(name, labels, histogram.total)
+        yield "{0}_count{1} {2}".format(name, labels, histogram.count)
+
+    def snapshot(self):
+        """
+        The current values as a dict, for the snapshot file. Histograms are summarised.
+        :rtype : dict
+        """
+        out = {}
+        for metric in self.__metrics:
+            values = {}
+            for label, value in self.__samples(metric):
+                if metric.kind == HISTOGRAM:
+                    value = dict(count=value.count, mean=value.mean, max=value.max)
+                values[label] = value
+            if not values:
+                continue
+            out[metric.name] = values if metric.label else values[None]
+        return out
+
+    def counters(self):
+        return [metric.name for metric in self.__metrics if metric.kind == COUNTER]
+
+
+#################
+# Publishing them
+#################
+class MetricsExporter(Subsystem):
+    name = "Metrics"
+
+    def __init__(self, registry, text_path=None, socket_path=None, snapshot_path=None,
+                 interval=15, snapshot_interval=60):
+        """
+        :param registry: The MetricsRegistry to export.
+        :param text_path: File to rewrite with the current metrics every interval seconds.
+        :param socket_path: Unix socket to serve the current metrics on.
+        :param snapshot_path: File to append a JSON snapshot to every snapshot_interval seconds.
+        """
+        self.registry = registry
+        self.text_path = text_path
+        self.socket_path = socket_path
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+        self.__wake = None
+        self.__stop = False
+        # For working out the counter rates between snapshots.
+        self.__last_counters = None
+        self.__last_snapshot = None
+
+    def stop(self):
+        self.__stop = True
+        if self.__wake:
+            self.__wake.set()
+
+    async def run(self, runtime):
+        self.__stop = False
+        self.__wake = asyncio.Event()
+        server = await self.__serve()
+        next_snapshot = monotonic() + self.snapshot_interval
+        try:
+            while not self.__stop:
+                self.write_text()
+                if monotonic() >= next_snapshot:
+                    self.write_snapshot()
+                    next_snapshot += self.snapshot_interval
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if server:
+                server.close()
+                await server.wait_closed()
+                self.__remove_socket()
+            # One last look on the way down.
+            self.write_text()
+            self.write_snapshot()
+
+    def write_text(self):
+        if not self.text_path:
+            return
+        # Written to the side and renamed, so whatever reads it never sees half a file.
+        temp_path = self.text_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                f.write(self.registry.render())
+            os.replace(temp_path, self.text_path)
+        except OSError as err:
+            logging.warning("Metrics: Unable to write {0}: {1}".format(self.text_path, err))
+
+    def write_snapshot(self):
+        if not self.snapshot_path:
+            return
+        now = monotonic()
+        values = self.registry.snapshot()
+        counters = {name: values[name] for name in self.registry.counters()
+                    if name in values and not isinstance(values[name], dict)}
+        rates = {}
+        if self.__last_counters is not None and now > self.__last_snapshot:
+            for name, value in counters.items():
+                if name in self.__last_counters:
+                    rates[name] = round((value - self.__last_counters[name]) / (now - self.__last_snapshot), 3)
+        self.__last_counters = counters
+        self.__last_snapshot = now
+        try:
+            with open(self.snapshot_path, "a") as f:
+                f.write(json.dumps(dict(time=time(), metrics=values, rates=rates), sort_keys=True))
+                f.write("\n")
+        except OSError as err:
+            logging.warning("Metrics: Unable to write {0}: {1}".format(self.snapshot_path, err))
+
+    #################
+    # Unix socket
+    #################
+    async def __serve(self):
+        if not self.socket_path or not hasattr(asyncio, "start_unix_server"):
+            return None
+        self.__remove_socket()
+        try:
+            server = await asyncio.start_unix_server(self.__client, path=self.socket_path)
+        except OSError as err:
+            logging.warning("Metrics: Unable to listen on {0}: {1}".format(self.socket_path, err))
+            return None
+        logging.info("Metrics: Serving on {0}".format(self.socket_path))
+        return server
+
+    async def __client(self, reader, writer):
+        try:
+            writer.write(self.registry.render().encode())
+            await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    def __remove_socket(self):
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Running the subsystems in processes of their own.
+#
+# On one event loop, everything shares a single Python interpreter (and its GIL) on a small
+# ARM CPU, so a slow bit of Python in one subsystem (parsing a long inbox, say) holds up the
+# others, serial ingest included. In multi-process mode the parent runs a Runtime whose
+# subsystems are ChildProcesses: each one starts a process with a Runtime of its own (its
+# own log file and metrics file too), restarts it under the usual RestartPolicy if it dies,
+# and stops it with a SIGTERM, which the child's runtime treats like any other shutdown.
+#
+# The processes share sensor data two ways:
+#   - SharedRecord: the latest record, in a fixed layout block of shared memory guarded by a
+#     seqlock. The writer bumps a sequence number to odd, writes, and bumps it to even
+#     again. A reader copies the block and tries again if the number was odd or changed
+#     underneath it. Nobody waits on anybody, and a reader always gets a whole record.
+#   - RecordPipe: every record, through a multiprocessing queue, for whatever needs them all
+#     (the GPRS uplink). If the reader falls behind, records are dropped and counted rather
+#     than the ingest process being held up.
+#
+# ChildProcess also keeps track of how much CPU time each process uses.
+#
+#####################################################################
+
+import os
+import sys
+import math
+import queue
+import signal
+import struct
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from time import monotonic
+from multiprocessing import shared_memory
+from HighaltHardware.HighaltRuntime import Runtime, Subsystem
+from HighaltHardware.HighaltArduino import SensorRecord, SENSOR_FIELDS, TEXT_FIELDS
+from HighaltHardware.TelemetryBus import TOPIC_SENSOR
+
+# Fork where we can: it's much quicker to start than a fresh interpreter, and the child sets
+# up its own logging straight away.
+_context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Text fields are stored as fixed length byte strings.
+TEXT_SIZE = 16
+# Sequence number, then when the record was written (monotonic(), which is the same clock
+# in every process), then the fields. Numbers are doubles, with NaN for None.
+_HEADER = struct.Struct("<Q")
+_PAYLOAD = struct.Struct("<d" + "".join("{0}s".format(TEXT_SIZE) if name in TEXT_FIELDS else "d"
+                                        for name in SENSOR_FIELDS))
+
+
+#################
+# Latest record, in shared memory
+#################
+class SharedRecord(object):
+    size = _HEADER.size + _PAYLOAD.size
+
+    def __init__(self, name=None):
+        """
+        :param name: Name of an existing block to use. Without one, a new block is made.
+        """
+        if name is None:
+            self.__memory = shared_memory.SharedMemory(create=True, size=self.size)
+            self.__memory.buf[:self.size] = bytes(self.size)
+            self.__owner = True
+        else:
+            self.__memory = shared_memory.SharedMemory(name=name)
+            self.__owner = False
+        self.__buffer = self.__memory.buf
+        # Only one process writes, so it can keep count itself. Picked up on the first write, as
+        # readers open the block by name too.
+        self.__sequence = None
+        self.retries = 0
+
+    @property
+    def name(self):
+        return self.__memory.name
+
+    @property
+    def sequence(self):
+        # Goes up by two for each record written. 0 means nothing has been.
+        return _HEADER.unpack_from(self.__buffer, 0)[0]
+
+    def write(self, record):
+        values = [monotonic()]
+        for name, value in zip(SENSOR_FIELDS, record):
+            if name in TEXT_FIELDS:
+                values.append((value or "").encode()[:TEXT_SIZE])
+            else:
+                values.append(math.nan if value is None else value)
+        if self.__sequence is None:
+            # A writer that died part way through a record leaves the number odd. Round it up,
+            # or our odd and even would be the wrong way round and torn writes would look whole.
+            sequence = _HEADER.unpack_from(self.__buffer, 0)[0]
+            self.__sequence = sequence + (sequence & 1)
+        self.__sequence += 1
+        _HEADER.pack_into(self.__buffer, 0, self.__sequence)
+        _PAYLOAD.pack_into(self.__buffer, _HEADER.size, *values)
+        self.__sequence += 1
+        _HEADER.pack_into(self.__buffer, 0, self.__sequence)
+
+    def read_entry(self, attempts=100):
+        """
+        :return: (SensorRecord, monotonic() time it was written), or None if there isn't one yet
+                 (or the writer kept changing it for all of the attempts).
+        """
+        for attempt in range(attempts):
+            before = _HEADER.unpack_from(self.__buffer, 0)[0]
+            if before == 0:
+                return None
+            if before & 1:
+                # Being written right now.
+                self.retries += 1
+                continue
+            values = _PAYLOAD.unpack_from(self.__buffer, _HEADER.size)
+            if _HEADER.unpack_from(self.__buffer, 0)[0] != before:
+                self.retries += 1
+                continue
+            fields = []
+            for name, value in zip(SENSOR_FIELDS, values[1:]):
+                if name in TEXT_FIELDS:
+                    fields.append(value.rstrip(b"\0").decode(errors="replace"))
+                else:
+                    fields.append(None if math.isnan(value) else value)
+            return SensorRecord(*fields), values[0]
+        return None
+
+    def read(self):
+        """
+        :rtype : SensorRecord
+        """
+        entry = self.read_entry()
+        return entry[0] if entry else None
+
+    def age(self):
+        # Seconds since the latest record was written, or None if there isn't one.
+        entry = self.read_entry()
+        return monotonic() - entry[1] if entry else None
+
+    def close(self):
+        self.__buffer = None
+        self.__memory.close()
+        if self.__owner:
+            self.__memory.unlink()
+
+
+#################
+# Every record, through a queue
+#################
+class RecordPipe(object):
+    def __init__(self, maxsize=1000):
+        self.__queue = _context.Queue(maxsize)
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, record):
+        # Never blocks. Made for bus.listen().
+        try:
+            self.__queue.put_nowait(record)
+            self.sent += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def receive(self, timeout=None):
+        """
+        The next record, or None if none came within timeout seconds.
+        """
+        try:
+            return self.__queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RecordReceiver(Subsystem):
+    name = "Records"
+
+    def __init__(self, pipe, bus, keep=50):
+        """
+        Take records off a RecordPipe and publish them on this process's bus.
+        :param keep: How many of the latest to keep for recent_records().
+        """
+        self.__pipe = pipe
+        self.__bus = bus
+        self.__recent = deque(maxlen=keep)
+        self.__stop = False
+        self.received = 0
+
+    def stop(self):
+        self.__stop = True
+
+    def recent_records(self):
+        """
+        The last few SensorRecords, oldest first.
+        :rtype : list
+        """
+        return list(self.__recent)
+
+    async def run(self, runtime):
+        self.__stop = False
+        while not self.__stop:
+            # Blocks, so it waits on a worker thread. Wakes up every second to check for stop.
+            record = await runtime.run_blocking(self.__pipe.receive, 1)
+            if record is None:
+                continue
+            self.received += 1
+            self.__recent.append(record)
+            self.__bus.publish(TOPIC_SENSOR, record)
+
+
+#################
+# CPU accounting
+#################
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def process_cpu_seconds(pid):
+    # User plus system CPU time, from /proc. None where there's no /proc (or no such process).
+    try:
+        with open("/proc/{0}/stat".format(pid)) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name is in brackets and can have spaces in it, so count from after it.
+    fields = stat[stat.rindex(")") + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+
+
+def own_cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+#################
+# A child process
+#################
+def _child_main(name, setup, args, log_path, log_level, metrics_path, stall_timeouts, started):
+    # Everything the parent had going (its log writer thread, its event loop) is gone, or
+    # never came across, so start over.
+    from HighaltHardware.HighaltLogging import AsyncLogging
+    from HighaltHardware.HighaltMetrics import MetricsRegistry, MetricsExporter
+    from HighaltHardware.HighaltWatchdog import Watchdog
+    # A forked child starts out inside the parent's event loop, with the parent's signal
+    # wakeup pipe: a SIGTERM here would wake the parent up. (Python 3.12 does this itself.)
+    asyncio.events._set_running_loop(None)
+    if hasattr(signal, "set_wakeup_fd"):
+        signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Ctrl-C goes to the whole process group, but stopping is up to the parent.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    async_logging = AsyncLogging(log_path, level=log_level)
+    async_logging.start()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: async_logging.dump("SIGUSR1"))
+    try:
+        logging.info("{0}: Process {1} started.".format(name, os.getpid()))
+        runtime = Runtime(started=started, signals=(signal.SIGTERM,))
+        metrics = MetricsRegistry()
+        runtime.register_metrics(metrics)
+        if metrics_path:
+            runtime.add(MetricsExporter(metrics, text_path=metrics_path))
+        setup(runtime, metrics, *args)
+        # Stalls are dealt with in here. The parent only sees the process exit.
+        watchdog = runtime.add(Watchdog(runtime, stall_timeouts=stall_timeouts))
+        watchdog.register_metrics(metrics)
+        runtime.call_every(600, runtime.log_status)
+        runtime.run()
+    except Exception:
+        logging.exception("{0}: Process failed.".format(name))
+        raise
+    finally:
+        logging.info("{0}: Process {1} exiting.".format(name, os.getpid()))
+        async_logging.stop()
+        logging.shutdown()
+
+
+class ChildProcess(Subsystem):
+    # A few seconds more than the child's own runtime takes to shut down.
+    stop_timeout = Runtime.shutdown_deadline + 5
+    # Send the SIGTERM as soon as the parent starts stopping, so the children all wind down
+    # at the same time instead of one after the other.
+    stop_together = True
+
+    def __init__(self, name, setup, args=(), log_path=None, log_level=logging.INFO, metrics_path=None,
+                 stall_timeouts=None):
+        """
+        :param name: For the logs (and the process title).
+        :param setup: Called in the child as setup(runtime, metrics, *args) to add its subsystems.
+                      Has to be a module level function if processes are spawned rather than forked.
+        :param log_path: The child's log file.
+        :param metrics_path: The child's metrics file (see MetricsExporter).
+        :param stall_timeouts: For the child's Watchdog: name -> seconds, overriding each subsystem's own.
+        """
+        self.name = name
+        self.__setup = setup
+        self.__args = tuple(args)
+        self.__log_path = log_path
+        self.__log_level = log_level
+        self.__metrics_path = metrics_path
+        self.__stall_timeouts = stall_timeouts
+        self.__process = None
+        self.__stop = False
+        # CPU time used by earlier runs, and by this one at the last look.
+        self.__cpu_before = 0.0
+        self.__cpu_now = 0.0
+        self.exit_codes = []
+
+    @property
+    def pid(self):
+        return self.__process.pid if self.__process else None
+
+    @property
+    def cpu_seconds(self):
+        return self.__cpu_before + self.__cpu_now
+
+    def stop(self):
+        self.__stop = True
+        if self.__process is not None and self.__process.is_alive():
+            self.__process.terminate()
+
+    async def run(self, runtime):
+        self.__stop = False
+        self.__cpu_now = 0.0
+        self.__process = _context.Process(target=_child_main, name=self.name,
+                                          args=(self.name, self.__setup, self.__args, self.__log_path,
+                                                self.__log_level, self.__metrics_path, self.__stall_timeouts,
+                                                monotonic()))
+        self.__process.start()
+        logging.info("{0}: Started process {1}.".format(self.name, self.__process.pid))
+        runtime.mark(self, "process started")
+        try:
+            while self.__process.is_alive():
+                self.__sample_cpu()
+                await asyncio.sleep(0.5)
+        except asyncio.CancelledError:
+            # Out of time. It gets no more chances.
+            logging.warning("{0}: Killing process {1}.".format(self.name, self.__process.pid))
+            self.__process.kill()
+            self.__process.join()
+            raise
+        finally:
+            self.__cpu_before += self.__cpu_now
+            self.__cpu_now = 0.0
+        self.__process.join()
+        self.exit_codes.append(self.__process.exitcode)
+        logging.log(logging.INFO if self.__stop else logging.WARNING,
+                    "{0}: Process {1} exited with {2}.".format(self.name, self.__process.pid,
+                                                               self.__process.exitcode))
+
+    def __sample_cpu(self):
+        seconds = process_cpu_seconds(self.__process.pid)
+        if seconds is not None:
+            self.__cpu_now = seconds
+
+
+#################
+# Parent side bookkeeping
+#################
+def register_process_metrics(metrics, children):
+    """
+    CPU time for the parent and each child, as highalt_process_cpu_seconds_total{process=...}.
+    """
+    def cpu():
+        out = {"parent": own_cpu_seconds()}
+        for child in children:
+            out[child.name] = child.cpu_seconds
+        return out
+    metrics.counter("process_cpu_seconds_total", "CPU time used by each process.", cpu, label="process")
+
+
+def log_process_cpu(children):
+    logging.info("Processes: CPU parent={0:.1f}s {1}".format(
+        own_cpu_seconds(), " ".join("{0}={1:.1f}s".format(child.name, child.cpu_seconds) for child in children)))
+
+
+if __name__ == "__main__":
+    # Seqlock check: one process writes records as fast as it can, this one reads them, and
+    # every record read has to be one that was written whole.
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(levelname)s:%(message)s', level=logging.INFO)
+
+    def fake_record(i):
+        return SensorRecord(*([float(i), "12/3/2016", "10:0:{0}.0".format(i % 60)] +
+                              [float(i)] * (len(SENSOR_FIELDS) - 3)))
+
+    def writer(block_name, count):
+        block = SharedRecord(block_name)
+        for n in range(1, count + 1):
+            block.write(fake_record(n))
+        block.close()
+
+    shared = SharedRecord()
+    total = 200000
+    proc = _context.Process(target=writer, args=(shared.name, total))
+    proc.start()
+    reads = torn = 0
+    last = 0
+    start_time = monotonic()
+    while proc.is_alive() or last < total:
+        got = shared.read()
+        if got is None:
+            continue
+        reads += 1
+        # Every field of a whole record has the same number in it.
+        if any(v != got.millis for k, v in zip(SENSOR_FIELDS, got) if k not in TEXT_FIELDS):
+            torn += 1
+        last = int(got.millis)
+        if not proc.is_alive() and last >= total:
+            break
+    proc.join()
+    print("{0} reads in {1:.1f}s ({2:.1f}us each), {3} torn, {4} retries, last record {5}".format(
+        reads, monotonic() - start_time, (monotonic() - start_time) / max(reads, 1) * 1e6, torn, shared.retries,
+        last))
+    shared.close()
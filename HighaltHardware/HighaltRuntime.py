@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# One event loop to run everything on.
+#
+# Each piece of hardware used to get a supervisor thread, which started a worker thread and
+# then sat in join(5) until it died, with highalt.py doing the same to the supervisors. Now
+# each one is a Subsystem: a coroutine that runs on a single asyncio loop, waiting on serial
+# port readiness, timers or (for the few calls that really do block) a worker thread. Calls
+# that hold on to a thread for minutes at a time, like the camera's, get a daemon thread of
+# their own, so one that hangs can't stop the program exiting. The Runtime:
+#   - starts the subsystems, all at once,
+#   - keeps track of when each one says it's ready (first record in, modem registered, ...),
+#     and logs how long each step of starting up took,
+#   - restarts any that stop or fail, when their RestartPolicy says to (or when something
+#     like the Watchdog says one has stalled),
+#   - runs periodic jobs (call_every),
+#   - and on stop() (or SIGINT/SIGTERM, which is what power.py sends before it halts the Pi)
+#     stops them again in reverse order. Each gets a few seconds to write out what it has
+#     and close its files before it's cancelled, and the whole lot has to be done within
+#     shutdown_deadline.
+#
+#####################################################################
+
+import signal
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from HighaltHardware.RestartPolicy import RestartPolicy
+
+
+#################
+# Something for the runtime to run
+#################
+class Subsystem(object):
+    # Used in the log.
+    name = "Subsystem"
+    # Seconds to wait before starting it again after it first stops or fails. It backs off
+    # from there (see RestartPolicy).
+    restart_delay = 1
+    # Seconds it gets to finish after stop() before it's cancelled.
+    stop_timeout = 10
+    # True if it calls runtime.ready() itself once it's up. Otherwise it counts as ready as
+    # soon as it's started.
+    reports_ready = False
+    # True to have stop() called as soon as the runtime starts stopping, rather than in turn.
+    # For things that take a while to stop and don't depend on each other, like processes.
+    stop_together = False
+    # Seconds without a heartbeat that count as stalled, for the Watchdog. None isn't watched.
+    stall_timeout = None
+    # monotonic() time it last showed it was working (a record in, a segment recording, ...).
+    last_heartbeat = None
+
+    async def run(self, runtime):
+        """
+        Do the work. Returning (or raising) while the runtime is still running means it gets
+        restarted, so only return when stop() has been called.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Finish up. Called on the loop's thread. run() should return soon after.
+        """
+        pass
+
+    async def recover(self, runtime):
+        """
+        The Watchdog thinks it's stalled. Override to try something less drastic than a restart
+        first (resetting the device, say).
+        """
+        await runtime.restart(self, "stalled")
+
+    def restart_policy(self):
+        # Override for different backoff or breaker settings.
+        return RestartPolicy(self.name, base_delay=self.restart_delay)
+
+
+#################
+# How long starting up took
+#################
+class StartupTimes(object):
+    def __init__(self, start=None):
+        """
+        :param start: monotonic() time to measure from. Defaults to now.
+        """
+        self.start = start if start is not None else monotonic()
+        # who -> list of (phase, seconds since start)
+        self.phases = OrderedDict()
+
+    def mark(self, who, phase):
+        """
+        Note that who finished phase just now. Only the first time through counts: once who is
+        ready, later marks (after a restart) aren't kept.
+        :return: Seconds since the start.
+        """
+        elapsed = monotonic() - self.start
+        phases = self.phases.setdefault(who, [])
+        if not any(done == "ready" for done, _ in phases):
+            phases.append((phase, elapsed))
+        return elapsed
+
+    def summary(self):
+        # "Arduino: start 0.41s, serial open 0.43s, ready 1.20s; FONA: ..."
+        return "; ".join("{0}: {1}".format(who, ", ".join("{0} {1:.2f}s".format(phase, elapsed)
+                                                          for phase, elapsed in phases))
+                         for who, phases in self.phases.items())
+
+
+#################
+# The runtime
+#################
+class Runtime(object):
+    # How long to wait for everything to be ready before logging the startup times anyway.
+    startup_timeout = 60
+    # Seconds everything gets to stop, all together. Keep it under what power.py (and the init
+    # script) will wait.
+    shutdown_deadline = 20
+    # Seconds to wait for the worker threads to finish once everything has stopped.
+    executor_timeout = 5
+
+    def __init__(self, started=None, signals=(signal.SIGINT, signal.SIGTERM)):
+        """
+        :param started: monotonic() time the program started, to measure startup from.
+        :param signals: Signals that stop the runtime.
+        """
+        self.__signals = signals
+        self.__subsystems = []
+        self.__timers = []
+        self.__loop = None
+        self.__executor = None
+        self.__stopping = None
+        self.__stop_requested = False
+        # name -> asyncio.Event, set while the subsystem is up. Made once the loop is running.
+        self.__ready = {}
+        # name -> the task running the subsystem right now.
+        self.__running = {}
+        # Names of subsystems being restarted on purpose, which counts as a failure.
+        self.__restarting = set()
+        # name -> RestartPolicy, which also has the restart counts and downtime.
+        self.policies = {}
+        self.startup = StartupTimes(started)
+
+    @property
+    def loop(self):
+        return self.__loop
+
+    @property
+    def stopping(self):
+        return self.__stop_requested
+
+    @property
+    def subsystems(self):
+        return [subsystem for subsystem, _ in self.__subsystems]
+
+    def add(self, subsystem, start_delay=0):
+        """
+        :param subsystem: The Subsystem to run.
+        :param start_delay: Seconds to wait after starting up before starting this one. Everything
+                            starts straight away by default; use wait_ready() for ordering.
+        :return: The subsystem, for convenience.
+        """
+        self.__subsystems.append((subsystem, start_delay))
+        self.policies[subsystem.name] = subsystem.restart_policy()
+        return subsystem
+
+    def call_every(self, interval, func, *args):
+        """
+        Call func(*args) on the loop every interval seconds, for as long as the runtime runs.
+        """
+        self.__timers.append((interval, func, args))
+
+    def mark(self, who, phase):
+        """
+        Note that a startup phase is done. who is a Subsystem or a name. Safe from any thread.
+        """
+        who = getattr(who, "name", who)
+        elapsed = self.startup.mark(who, phase)
+        logging.debug("Runtime: %s: %s after %.3fs", who, phase, elapsed)
+
+    def ready(self, subsystem):
+        """
+        subsystem is up and doing its job. Safe from any thread.
+        """
+        try:
+            on_loop = asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self.__set_ready(subsystem)
+        elif self.__loop and not self.__loop.is_closed():
+            try:
+                self.__loop.call_soon_threadsafe(self.__set_ready, subsystem)
+            except RuntimeError:
+                pass
+
+    def is_ready(self, name):
+        event = self.__ready.get(name)
+        return event is not None and event.is_set()
+
+    async def wait_ready(self, name, timeout=None):
+        """
+        Wait for the subsystem called name to be ready.
+        :return: True if it is, False if the timeout ran out first.
+        """
+        try:
+            await asyncio.wait_for(self.__ready[name].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def __set_ready(self, subsystem):
+        event = self.__ready.get(subsystem.name)
+        if event is None or event.is_set():
+            return
+        event.set()
+        policy = self.policies[subsystem.name]
+        if policy.starts == 1:
+            logging.info("Runtime: {0} ready after {1:.2f}s.".format(subsystem.name,
+                                                                   self.startup.mark(subsystem.name, "ready")))
+        else:
+            logging.info("Runtime: {0} ready again, {1:.2f}s after restarting.".format(subsystem.name,
+                                                                                     policy.uptime or 0))
+
+    async def __report_startup(self):
+        events = [self.__ready[subsystem.name] for subsystem, _ in self.__subsystems]
+        if events:
+            _, pending = await asyncio.wait([asyncio.ensure_future(event.wait()) for event in events],
+                                            timeout=self.startup_timeout)
+            for waiter in pending:
+                waiter.cancel()
+        waiting = [subsystem.name for subsystem, _ in self.__subsystems if not self.is_ready(subsystem.name)]
+        logging.info("Runtime: Startup times: {0}".format(self.startup.summary()))
+        if waiting:
+            logging.warning("Runtime: Still not ready after {0}s: {1}".format(self.startup_timeout,
+                                                                             ", ".join(waiting)))
+
+    async def restart(self, subsystem, reason):
+        """
+        Stop subsystem and have it started again, as though it had failed. If stop() doesn't do it
+        within its stop_timeout (it's stuck), it's cancelled.
+        """
+        task = self.__running.get(subsystem.name)
+        if task is None or task.done() or self.__stop_requested:
+            return
+        logging.warning("Runtime: Restarting {0} ({1}).".format(subsystem.name, reason))
+        self.__restarting.add(subsystem.name)
+        try:
+            subsystem.stop()
+        except Exception as err:
+            logging.warning("Runtime: Stopping {0} raised: {1!r}".format(subsystem.name, err))
+        done, _ = await asyncio.wait([task], timeout=subsystem.stop_timeout)
+        if not done:
+            logging.warning("Runtime: {0} didn't stop in {1}s. Cancelling it.".format(subsystem.name,
+                                                                                    subsystem.stop_timeout))
+            task.cancel()
+
+    async def run_blocking(self, func, *args):
+        """
+        Run a call that blocks on a worker thread, without holding up the loop.
+        """
+        return await self.__loop.run_in_executor(None, func, *args)
+
+    async def run_in_thread(self, func, *args):
+        """
+        Like run_blocking, but on a daemon thread of its own instead of the shared pool. For calls
+        that keep going for a long time (recording video), so one that hangs doesn't tie up a pool
+        thread, and doesn't hold up the program exiting.
+        """
+        loop = self.__loop
+        future = loop.create_future()
+
+        def settle(error, result):
+            # Whoever was waiting may have been cancelled meanwhile.
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def work():
+            error = result = None
+            try:
+                result = func(*args)
+            except Exception as err:
+                error = err
+            try:
+                loop.call_soon_threadsafe(settle, error, result)
+            except RuntimeError:
+                # The loop has closed.
+                pass
+
+        threading.Thread(target=work, name=getattr(func, "__name__", "worker"), daemon=True).start()
+        return await future
+
+    def stop(self):
+        # Safe to call from any thread, or from a signal handler.
+        self.__stop_requested = True
+        if self.__loop and not self.__loop.is_closed():
+            try:
+                self.__loop.call_soon_threadsafe(self.__stopping.set)
+            except RuntimeError:
+                # The loop closed in between.
+                pass
+
+    def run(self):
+        """
+        Run everything until stop() is called. Blocks.
+        """
+        self.__loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.__loop)
+        # Our own pool rather than the loop's, so we can decide how long to wait for it.
+        self.__executor = ThreadPoolExecutor(thread_name_prefix="Runtime")
+        self.__loop.set_default_executor(self.__executor)
+        try:
+            self.__loop.run_until_complete(self.__main())
+        finally:
+            self.__loop.run_until_complete(self.__shutdown_executor())
+            self.__loop.close()
+            logging.info("Runtime: Stopped.")
+
+    async def __main(self):
+        self.__stopping = asyncio.Event()
+        if self.__stop_requested:
+            self.__stopping.set()
+        for sig in self.__signals:
+            try:
+                self.__loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Not on this platform, or not on the main thread.
+                pass
+
+        self.__ready = {subsystem.name: asyncio.Event() for subsystem, _ in self.__subsystems}
+        tasks = []
+        for subsystem, delay in self.__subsystems:
+            tasks.append((subsystem, asyncio.ensure_future(self.__supervise(subsystem, delay))))
+        timers = [asyncio.ensure_future(self.__repeat(*timer)) for timer in self.__timers]
+        timers.append(asyncio.ensure_future(self.__report_startup()))
+        logging.info("Runtime: Running {0} subsystems.".format(len(tasks)))
+
+        await self.__stopping.wait()
+
+        logging.info("Runtime: Stopping.")
+        start = monotonic()
+        deadline = start + self.shutdown_deadline
+        for timer in timers:
+            timer.cancel()
+        for subsystem, _ in reversed(self.__subsystems):
+            if subsystem.stop_together:
+                subsystem.stop()
+        # Last started, first stopped.
+        drain_times = []
+        for subsystem, task in reversed(tasks):
+            timeout = max(0, min(subsystem.stop_timeout, deadline - monotonic()))
+            drain_times.append((subsystem.name, await self.__stop_subsystem(subsystem, task, timeout)))
+        logging.info("Runtime: Shut down in {0:.2f}s ({1}).".format(
+            monotonic() - start, ", ".join("{0} {1:.2f}s".format(name, seconds) for name, seconds in drain_times)))
+
+    # Wait for the worker threads, but not forever: one stuck in a device call would hold up
+    # the whole shutdown. (The loop's shutdown_default_executor can't be given up on: it joins
+    # its thread even when it's cancelled.)
+    async def __shutdown_executor(self):
+        try:
+            await asyncio.wait_for(self.run_in_thread(self.__executor.shutdown), self.executor_timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Runtime: Worker threads still busy after {0}s. Not waiting for them.".format(
+                self.executor_timeout))
+
+    async def __supervise(self, subsystem, delay):
+        policy = self.policies[subsystem.name]
+        if delay:
+            await self.__sleep(delay)
+        while not self.__stop_requested:
+            logging.info("Runtime: Starting {0}.".format(subsystem.name))
+            policy.started()
+            self.__ready[subsystem.name].clear()
+            if policy.starts == 1:
+                self.mark(subsystem, "start")
+            if not subsystem.reports_ready:
+                self.__set_ready(subsystem)
+            failed = True
+            # Its own task, so restart() can cancel it without cancelling us.
+            task = self.__running[subsystem.name] = asyncio.ensure_future(subsystem.run(self))
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                # Let it clean up before we go.
+                task.cancel()
+                await asyncio.wait([task])
+                raise
+            try:
+                task.result()
+                failed = False
+            except asyncio.CancelledError:
+                logging.warning("Runtime: {0} was cancelled.".format(subsystem.name))
+            except Exception as err:
+                logging.warning("Runtime: {0} failed: {1!r}".format(subsystem.name, err))
+            if subsystem.name in self.__restarting:
+                self.__restarting.discard(subsystem.name)
+                failed = True
+            delay = policy.stopped(failed)
+            if self.__stop_requested:
+                break
+            logging.warning("Runtime: {0} stopped. Restarting in {1:.1f}s.".format(subsystem.name, delay))
+            await self.__sleep(delay)
+
+    # Sleep, but wake up early if we're stopping.
+    async def __sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self.__stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def __stop_subsystem(self, subsystem, task, timeout):
+        # Returns how long it took.
+        logging.info("Runtime: Stopping {0}.".format(subsystem.name))
+        start = monotonic()
+        try:
+            subsystem.stop()
+        except Exception as err:
+            logging.warning("Runtime: Stopping {0} raised: {1!r}".format(subsystem.name, err))
+        done, _ = await asyncio.wait([task], timeout=timeout)
+        if not done:
+            logging.warning("Runtime: {0} didn't stop in {1:.1f}s. Cancelling it.".format(subsystem.name, timeout))
+            task.cancel()
+            await asyncio.wait([task])
+        elapsed = monotonic() - start
+        logging.info("Runtime: {0} stopped in {1:.2f}s.".format(subsystem.name, elapsed))
+        return elapsed
+
+    async def __repeat(self, interval, func, args):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                func(*args)
+            except Exception as err:
+                logging.warning("Runtime: Periodic call to {0} failed: {1!r}".format(func, err))
+
+    def register_metrics(self, metrics):
+        def per_subsystem(func):
+            return lambda: {name: func(policy) for name, policy in self.policies.items()}
+        metrics.counter("restarts_total", "Times each subsystem was restarted.",
+                        per_subsystem(lambda p: p.restarts), label="subsystem")
+        metrics.counter("failures_total", "Times each subsystem failed.",
+                        per_subsystem(lambda p: p.failures), label="subsystem")
+        metrics.counter("breaker_trips_total", "Times each subsystem's restart breaker opened.",
+                        per_subsystem(lambda p: p.breaker_trips), label="subsystem")
+        metrics.counter("downtime_seconds_total", "Time each subsystem has spent not running.",
+                        per_subsystem(lambda p: round(p.total_downtime, 3)), label="subsystem")
+        metrics.gauge("up", "Whether each subsystem is running.",
+                      per_subsystem(lambda p: int(p.running)), label="subsystem")
+
+    def log_status(self):
+        for subsystem, _ in self.__subsystems:
+            policy = self.policies[subsystem.name]
+            logging.info("Runtime: {0}, {1}.".format(
+                policy, "up {0:.0f}s".format(policy.uptime) if policy.running else "not running"))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Output file layer shared by the camera and the sensor logger.
+#
+# The SD card fragments badly when files are grown by lots of small appends, and the
+# write speed drops off as the card fills. To help with that, every segment is
+# preallocated to the size we expect it to reach, written into, and then truncated back
+# to the real size when it's closed.
+#
+# Each SegmentStore also keeps a histogram of how long the writes take, so we can see
+# from the log whether the sustained write speed holds up through a flight.
+#
+#####################################################################
+
+import os
+import logging
+from bisect import bisect_left
+from time import perf_counter
+
+
+#################
+# Write latency histogram
+#################
+class LatencyHistogram(object):
+    # Upper bounds of each bucket, in seconds. Anything slower lands in the last (overflow) bucket.
+    default_bounds = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self, bounds=None):
+        self.__bounds = tuple(bounds) if bounds else self.default_bounds
+        self.__counts = [0] * (len(self.__bounds) + 1)
+        self.__count = 0
+        self.__total = 0.0
+        self.__max = 0.0
+
+    def record(self, seconds):
+        self.__counts[bisect_left(self.__bounds, seconds)] += 1
+        self.__count += 1
+        self.__total += seconds
+        if seconds > self.__max:
+            self.__max = seconds
+
+    @property
+    def count(self):
+        return self.__count
+
+    @property
+    def total(self):
+        return self.__total
+
+    @property
+    def mean(self):
+        return self.__total / self.__count if self.__count else 0.0
+
+    @property
+    def max(self):
+        return self.__max
+
+    def buckets(self):
+        # Pairs of (upper bound, count). The overflow bucket has an upper bound of None.
+        return list(zip(self.__bounds + (None,), self.__counts))
+
+    def __str__(self):
+        parts = []
+        for bound, count in self.buckets():
+            if count:
+                label = "<={0:g}ms".format(bound * 1000) if bound is not None else "slower"
+                parts.append("{0}:{1}".format(label, count))
+        return "n={0} mean={1:.3f}ms max={2:.3f}ms [{3}]".format(self.__count,
+                                                               self.mean * 1000,
+                                                               self.__max * 1000,
+                                                               " ".join(parts))
+
+
+#################
+# A single preallocated output file
+#################
+class SegmentFile(object):
+    def __init__(self, path, expected_size=0, histogram=None, encoding='utf-8'):
+        """
+        Open a new segment file and preallocate space for it. Raises FileExistsError rather
+        than overwrite a file that's already there.
+        :param path: Where to create the file.
+        :param expected_size: How many bytes we expect to write. 0 skips preallocation.
+        :param histogram: LatencyHistogram to record write times into.
+        :param encoding: Used to encode anything written as a str.
+        """
+        self.name = path
+        self.__encoding = encoding
+        self.__histogram = histogram if histogram is not None else LatencyHistogram()
+        self.__size = 0
+        # How long the fsync on close took.
+        self.sync_time = None
+        self.__file = open(path, 'xb')
+        if expected_size > 0:
+            self.__preallocate(expected_size)
+
+    def __preallocate(self, size):
+        # Not every platform (or file system) has fallocate. If it isn't there we just
+        # lose the benefit, we don't lose any data.
+        if not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(self.__file.fileno(), 0, size)
+        except OSError as err:
+            logging.debug("Storage: Unable to preallocate {0}: {1}".format(self.name, err))
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode(self.__encoding)
+        start = perf_counter()
+        written = self.__file.write(data)
+        self.__histogram.record(perf_counter() - start)
+        self.__size += written
+        return written
+
+    def flush(self):
+        start = perf_counter()
+        self.__file.flush()
+        self.__histogram.record(perf_counter() - start)
+
+    def fileno(self):
+        return self.__file.fileno()
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def closed(self):
+        return self.__file.closed
+
+    def close(self, sync=True):
+        """
+        :param sync: fsync before closing, so the segment is on the card and not just in the
+                     page cache if the power goes.
+        """
+        if self.__file.closed:
+            return
+        self.__file.flush()
+        # Give back whatever part of the preallocation we didn't use.
+        self.__file.truncate(self.__size)
+        if sync:
+            start = perf_counter()
+            os.fsync(self.__file.fileno())
+            self.sync_time = perf_counter() - start
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+#################
+# A directory of segments
+#################
+class SegmentStore(object):
+    def __init__(self, directory, expected_size=0, name="Storage", histogram=None):
+        """
+        A place to create segment files, all sharing one write latency histogram.
+        :param directory: Directory to put the segments in. Created if it doesn't exist.
+        :param expected_size: Size in bytes to preallocate for each segment.
+        :param name: Used to label the log messages.
+        :param histogram: LatencyHistogram to record into, if it should outlast this store.
+        """
+        self.directory = directory
+        self.expected_size = expected_size
+        self.name = name
+        self.histogram = histogram if histogram is not None else LatencyHistogram()
+        self.segment_count = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def open_segment(self, filename):
+        path = os.path.join(self.directory, filename)
+        stem, extension = os.path.splitext(path)
+        # Names can repeat (two files in the same second, or a restart), but the data can't be lost.
+        copy = 0
+        while True:
+            try:
+                segment = SegmentFile(path, self.expected_size, self.histogram)
+                break
+            except FileExistsError:
+                copy += 1
+                path = "{0}.{1}{2}".format(stem, copy, extension)
+        if copy:
+            logging.warning("{0}: {1} already exists, using {2}".format(self.name, filename, path))
+        logging.debug("%s: Opening segment %s", self.name, path)
+        self.segment_count += 1
+        return segment
+
+    def log_histogram(self):
+        logging.info("{0}: Write latency after {1} segments: {2}".format(self.name,
+                                                                         self.segment_count,
+                                                                         self.histogram))
+
+
+# The number after the highest numbered directory (0000, 0001, ...) in directory, or 0 if
+# there aren't any yet.
+def next_directory_number(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    numbers = [int(name) for name in names if name.isdigit() and os.path.isdir(os.path.join(directory, name))]
+    return max(numbers) + 1 if numbers else 0
+
+
+# Work out where the video and sensor directories go. By default they both sit under
+# root_dir, but the video can be put on its own partition so the two don't fight over
+# the same free space.
+def data_dirs(root_dir, date_dir, time_dir, video_root=None):
+    video_data_dir = os.path.join(video_root or root_dir, date_dir, time_dir, 'video')
+    sensor_data_dir = os.path.join(root_dir, date_dir, time_dir, 'sensors')
+    return video_data_dir, sensor_data_dir
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Noticing when something has stopped working without stopping running.
+#
+# A hung serial read, a camera that's quietly stopped recording and a FONA stuck in the middle
+# of a command all look the same to the runtime: the subsystem is still running, so nothing
+# gets restarted. Instead, each subsystem that wants watching keeps a heartbeat (last_heartbeat,
+# the monotonic() time it last did its job: a record in, a second of video, an answer from the
+# modem) and says how long it can go without one (stall_timeout). The Watchdog checks them
+# every second or so. When one goes stale:
+#   1. It calls the subsystem's recover(), which does whatever's most likely to fix it with the
+#      least fuss: the Arduino is reset with DTR, the FONA is power cycled. By default that's a
+#      restart.
+#   2. If the heartbeat still hasn't come back after another stall_timeout, the runtime restarts
+#      it (cancelling it if it won't stop). That counts as a failure, so the restart policy's
+#      backoff and breaker apply, and it carries on doing that for as long as it stays stalled.
+# How late each stall was noticed, and how long it took to come back, go in histograms.
+#
+# It can also keep the Pi's hardware watchdog (/dev/watchdog) fed. That's only done from the
+# event loop, so if the loop itself hangs, the Pi reboots.
+#
+#####################################################################
+
+import asyncio
+import logging
+from time import monotonic
+from HighaltHardware.HighaltStorage import LatencyHistogram
+from HighaltHardware.HighaltRuntime import Subsystem
+
+# Buckets for the latency histograms, in seconds.
+STALL_BOUNDS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+
+#################
+# The Pi's hardware watchdog
+#################
+class HardwareWatchdog(object):
+    def __init__(self, path="/dev/watchdog"):
+        """
+        Once opened, the Pi reboots unless pet() is called every 15 seconds or so (the bcm2835
+        driver's default), until close().
+        """
+        self.path = path
+        self.__device = None
+        self.pets = 0
+
+    def open(self):
+        self.__device = open(self.path, "wb", buffering=0)
+        logging.info("Watchdog: Opened {0}.".format(self.path))
+
+    def pet(self):
+        if self.__device:
+            self.__device.write(b"\0")
+            self.pets += 1
+
+    def close(self):
+        if self.__device:
+            # The magic close: tells the driver we meant to stop, so it doesn't reboot us.
+            try:
+                self.__device.write(b"V")
+            finally:
+                self.__device.close()
+                self.__device = None
+            logging.info("Watchdog: Closed {0}.".format(self.path))
+
+
+#################
+# What we know about each subsystem we're watching
+#################
+class StallState(object):
+    def __init__(self):
+        # When we noticed the current stall, and when we last did something about it.
+        self.detected = None
+        self.last_action = None
+        # Stats
+        self.stalls = 0
+        self.recoveries = 0
+        self.escalations = 0
+        # How long after the heartbeat went stale we noticed, and from then until it came back.
+        self.detect_latency = LatencyHistogram(STALL_BOUNDS)
+        self.recovery_latency = LatencyHistogram(STALL_BOUNDS)
+
+
+#################
+# The watchdog itself
+#################
+class Watchdog(Subsystem):
+    name = "Watchdog"
+    stop_timeout = 2
+
+    def __init__(self, runtime, interval=1, stall_timeouts=None, hardware=None):
+        """
+        :param runtime: The runtime whose subsystems to watch.
+        :param interval: Seconds between checks. Detection can be this late.
+        :param stall_timeouts: Name -> seconds, to override each subsystem's stall_timeout.
+        :param hardware: HardwareWatchdog to keep fed, if any.
+        """
+        self.__runtime = runtime
+        self.interval = interval
+        self.stall_timeouts = dict(stall_timeouts or {})
+        self.hardware = hardware
+        self.__states = {}
+        self.__wake = None
+        self.__stop = False
+
+    def stop(self):
+        self.__stop = True
+        if self.__wake:
+            self.__wake.set()
+
+    def stall_timeout_for(self, subsystem):
+        return self.stall_timeouts.get(subsystem.name, subsystem.stall_timeout)
+
+    def watched(self):
+        return [subsystem for subsystem in self.__runtime.subsystems
+                if subsystem is not self and self.stall_timeout_for(subsystem) is not None]
+
+    def heartbeat_ages(self):
+        now = monotonic()
+        return {subsystem.name: (round(now - subsystem.last_heartbeat, 3)
+                                 if subsystem.last_heartbeat is not None else None)
+                for subsystem in self.watched()}
+
+    async def run(self, runtime):
+        self.__stop = False
+        self.__wake = asyncio.Event()
+        if self.hardware:
+            # Without it we still do the checks, so carry on.
+            try:
+                self.hardware.open()
+            except OSError as err:
+                logging.warning("Watchdog: Unable to open {0}: {1}".format(self.hardware.path, err))
+        try:
+            logging.info("Watchdog: Watching {0}.".format(", ".join(
+                "{0} ({1}s)".format(subsystem.name, self.stall_timeout_for(subsystem)) for subsystem in self.watched())))
+            while not self.__stop:
+                self.check()
+                if self.hardware:
+                    self.hardware.pet()
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self.hardware:
+                self.hardware.close()
+            self.log_stats()
+
+    def check(self):
+        now = monotonic()
+        for subsystem in self.watched():
+            state = self.__states.setdefault(subsystem.name, StallState())
+            timeout = self.stall_timeout_for(subsystem)
+            beat = subsystem.last_heartbeat
+            if state.detected is not None:
+                if beat is not None and beat > state.detected:
+                    state.recoveries += 1
+                    state.recovery_latency.record(beat - state.detected)
+                    logging.info("Watchdog: {0} is working again, {1:.1f}s after it was found stalled.".format(
+                        subsystem.name, beat - state.detected))
+                    state.detected = None
+                # Running but still not ready after a restart is as stalled as it gets.
+                elif self.__runtime.policies[subsystem.name].running and now - state.last_action >= timeout:
+                    state.escalations += 1
+                    state.last_action = now
+                    self.__spawn(self.__runtime.restart(subsystem, "still stalled"))
+                continue
+            # Not running at all is the runtime's problem, and it isn't stalled until it's been up once.
+            if beat is None or not self.__is_running(subsystem):
+                continue
+            age = now - beat
+            if age > timeout:
+                state.stalls += 1
+                state.detected = state.last_action = now
+                state.detect_latency.record(age - timeout)
+                logging.warning("Watchdog: {0} has stalled. Nothing for {1:.1f}s (limit {2}s). Recovering.".format(
+                    subsystem.name, age, timeout))
+                self.__spawn(subsystem.recover(self.__runtime))
+
+    def __is_running(self, subsystem):
+        return self.__runtime.policies[subsystem.name].running and self.__runtime.is_ready(subsystem.name)
+
+    def __spawn(self, coroutine):
+        asyncio.ensure_future(coroutine).add_done_callback(self.__task_done)
+
+    @staticmethod
+    def __task_done(task):
+        if not task.cancelled() and task.exception():
+            logging.warning("Watchdog: Recovery failed: {0!r}".format(task.exception()))
+
+    def register_metrics(self, metrics):
+        def per_subsystem(func):
+            return lambda: {name: func(state) for name, state in self.__states.items()}
+        metrics.gauge("heartbeat_age_seconds", "Time since each watched subsystem last did its job.",
+                      self.heartbeat_ages, label="subsystem")
+        metrics.counter("watchdog_stalls_total", "Times each subsystem was found stalled.",
+                        per_subsystem(lambda s: s.stalls), label="subsystem")
+        metrics.counter("watchdog_recoveries_total", "Times each subsystem came back from a stall.",
+                        per_subsystem(lambda s: s.recoveries), label="subsystem")
+        metrics.counter("watchdog_escalations_total", "Stalls that needed a restart on top of recover().",
+                        per_subsystem(lambda s: s.escalations), label="subsystem")
+        metrics.histogram("watchdog_detect_seconds", "How long after the stall limit each stall was noticed.",
+                          per_subsystem(lambda s: s.detect_latency), label="subsystem")
+        metrics.histogram("watchdog_recovery_seconds", "Time from noticing a stall to the next heartbeat.",
+                          per_subsystem(lambda s: s.recovery_latency), label="subsystem")
+        if self.hardware:
+            metrics.counter("watchdog_pets_total", "Times the hardware watchdog was fed.",
+                            lambda: self.hardware.pets)
+
+    def log_stats(self):
+        for name, state in sorted(self.__states.items()):
+            logging.info("Watchdog: {0}: stalls={1} recoveries={2} escalations={3} detect: {4} recovery: {5}".format(
+                name, state.stalls, state.recoveries, state.escalations, state.detect_latency,
+                state.recovery_latency))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Parsing the GPS's NMEA sentences ourselves.
+#
+# Adafruit_GPS on the Arduino only keeps part of what the GPS says (nothing on satellites,
+# HDOP or how good the fix is), and reading it is most of the sketch's loop. Instead the raw
+# sentences can come to the Pi, either forwarded by the sketch (its 'N' stream mode) or
+# straight from a GPS wired to one of the Pi's UARTs (HighaltGps). This turns them into:
+#
+#   RmcSentence  time, date, valid, position, speed and course
+#   GgaSentence  time, position, fix quality, satellites in use, HDOP, altitude, geoid separation
+#   GsaSentence  2D/3D, the satellites used, PDOP/HDOP/VDOP
+#
+# and puts each fix's sentences together into a GpsFix. The GPS sends an RMC and a GGA with
+# the same time for each fix (5 a second, as we set it up), so a GpsFix comes out as soon as it
+# has both. GSA has no time, so the fix gets the last one that came in (we only ask for it
+# once a second, as 9600 baud doesn't leave room for more). Sentences with a bad checksum are
+# counted and thrown away.
+#
+# feed() takes bytes as they come off a port, whole lines or not. add() takes one sentence.
+#
+#####################################################################
+
+from functools import reduce
+from operator import xor
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+# The longest sentence NMEA allows, with the $ and \r\n.
+MAX_SENTENCE = 82
+
+RmcSentence = namedtuple('RmcSentence', ['talker', 'time', 'valid', 'latitude', 'longitude', 'speed', 'course',
+                                         'date'])
+GgaSentence = namedtuple('GgaSentence', ['talker', 'time', 'latitude', 'longitude', 'quality', 'satellites', 'hdop',
+                                         'altitude', 'geoid_separation'])
+GsaSentence = namedtuple('GsaSentence', ['talker', 'selection', 'fix_type', 'prns', 'pdop', 'hdop', 'vdop'])
+
+# GGA fix quality.
+QUALITY_NONE = 0
+QUALITY_GPS = 1
+QUALITY_DGPS = 2
+# GSA fix type.
+FIX_NONE = 1
+FIX_2D = 2
+FIX_3D = 3
+
+
+class GpsFix (namedtuple('GpsFix', ['stamp', 'date', 'time', 'valid', 'latitude', 'longitude', 'altitude',
+                                    'geoid_separation', 'speed', 'course', 'quality', 'satellites', 'hdop', 'pdop',
+                                    'vdop', 'fix_type', 'prns'])):
+    """
+    Everything the GPS said about one fix. time is seconds since midnight UTC, speed is in knots
+    and altitude in metres. stamp is whatever was passed in with the fix's first sentence (the
+    Arduino's millis(), or the time it was read). Anything the GPS didn't send is None.
+    """
+    __slots__ = ()
+
+    @property
+    def has_fix(self):
+        return bool(self.valid) and self.latitude is not None and self.longitude is not None
+
+    @property
+    def utc(self):
+        # As a datetime, if the GPS knows the date and time.
+        if self.date is None or self.time is None:
+            return None
+        return datetime(self.date.year, self.date.month, self.date.day) + timedelta(seconds=self.time)
+
+
+#################
+# Fields
+#################
+# float() and int() both take bytes, so the fields are never decoded.
+def _float(value):
+    return float(value) if value else None
+
+
+def _int(value):
+    return int(value) if value else None
+
+
+def _degrees(value, hemisphere):
+    # ddmm.mmmm (or dddmm.mmmm) to signed decimal degrees.
+    if not value:
+        return None
+    raw = float(value)
+    degrees = int(raw // 100)
+    degrees += (raw - degrees * 100) / 60
+    return -degrees if hemisphere in (b'S', b'W') else degrees
+
+
+def _time(value):
+    # hhmmss.sss to seconds since midnight.
+    if not value:
+        return None
+    return int(value[0:2]) * 3600 + int(value[2:4]) * 60 + float(value[4:])
+
+
+def _date(value):
+    # ddmmyy
+    if not value:
+        return None
+    return date(2000 + int(value[4:6]), int(value[2:4]), int(value[0:2]))
+
+
+def checksum(body):
+    # The XOR of every byte in body (what's between the $ and the *).
+    return reduce(xor, body, 0)
+
+
+#################
+# Sentences
+#################
+def _rmc(talker, fields):
+    return RmcSentence(talker, _time(fields[1]), fields[2] == b'A',
+                       _degrees(fields[3], fields[4]), _degrees(fields[5], fields[6]),
+                       _float(fields[7]), _float(fields[8]), _date(fields[9]))
+
+
+def _gga(talker, fields):
+    return GgaSentence(talker, _time(fields[1]), _degrees(fields[2], fields[3]), _degrees(fields[4], fields[5]),
+                       _int(fields[6]), _int(fields[7]), _float(fields[8]), _float(fields[9]), _float(fields[11]))
+
+
+def _gsa(talker, fields):
+    return GsaSentence(talker, fields[1].decode('ascii'), _int(fields[2]),
+                       tuple(int(prn) for prn in fields[3:15] if prn),
+                       _float(fields[15]), _float(fields[16]), _float(fields[17]))
+
+
+_SENTENCES = {b'RMC': _rmc, b'GGA': _gga, b'GSA': _gsa}
+
+
+class ChecksumError (ValueError):
+    pass
+
+
+def parse_sentence(sentence):
+    """
+    One sentence (bytes, with or without the line ending) into an RmcSentence, GgaSentence or
+    GsaSentence.
+    :return: The sentence, or None if it's one we don't parse.
+    :raises ValueError: If it's damaged: no $, a bad checksum, or fields that don't parse.
+    """
+    sentence = sentence.strip()
+    star = sentence.rfind(b'*')
+    if not sentence.startswith(b'$') or star < 0 or len(sentence) != star + 3:
+        raise ValueError("Not an NMEA sentence: {0!r}".format(sentence))
+    body = sentence[1:star]
+    if checksum(body) != int(sentence[star + 1:], 16):
+        raise ChecksumError("Bad checksum: {0!r}".format(sentence))
+    fields = body.split(b',')
+    parse = _SENTENCES.get(fields[0][2:])
+    if parse is None:
+        return None
+    try:
+        return parse(fields[0][:2].decode('ascii'), fields)
+    except IndexError:
+        raise ValueError("Too few fields: {0!r}".format(sentence))
+
+
+#################
+# Putting fixes together
+#################
+class _Epoch(object):
+    __slots__ = ('time', 'stamp', 'rmc', 'gga', 'done')
+
+    def __init__(self, time, stamp):
+        self.time = time
+        self.stamp = stamp
+        self.rmc = None
+        self.gga = None
+        self.done = False
+
+
+class NmeaParser(object):
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.__epoch = None
+        # The latest of each kind of sentence.
+        self.rmc = None
+        self.gga = None
+        self.gsa = None
+        # Stats
+        self.sentences = 0
+        self.fixes = 0
+        self.checksum_errors = 0
+        self.malformed = 0
+        self.ignored = 0
+
+    @property
+    def errors(self):
+        return dict(checksum=self.checksum_errors, malformed=self.malformed)
+
+    def reset(self):
+        self.__buffer.clear()
+        self.__epoch = None
+
+    def feed(self, data, stamp=None):
+        """
+        :param data: Bytes off the port.
+        :param stamp: Goes on the fixes whose first sentence is in data.
+        :return: The GpsFixes completed.
+        :rtype : list
+        """
+        fixes = []
+        buffer = self.__buffer
+        buffer += data
+        while True:
+            end = buffer.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            # Half a sentence from before we started listening, or a blank line, is no use.
+            start = line.find(b'$')
+            if start >= 0:
+                fixes.extend(self.add(line[start:], stamp))
+        if len(buffer) > 2 * MAX_SENTENCE:
+            # No line ending in far too long: whatever this is, it isn't NMEA.
+            self.malformed += 1
+            buffer.clear()
+        return fixes
+
+    def add(self, sentence, stamp=None):
+        """
+        One sentence, as bytes.
+        :return: The GpsFixes it completes (one at most, usually none).
+        :rtype : list
+        """
+        try:
+            parsed = parse_sentence(sentence)
+        except ChecksumError:
+            self.checksum_errors += 1
+            return []
+        except ValueError:
+            self.malformed += 1
+            return []
+        self.sentences += 1
+        if parsed is None:
+            self.ignored += 1
+            return []
+        if isinstance(parsed, GsaSentence):
+            self.gsa = parsed
+            return []
+        fixes = []
+        epoch = self.__epoch
+        if epoch is None or parsed.time != epoch.time:
+            # A new fix. If the last one never got its GGA, it goes out as it is.
+            if epoch is not None and epoch.rmc and not epoch.done:
+                fixes.append(self.__fix(epoch))
+            epoch = self.__epoch = _Epoch(parsed.time, stamp)
+        if isinstance(parsed, RmcSentence):
+            self.rmc = epoch.rmc = parsed
+        else:
+            self.gga = epoch.gga = parsed
+        if epoch.rmc and epoch.gga and not epoch.done:
+            fixes.append(self.__fix(epoch))
+        return fixes
+
+    def __fix(self, epoch):
+        epoch.done = True
+        self.fixes += 1
+        rmc, gga, gsa = epoch.rmc, epoch.gga, self.gsa
+        return GpsFix(epoch.stamp, rmc.date, rmc.time, rmc.valid,
+                      rmc.latitude, rmc.longitude,
+                      gga.altitude if gga else None, gga.geoid_separation if gga else None,
+                      rmc.speed, rmc.course,
+                      gga.quality if gga else None, gga.satellites if gga else None,
+                      gga.hdop if gga and gga.hdop is not None else (gsa.hdop if gsa else None),
+                      gsa.pdop if gsa else None, gsa.vdop if gsa else None,
+                      gsa.fix_type if gsa else None, gsa.prns if gsa else ())
+
+
+def make_sentence(body):
+    # body with the $, checksum and line ending added. For the PMTK commands we send the GPS, and simulators.
+    body = body.encode('ascii')
+    return b'$' + body + "*{0:02X}\r\n".format(checksum(body)).encode('ascii')
+
+
+if __name__ == "__main__":
+    # Parse a few seconds' worth of sentences, some damaged, and see how long it takes.
+    import random
+    from time import perf_counter
+
+    stream = bytearray()
+    for i in range(5000):
+        t = "1200{0:02d}.{1:03d}".format((i // 5) % 60, (i % 5) * 200)
+        stream += make_sentence("GPGGA,{0},3723.4567,N,12224.0000,W,1,09,0.92,{1:.1f},M,-25.6,M,,".format(t, 100 + i / 10))
+        if i % 5 == 0:
+            stream += make_sentence("GPGSA,A,3,05,07,09,13,15,20,28,30,,,,,1.52,0.92,1.21")
+        stream += make_sentence("GPRMC,{0},A,3723.4567,N,12224.0000,W,0.52,91.3,191026,,,A".format(t))
+    damaged = bytearray(stream)
+    rng = random.Random(1)
+    for _ in range(50):
+        damaged[rng.randrange(len(damaged))] ^= 1 << rng.randrange(7)
+
+    for name, data in (("clean", stream), ("damaged", damaged)):
+        parser = NmeaParser()
+        start = perf_counter()
+        fixes = []
+        for offset in range(0, len(data), 64):
+            fixes.extend(parser.feed(data[offset:offset + 64]))
+        elapsed = perf_counter() - start
+        print("{0}: {1} sentences, {2} fixes, errors {3}, {4:.1f}us per sentence".format(
+            name, parser.sentences, parser.fixes, parser.errors, elapsed / max(1, parser.sentences) * 1e6))
+    print(fixes[-1])
+    print(fixes[-1].utc)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# When (and whether) to restart something that keeps failing.
+#
+# Restarting straight away is what made an unplugged Arduino spin a core at 100% and fill
+# the log. A RestartPolicy works out the delay instead:
+#   - Exponential backoff: each failure in a row doubles the delay, up to a maximum, with
+#     some random jitter so things that failed together don't all retry together.
+#   - A maximum restart rate: more than max_restarts within window seconds opens the
+#     circuit breaker, and nothing is tried for open_time seconds.
+#   - After that, one attempt is let through (half open). If it stays up for healthy_after
+#     seconds the breaker closes again and the backoff starts over. If it fails, it's open
+#     again.
+# A run that lasted healthy_after seconds resets the backoff too, so a subsystem that fails
+# once a day restarts quickly every time.
+#
+# It also keeps the numbers: restarts, failures, time spent down, and the breaker state.
+#
+#####################################################################
+
+import random
+import logging
+from collections import deque
+from time import monotonic
+
+# Circuit breaker states.
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half open"
+
+
+class RestartPolicy(object):
+    def __init__(self, name="", base_delay=1, max_delay=60, multiplier=2, jitter=0.2,
+                 max_restarts=10, window=300, open_time=300, healthy_after=60, rng=None):
+        """
+        :param name: For the log.
+        :param base_delay: Seconds to wait after the first failure.
+        :param max_delay: Longest the backoff gets.
+        :param multiplier: How much longer each wait is than the last.
+        :param jitter: Randomly lengthen or shorten each wait by up to this fraction.
+        :param max_restarts: Open the breaker after more than this many restarts ...
+        :param window: ... in this many seconds.
+        :param open_time: Seconds the breaker stays open.
+        :param healthy_after: Running this long counts as having recovered.
+        :param rng: random.Random to use for the jitter (for repeatable tests).
+        """
+        self.name = name
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_restarts = max_restarts
+        self.window = window
+        self.open_time = open_time
+        self.healthy_after = healthy_after
+        self.__random = rng or random.Random()
+        self.__state = STATE_CLOSED
+        self.__recent = deque()
+        self.__started = None
+        self.__down_since = None
+        self.consecutive_failures = 0
+        # Stats
+        self.starts = 0
+        self.restarts = 0
+        self.failures = 0
+        self.breaker_trips = 0
+        self.downtime = 0.0
+
+    @property
+    def state(self):
+        # A half open run that's lasted long enough closes the breaker.
+        if self.__state == STATE_HALF_OPEN and self.uptime is not None and self.uptime >= self.healthy_after:
+            logging.info("Restart policy: {0} has recovered. Closing the breaker.".format(self.name))
+            self.__state = STATE_CLOSED
+            self.consecutive_failures = 0
+        return self.__state
+
+    @property
+    def running(self):
+        return self.__started is not None
+
+    @property
+    def uptime(self):
+        return monotonic() - self.__started if self.__started is not None else None
+
+    @property
+    def total_downtime(self):
+        # Including the time it's been down right now.
+        current = monotonic() - self.__down_since if self.__down_since is not None else 0.0
+        return self.downtime + current
+
+    def started(self):
+        now = monotonic()
+        if self.__down_since is not None:
+            self.downtime += now - self.__down_since
+            self.__down_since = None
+        if self.starts:
+            self.restarts += 1
+        self.starts += 1
+        self.__started = now
+        if self.__state == STATE_OPEN:
+            self.__state = STATE_HALF_OPEN
+
+    def stopped(self, failed=True):
+        """
+        The thing stopped (or failed to start).
+        :return: Seconds to wait before starting it again.
+        """
+        now = monotonic()
+        uptime = now - self.__started if self.__started is not None else 0
+        # Make sure a half open run that made it gets counted as closed first.
+        state = self.state
+        self.__started = None
+        self.__down_since = now
+        if failed:
+            self.failures += 1
+        if uptime >= self.healthy_after:
+            self.consecutive_failures = 0
+        self.consecutive_failures += 1
+
+        self.__recent.append(now)
+        while self.__recent and self.__recent[0] < now - self.window:
+            self.__recent.popleft()
+
+        if state == STATE_HALF_OPEN or len(self.__recent) > self.max_restarts:
+            if state != STATE_OPEN:
+                self.breaker_trips += 1
+            self.__state = STATE_OPEN
+            self.__recent.clear()
+            logging.warning("Restart policy: {0} keeps failing. Waiting {1}s before trying again.".format(
+                self.name, self.open_time))
+            return self.open_time
+
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (self.consecutive_failures - 1))
+        return delay * (1 + self.__random.uniform(-self.jitter, self.jitter))
+
+    def __str__(self):
+        return "{0}: {1}, {2} restart(s), {3} failure(s), {4} trip(s), down {5:.0f}s".format(
+            self.name, self.state, self.restarts, self.failures, self.breaker_trips, self.total_downtime)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Sensor streams at their own rates.
+#
+# In the old one-row-every-700ms loop the sketch waited on the GPS before reading anything
+# else, so the IMU and barometer were read far less often than they could be. In stream mode
+# (the sketch's 'M') each sensor is read on its own schedule and sent as a stream of its own,
+# each sample with the Arduino millis() it was taken at:
+#   'I' IMU: accelerometer, magnetometer, gyro, as often as the sketch's IMU_INTERVAL (50 Hz)
+#   'P' barometer and thermocouple, as fast as the barometer converts (about 1 Hz)
+#   'G' GPS, for each RMC sentence (5 Hz, as the GPS is set up)
+#
+# Each stream is written as it comes, with its own timestamps, to a directory of its own
+# (sensors/imu, sensors/baro, sensors/gps). StreamAligner puts them back together when
+# something wants a whole row: the value of every field at a given time, interpolated
+# between the samples either side of it (or the last one, if it's recent enough).
+#
+#####################################################################
+
+import os
+import logging
+from time import monotonic
+from datetime import datetime
+from collections import deque, namedtuple
+from HighaltHardware.HighaltStorage import SegmentStore
+
+# Stream tags, as sent by the sketch (the frame type of its samples).
+STREAM_IMU = ord('I')
+STREAM_BARO = ord('P')
+STREAM_GPS = ord('G')
+
+ImuSample = namedtuple('ImuSample', ['millis', 'accel_x', 'accel_y', 'accel_z', 'mag_x', 'mag_y', 'mag_z',
+                                     'gyro_x', 'gyro_y', 'gyro_z', 'lsm_temp'])
+BaroSample = namedtuple('BaroSample', ['millis', 'pressure', 'baro_altitude', 'baro_temp', 'k_temp'])
+
+
+class GpsSample (namedtuple('GpsSample', ['millis', 'gps_date', 'gps_time', 'gps_fix', 'latitude', 'longitude',
+                                          'speed', 'angle', 'gps_altitude'])):
+    __slots__ = ()
+
+    @property
+    def has_fix(self):
+        return bool(self.gps_fix) and self.latitude is not None and self.longitude is not None
+
+    @classmethod
+    def from_fix(cls, fix, millis):
+        # From one of NmeaParser's GpsFixes, with the date and time written the way the sketch does them.
+        gps_date = "{0}/{1}/{2}".format(fix.date.year, fix.date.month, fix.date.day) if fix.date else None
+        gps_time = None
+        if fix.time is not None:
+            hours, rest = divmod(int(round(fix.time * 1000)), 3600000)
+            minutes, rest = divmod(rest, 60000)
+            gps_time = "{0}:{1}:{2}.{3:03d}".format(hours, minutes, rest // 1000, rest % 1000)
+        if not fix.has_fix:
+            return cls(millis, gps_date, gps_time, 0.0, None, None, None, None, None)
+        return cls(millis, gps_date, gps_time, 1.0, fix.latitude, fix.longitude, fix.speed, fix.course, fix.altitude)
+
+
+STREAM_TYPES = {STREAM_IMU: ImuSample, STREAM_BARO: BaroSample, STREAM_GPS: GpsSample}
+STREAM_NAMES = {STREAM_IMU: 'imu', STREAM_BARO: 'baro', STREAM_GPS: 'gps'}
+# Type -> tag, to tell where a sample came from.
+STREAM_OF = {sample_type: stream for stream, sample_type in STREAM_TYPES.items()}
+
+# Taken from the sample before, never interpolated.
+HOLD_FIELDS = ('gps_date', 'gps_time', 'gps_fix')
+
+# How long (in ms) a stream's last sample still counts, if there's nothing newer.
+MAX_GAP = {STREAM_IMU: 500, STREAM_BARO: 3000, STREAM_GPS: 2000}
+
+
+def format_row(values):
+    # A CSV line like the sketch's text ones: blanks for None, no ".0" on whole numbers.
+    return ",".join("" if v is None else (str(int(v)) if isinstance(v, float) and v.is_integer() else str(v))
+                    for v in values)
+
+
+#################
+# Putting the streams back together
+#################
+class StreamAligner(object):
+    def __init__(self, window=5000, max_gap=None):
+        """
+        :param window: How much of each stream to keep, in ms.
+        :param max_gap: Stream -> ms its last sample counts for. Defaults to MAX_GAP.
+        """
+        self.window = window
+        self.max_gap = dict(MAX_GAP)
+        if max_gap:
+            self.max_gap.update(max_gap)
+        self.__samples = {}
+
+    def clear(self):
+        # The Arduino was reset, so millis() has started over.
+        self.__samples.clear()
+
+    def add(self, stream, sample):
+        samples = self.__samples.get(stream)
+        if samples is None:
+            samples = self.__samples[stream] = deque()
+        samples.append(sample)
+        while samples[0].millis < sample.millis - self.window:
+            samples.popleft()
+
+    def latest(self, stream):
+        samples = self.__samples.get(stream)
+        return samples[-1] if samples else None
+
+    def at(self, stream, millis):
+        """
+        The stream's fields at millis, as a dict. Empty if there's nothing close enough.
+        :rtype : dict
+        """
+        samples = self.__samples.get(stream)
+        if not samples:
+            return {}
+        # Usually wanted near the end, so look from there.
+        after = None
+        for sample in reversed(samples):
+            if sample.millis <= millis:
+                break
+            after = sample
+        else:
+            sample = None
+        gap = self.max_gap.get(stream, 0)
+        if sample is None:
+            return after._asdict() if after.millis - millis <= gap else {}
+        if after is None:
+            return sample._asdict() if millis - sample.millis <= gap else {}
+        fraction = (millis - sample.millis) / (after.millis - sample.millis)
+        values = sample._asdict()
+        for name, before_value, after_value in zip(sample._fields, sample, after):
+            if name not in HOLD_FIELDS and before_value is not None and after_value is not None:
+                values[name] = before_value + (after_value - before_value) * fraction
+        return values
+
+    def aligned(self, millis, record_type):
+        """
+        A record_type (a namedtuple, like SensorRecord) with every stream's fields at millis.
+        Fields nothing has a value for are None.
+        """
+        values = {}
+        for stream in self.__samples:
+            values.update(self.at(stream, millis))
+        values['millis'] = millis
+        return record_type(*[values.get(name) for name in record_type._fields])
+
+
+#################
+# Writing the streams out
+#################
+class StreamFiles(object):
+    def __init__(self, directory, samples_per_file=3000, flush_interval=1.0, histogram=None):
+        """
+        One directory of CSV segments per stream, under directory.
+        :param samples_per_file: Start a new file after this many samples.
+        :param flush_interval: Seconds between flushes. At 50 Hz, flushing every line adds up.
+        :param histogram: LatencyHistogram to record the write times in.
+        """
+        self.directory = directory
+        self.samples_per_file = samples_per_file
+        self.flush_interval = flush_interval
+        self.__histogram = histogram
+        self.__stores = {}
+        # stream name -> [file, lines in it]
+        self.__files = {}
+        self.__last_flush = monotonic()
+        self.samples = {}
+
+    def write(self, stream, sample):
+        self.write_row(STREAM_NAMES.get(stream, chr(stream)), sample)
+
+    def write_row(self, name, row):
+        # Any namedtuple, into name's CSV files. For streams worked out from the others.
+        self.__write(name, format_row(row), ".csv", ",".join(row._fields))
+
+    def write_text(self, name, line, extension):
+        # A line of something that isn't a sample (the GPS's own sentences, say), as it is.
+        self.__write(name, line, extension, None)
+
+    def __write(self, name, line, extension, header):
+        current = self.__files.get(name)
+        if current is None or current[1] >= self.samples_per_file:
+            if current is not None:
+                current[0].close()
+            current = self.__files[name] = [self.__open(name, extension, header), 0]
+        current[0].write(line)
+        current[0].write("\n")
+        current[1] += 1
+        self.samples[name] = self.samples.get(name, 0) + 1
+        if monotonic() - self.__last_flush >= self.flush_interval:
+            self.flush()
+
+    def __open(self, name, extension, header):
+        store = self.__stores.get(name)
+        if store is None:
+            store = self.__stores[name] = SegmentStore(os.path.join(self.directory, name),
+                                                       self.samples_per_file * 100, "Streams", self.__histogram)
+        f = store.open_segment(datetime.today().strftime('%Y%m%d.%H%M%S') + extension)
+        if header:
+            f.write(header)
+            f.write("\n")
+        return f
+
+    def flush(self):
+        self.__last_flush = monotonic()
+        for f, _ in self.__files.values():
+            f.flush()
+
+    def close(self):
+        for f, count in self.__files.values():
+            f.close()
+        self.__files.clear()
+        if self.samples:
+            logging.info("Streams: Samples written: {0}".format(
+                ", ".join("{0} {1}".format(name, count) for name, count in sorted(self.samples.items()))))
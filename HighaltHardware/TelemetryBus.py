@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# In-process telemetry bus.
+#
+# Producers (the Arduino reader, the FONA status cache, the camera) publish records under a
+# topic. Consumers either:
+#   - read the latest value of a topic, which is a single dict lookup, or
+#   - subscribe, and get a bounded queue of their own. If a consumer falls behind, the
+#     oldest records are dropped (and counted) rather than the producer being held up, or
+#   - listen, and have a callback run for each record as it's published.
+#
+# Publishing doesn't take a lock. Everything it touches (a dict entry replaced whole, a
+# deque with a maxlen) is safe to use from more than one thread as is, so a producer on a
+# worker thread (the camera, the FONA's serial thread) can publish directly. Listener
+# callbacks run on the publisher's thread, so they should be quick.
+#
+#####################################################################
+
+import logging
+from collections import deque, namedtuple
+from time import monotonic
+
+# Topics, and what gets published under them.
+TOPIC_SENSOR = "sensor"                     # SensorRecord, for each line from the Arduino
+TOPIC_TIMED_SENSOR = "sensor.timed"         # TimedRecord, the same records with their flight time (see FlightClock)
+TOPIC_CAMERA_SEGMENT = "camera.segment"     # CameraSegment, as each video file is finished
+TOPIC_FONA_STATUS = "fona."                 # + status name (fona.battery_state, ...): the parsed value
+TOPIC_GPS = "gps"                           # GpsFix, from the GPS's own sentences (see NmeaParser)
+TOPIC_FLIGHT = "flight"                     # FlightEstimate, for each SensorRecord (see FlightState)
+TOPIC_STREAM = "stream."                    # + stream name (stream.imu, ...): each sample, in stream mode
+
+# A finished video segment.
+CameraSegment = namedtuple('CameraSegment', ['name', 'size', 'seconds'])
+
+# What a value is stored as in the latest value cache.
+Latest = namedtuple('Latest', ['value', 'timestamp', 'sequence'])
+
+
+#################
+# A bounded queue for one consumer
+#################
+class Subscription(object):
+    def __init__(self, topic, maxlen):
+        self.topic = topic
+        self.maxlen = maxlen
+        self.__queue = deque(maxlen=maxlen)
+        # Records that were pushed out before they were read.
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def put(self, value):
+        if len(self.__queue) == self.maxlen:
+            self.dropped += 1
+        self.__queue.append(value)
+
+    def get(self, default=None):
+        # The oldest record that hasn't been read yet.
+        try:
+            return self.__queue.popleft()
+        except IndexError:
+            return default
+
+    def drain(self):
+        """
+        Everything waiting, oldest first.
+        :rtype : list
+        """
+        out = []
+        while True:
+            try:
+                out.append(self.__queue.popleft())
+            except IndexError:
+                return out
+
+
+#################
+# The bus
+#################
+class TelemetryBus(object):
+    def __init__(self):
+        # topic -> Latest
+        self.__latest = {}
+        # topic -> tuple of Subscriptions. Replaced whole when one is added, so publishing
+        # never sees it half changed.
+        self.__subscriptions = {}
+        # topic -> tuple of callbacks
+        self.__listeners = {}
+        # Counts publishes, so a consumer can tell whether the latest value has changed. Only
+        # roughly ordered if more than one thread publishes.
+        self.__sequence = 0
+
+    @property
+    def topics(self):
+        return list(self.__latest)
+
+    def publish(self, topic, value):
+        self.__sequence += 1
+        self.__latest[topic] = Latest(value, monotonic(), self.__sequence)
+        for subscription in self.__subscriptions.get(topic, ()):
+            subscription.put(value)
+        for listener in self.__listeners.get(topic, ()):
+            try:
+                listener(value)
+            except Exception as err:
+                logging.warning("Telemetry bus: Listener on {0} failed: {1!r}".format(topic, err))
+
+    def latest(self, topic, default=None):
+        entry = self.__latest.get(topic)
+        return entry.value if entry else default
+
+    def latest_entry(self, topic):
+        """
+        :rtype : Latest
+        """
+        return self.__latest.get(topic)
+
+    def age(self, topic):
+        # Seconds since the topic was last published, or None if it never has been.
+        entry = self.__latest.get(topic)
+        return monotonic() - entry.timestamp if entry else None
+
+    def subscribe(self, topic, maxlen=100):
+        """
+        Get every record published on topic from now on, up to maxlen waiting at once.
+        :rtype : Subscription
+        """
+        subscription = Subscription(topic, maxlen)
+        self.__subscriptions[topic] = self.__subscriptions.get(topic, ()) + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.__subscriptions[subscription.topic] = tuple(s for s in self.__subscriptions.get(subscription.topic, ())
+                                                         if s is not subscription)
+
+    def listen(self, topic, callback):
+        """
+        Call callback(value) for every record published on topic, on the publisher's thread.
+        """
+        self.__listeners[topic] = self.__listeners.get(topic, ()) + (callback,)
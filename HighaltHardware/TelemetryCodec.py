@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# Compact telemetry for text message replies.
+#
+# A text message is 140 characters and every round trip is slow (and costs money), so
+# rather than "lat, lon" we pack as many recent fixes as will fit, plus altitude, vertical
+# rate, temperature, battery and flight phase, into one message.
+#
+# Numbers are fixed point integers. The first fix is sent whole, the older ones as the
+# difference from the fix before them, which keeps them small. Each integer is zigzag
+# encoded (so small negatives stay small) and written as base-32 digits, least significant
+# first, using a 64 character alphabet: the first 32 characters are a final digit, the
+# other 32 mean "more digits follow". Everything in the alphabet is in the GSM 03.38 basic
+# character set, so it goes through as a normal text.
+#
+# Layout (after the "HA" + version prefix):
+#   flags                       which of altitude/vrate/temp/battery/phase are present
+#   fix count
+#   time, lat, lon              newest fix: seconds since midnight UTC, degrees * 1e5
+#   dtime, dlat, dlon           each older fix, relative to the one before it
+#   altitude                    metres
+#   vertical rate               0.1 m/s
+#   temperature                 0.1 C
+#   battery                     percent
+#   flight phase                index into FlightState.PHASES (last, so older decoders just
+#                               don't read it)
+#
+# decode_telemetry() undoes it. telemetry_decode.py is a command line wrapper for the
+# ground team.
+#
+#####################################################################
+
+from HighaltHardware.FlightState import PHASES
+
+ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+/"
+DIGIT_BASE = 32
+PREFIX = "HA"
+VERSION = 1
+
+# Longest text message we'll send.
+MAX_LENGTH = 140
+
+# Fixed point scales.
+COORD_SCALE = 100000
+VRATE_SCALE = 10
+TEMP_SCALE = 10
+
+# Bits in the flags value.
+HAS_ALTITUDE = 1
+HAS_VRATE = 2
+HAS_TEMP = 4
+HAS_BATTERY = 8
+HAS_PHASE = 16
+
+_decode_table = dict((c, i) for i, c in enumerate(ALPHABET))
+
+
+def encode_int(value):
+    # Zigzag: 0, -1, 1, -2, 2 ... -> 0, 1, 2, 3, 4 ...
+    n = (value << 1) if value >= 0 else ((-value << 1) - 1)
+    out = []
+    while n >= DIGIT_BASE:
+        out.append(ALPHABET[DIGIT_BASE + (n % DIGIT_BASE)])
+        n //= DIGIT_BASE
+    out.append(ALPHABET[n])
+    return "".join(out)
+
+
+def decode_ints(text):
+    """
+    Turn a run of encoded integers back into a list of ints.
+    """
+    values = []
+    n = 0
+    shift = 1
+    for c in text:
+        digit = _decode_table[c]
+        if digit >= DIGIT_BASE:
+            n += (digit - DIGIT_BASE) * shift
+            shift *= DIGIT_BASE
+        else:
+            n += digit * shift
+            values.append((n >> 1) if not n & 1 else -((n + 1) >> 1))
+            n = 0
+            shift = 1
+    if shift != 1:
+        raise ValueError("Telemetry ends in the middle of a number.")
+    return values
+
+
+# Metres per second, from the oldest and newest records that have an altitude.
+def vertical_rate(records):
+    usable = [r for r in records if r.altitude is not None and r.millis is not None]
+    if len(usable) < 2 or usable[-1].millis <= usable[0].millis:
+        return None
+    return (usable[-1].altitude - usable[0].altitude) / ((usable[-1].millis - usable[0].millis) / 1000.0)
+
+
+def encode_telemetry(records, battery_percent=None, vrate=None, max_length=MAX_LENGTH, altitude=None, phase=None):
+    """
+    Pack recent SensorRecords into a single text message.
+    :param records: SensorRecords, oldest first (like ArduinoReader.recent_records()).
+    :param battery_percent: FONA battery charge, if known.
+    :param vrate: Vertical rate in m/s. Worked out from the records if not given.
+    :param max_length: The message won't be longer than this.
+    :param altitude: Altitude in metres (the FlightEstimate's, say). The latest record's if not given.
+    :param phase: Flight phase (one of FlightState.PHASES), if known.
+    :rtype : str
+    """
+    latest = records[-1] if records else None
+    if vrate is None:
+        vrate = vertical_rate(records)
+    if altitude is None and latest is not None:
+        altitude = latest.altitude
+
+    flags = 0
+    tail = []
+    if altitude is not None:
+        flags |= HAS_ALTITUDE
+        tail.append(encode_int(int(round(altitude))))
+    if vrate is not None:
+        flags |= HAS_VRATE
+        tail.append(encode_int(int(round(vrate * VRATE_SCALE))))
+    if latest is not None and latest.temperature is not None:
+        flags |= HAS_TEMP
+        tail.append(encode_int(int(round(latest.temperature * TEMP_SCALE))))
+    if battery_percent is not None:
+        flags |= HAS_BATTERY
+        tail.append(encode_int(int(battery_percent)))
+    if phase in PHASES:
+        flags |= HAS_PHASE
+        tail.append(encode_int(PHASES.index(phase)))
+    tail = "".join(tail)
+
+    # Newest fix first, then as many older ones as there's room for.
+    fixes = []
+    previous = None
+    for record in reversed(records):
+        if not record.has_fix or record.gps_seconds is None:
+            continue
+        current = (int(round(record.gps_seconds)),
+                   int(round(record.latitude * COORD_SCALE)),
+                   int(round(record.longitude * COORD_SCALE)))
+        # Several records can share the same fix. Only send it once.
+        if current == previous:
+            continue
+        if previous is None:
+            encoded = "".join(encode_int(v) for v in current)
+        else:
+            # Going back in time, so the time difference is positive (apart from midnight).
+            encoded = "".join(encode_int(p - c) for p, c in zip(previous, current))
+        fixes.append(encoded)
+        previous = current
+
+    while True:
+        body = encode_int(flags) + encode_int(len(fixes)) + "".join(fixes) + tail
+        message = PREFIX + ALPHABET[VERSION] + body
+        if len(message) <= max_length or not fixes:
+            return message
+        fixes.pop()
+
+
+def decode_telemetry(message):
+    """
+    Unpack a message from encode_telemetry().
+    :return: dict with 'fixes' (a list of (seconds since midnight UTC, lat, lon), newest first),
+             and 'altitude', 'vertical_rate', 'temperature', 'battery' and 'phase' (None if not sent).
+    """
+    message = message.strip()
+    if not message.startswith(PREFIX) or len(message) < len(PREFIX) + 1:
+        raise ValueError("Not a telemetry message.")
+    version = _decode_table.get(message[len(PREFIX)])
+    if version != VERSION:
+        raise ValueError("Unknown telemetry version: {0}".format(version))
+
+    values = decode_ints(message[len(PREFIX) + 1:])
+    flags, count = values[0], values[1]
+    position = 2
+    fixes = []
+    for i in range(count):
+        t, lat, lon = values[position:position + 3]
+        position += 3
+        if fixes:
+            # Stored as the difference from the newer fix.
+            t, lat, lon = previous[0] - t, previous[1] - lat, previous[2] - lon
+        previous = (t, lat, lon)
+        fixes.append((t % 86400, lat / COORD_SCALE, lon / COORD_SCALE))
+
+    result = dict(fixes=fixes, altitude=None, vertical_rate=None, temperature=None, battery=None, phase=None)
+    for flag, name, scale in ((HAS_ALTITUDE, 'altitude', 1),
+                              (HAS_VRATE, 'vertical_rate', VRATE_SCALE),
+                              (HAS_TEMP, 'temperature', TEMP_SCALE),
+                              (HAS_BATTERY, 'battery', 1)):
+        if flags & flag:
+            result[name] = values[position] / scale if scale != 1 else values[position]
+            position += 1
+    if flags & HAS_PHASE:
+        phase = values[position]
+        result['phase'] = PHASES[phase] if 0 <= phase < len(PHASES) else str(phase)
+    return result
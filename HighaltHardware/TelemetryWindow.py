@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+#####################################################################
+#
+# The last few hours of telemetry, in memory.
+#
+# "Highest altitude in the last 10 minutes" or "average temperature since burst" shouldn't
+# mean reading CSV files back off the SD card. TelemetryWindows keeps recent records in a
+# ring, a column at a time, in arrays that are all allocated up front: max_bytes is all it
+# will ever use, and when the ring is full the oldest record goes.
+#
+# For each of WINDOWS (the last minute, 10 minutes and hour) it keeps, as records come and go:
+#   - a running sum and count of each column, for the mean;
+#   - the min and max, from a monotonic queue of each column: the records that are bigger
+#     (or smaller) than every record after them. The oldest of those still in the window is
+#     the max. Each column has one queue for each direction, in a ring of its own, and every
+#     window only keeps where it starts in it (the longer windows' queues are the shorter
+#     ones' with more in front).
+# Adding a record and asking for any of those is a few operations per column, whatever the
+# length of the window. Other lengths work too, by going through the ring.
+#
+# marks keep the same for everything since something happened: each change of flight phase
+# (from the FlightMonitor, on TOPIC_FLIGHT) is marked, so "since burst" is since('burst').
+#
+# Times are flight times (see FlightClock) when the records come with them, otherwise when
+# they came in. "The last 10 minutes" is the 10 minutes before the latest record.
+#
+#####################################################################
+
+import math
+import logging
+from array import array
+from time import monotonic
+from collections import namedtuple
+from HighaltHardware.TelemetryBus import TOPIC_SENSOR, TOPIC_TIMED_SENSOR, TOPIC_FLIGHT
+
+# What's kept of each record. Anything a SensorRecord has, properties (altitude, temperature) included.
+WINDOW_COLUMNS = ('altitude', 'temperature', 'pressure', 'baro_altitude', 'gps_altitude', 'k_temp', 'baro_temp',
+                  'lsm_temp', 'speed', 'accel_z')
+# Seconds. Min, max and mean over these are kept up to date.
+WINDOWS = (60, 600, 3600)
+# 4MB is about 17000 records of the columns above, or over three hours of rows.
+MAX_BYTES = 4 * 1024 * 1024
+
+WindowStats = namedtuple('WindowStats', ['count', 'mean', 'min', 'max'])
+NO_STATS = WindowStats(0, None, None, None)
+
+
+class _Extremes(object):
+    # A monotonic queue of record numbers, in a ring as long as the store's.
+    __slots__ = ('seqs', 'size', 'start', 'end', 'largest')
+
+    def __init__(self, size, largest):
+        self.seqs = array('q', bytes(8 * size))
+        self.size = size
+        # Positions, counted from the first record ever, so they never wrap. end is one past the last.
+        self.start = 0
+        self.end = 0
+        self.largest = largest
+
+    def push(self, seq, value, values):
+        # Everything this one beats can never be the min (or max) again.
+        seqs, size = self.seqs, self.size
+        if self.largest:
+            while self.end > self.start and values[seqs[(self.end - 1) % size] % size] <= value:
+                self.end -= 1
+        else:
+            while self.end > self.start and values[seqs[(self.end - 1) % size] % size] >= value:
+                self.end -= 1
+        seqs[self.end % size] = seq
+        self.end += 1
+
+    def expire(self, oldest):
+        # Drop the records that are out of the ring.
+        seqs, size = self.seqs, self.size
+        while self.start < self.end and seqs[self.start % size] < oldest:
+            self.start += 1
+
+
+class _Window(object):
+    def __init__(self, seconds, columns):
+        self.seconds = seconds
+        # The first record in the window.
+        self.first = 0
+        self.sums = [0.0] * columns
+        self.counts = [0] * columns
+        # Where the window starts in each column's max and min queues.
+        self.max_heads = [0] * columns
+        self.min_heads = [0] * columns
+
+
+class _Mark(object):
+    def __init__(self, time, sums, counts, columns):
+        self.time = time
+        self.sums = list(sums)
+        self.counts = list(counts)
+        self.mins = [None] * columns
+        self.maxes = [None] * columns
+
+
+class TelemetryWindows(object):
+    def __init__(self, columns=WINDOW_COLUMNS, windows=WINDOWS, max_bytes=MAX_BYTES):
+        """
+        :param columns: Record attributes to keep.
+        :param windows: Window lengths (seconds) to keep the min, max and mean of as records come in.
+        :param max_bytes: How much the ring and queues can take up. They're allocated now.
+        """
+        self.columns = tuple(columns)
+        self.__index = {name: i for i, name in enumerate(self.columns)}
+        # A time and a value for each column per record, and a place in both queues for each column.
+        self.capacity = max(2, max_bytes // (8 * (1 + 3 * len(self.columns))))
+        self.__times = array('d', bytes(8 * self.capacity))
+        self.__values = [array('d', bytes(8 * self.capacity)) for _ in self.columns]
+        self.__maxes = [_Extremes(self.capacity, True) for _ in self.columns]
+        self.__mins = [_Extremes(self.capacity, False) for _ in self.columns]
+        self.__windows = {seconds: _Window(seconds, len(self.columns)) for seconds in windows}
+        # Since the start, for the marks.
+        self.__sums = [0.0] * len(self.columns)
+        self.__counts = [0] * len(self.columns)
+        self.marks = {}
+        self.__phase = None
+        # Records added, ever. The next one's number.
+        self.__next = 0
+        self.latest_time = None
+
+    def __len__(self):
+        return min(self.__next, self.capacity)
+
+    @property
+    def oldest_time(self):
+        if not self.__next:
+            return None
+        return self.__times[max(0, self.__next - self.capacity) % self.capacity]
+
+    #################
+    # In
+    #################
+    def add(self, time, record):
+        """
+        :param time: When the record was taken, in seconds. Never less than the last one's.
+        :param record: Anything with the columns as attributes (None for missing).
+        """
+        seq = self.__next
+        slot = seq % self.capacity
+        oldest = max(0, seq + 1 - self.capacity)
+        if seq >= self.capacity:
+            # The record in this slot is about to go. Out of the windows first, while it's still there.
+            for window in self.__windows.values():
+                self.__advance(window, oldest, None)
+            for extremes in self.__maxes:
+                extremes.expire(oldest)
+            for extremes in self.__mins:
+                extremes.expire(oldest)
+        self.__times[slot] = time
+        self.latest_time = time
+        sums, counts = self.__sums, self.__counts
+        marks = self.marks.values()
+        for i, name in enumerate(self.columns):
+            value = getattr(record, name, None)
+            values = self.__values[i]
+            if value is None or value != value:
+                values[slot] = math.nan
+                continue
+            values[slot] = value
+            sums[i] += value
+            counts[i] += 1
+            self.__maxes[i].push(seq, value, values)
+            self.__mins[i].push(seq, value, values)
+            for window in self.__windows.values():
+                window.sums[i] += value
+                window.counts[i] += 1
+            for mark in marks:
+                if mark.mins[i] is None or value < mark.mins[i]:
+                    mark.mins[i] = value
+                if mark.maxes[i] is None or value > mark.maxes[i]:
+                    mark.maxes[i] = value
+        self.__next = seq + 1
+        for window in self.__windows.values():
+            self.__advance(window, oldest, time - window.seconds)
+
+    def __advance(self, window, oldest, cutoff):
+        # Move the window's start past records that are too old (or leaving the ring).
+        times, size = self.__times, self.capacity
+        first = window.first
+        while first < self.__next and (first < oldest or (cutoff is not None and times[first % size] < cutoff)):
+            slot = first % size
+            for i, values in enumerate(self.__values):
+                value = values[slot]
+                if value == value:
+                    window.sums[i] -= value
+                    window.counts[i] -= 1
+            first += 1
+        window.first = first
+        for heads, queues in ((window.max_heads, self.__maxes), (window.min_heads, self.__mins)):
+            for i, extremes in enumerate(queues):
+                head = min(max(heads[i], extremes.start), extremes.end)
+                # Anything that pushed the queue back past the head is in the window, so that's where it starts now.
+                if head == extremes.end and extremes.end > extremes.start and \
+                        extremes.seqs[(extremes.end - 1) % size] >= first:
+                    head = extremes.end - 1
+                while head < extremes.end and extremes.seqs[head % size] < first:
+                    head += 1
+                heads[i] = head
+
+    def mark(self, name):
+        # From now on, since(name) is everything after the latest record.
+        self.marks[name] = _Mark(self.latest_time, self.__sums, self.__counts, len(self.columns))
+
+    def listen(self, bus, timed=True):
+        """
+        Take records off bus: TimedRecords (TOPIC_TIMED_SENSOR), or SensorRecords stamped when they
+        come in. Flight phase changes (TOPIC_FLIGHT) are marked.
+        """
+        if timed:
+            bus.listen(TOPIC_TIMED_SENSOR, lambda timed_record: self.add(timed_record.flight_time, timed_record.record))
+        else:
+            bus.listen(TOPIC_SENSOR, lambda record: self.add(monotonic(), record))
+        bus.listen(TOPIC_FLIGHT, self.__on_flight)
+
+    def __on_flight(self, estimate):
+        if estimate.phase != self.__phase:
+            if self.__phase is not None:
+                self.mark(estimate.phase)
+            self.__phase = estimate.phase
+
+    #################
+    # Out
+    #################
+    def stats(self, column, seconds):
+        """
+        The count, mean, min and max of column over the last seconds (up to what's in the ring).
+        Quick for the WINDOWS, a pass through the ring for anything else.
+        :rtype : WindowStats
+        """
+        i = self.__index[column]
+        window = self.__windows.get(seconds)
+        if window is None:
+            return self.__scan(i, seconds)
+        count = window.counts[i]
+        if not count:
+            return NO_STATS
+        values, size = self.__values[i], self.capacity
+        high, low = self.__maxes[i], self.__mins[i]
+        return WindowStats(count, window.sums[i] / count,
+                           values[low.seqs[window.min_heads[i] % size] % size],
+                           values[high.seqs[window.max_heads[i] % size] % size])
+
+    def since(self, name, column):
+        """
+        The count, mean, min and max of column since mark(name), or None if there's no such mark.
+        :rtype : WindowStats
+        """
+        mark = self.marks.get(name)
+        if mark is None:
+            return None
+        i = self.__index[column]
+        count = self.__counts[i] - mark.counts[i]
+        if not count:
+            return NO_STATS
+        return WindowStats(count, (self.__sums[i] - mark.sums[i]) / count, mark.mins[i], mark.maxes[i])
+
+    def rows(self, seconds):
+        # How many records came in over the last seconds.
+        if not self.__next:
+            return 0
+        window = self.__windows.get(seconds)
+        if window is not None:
+            return self.__next - window.first
+        cutoff = self.latest_time - seconds
+        times, size = self.__times, self.capacity
+        seq = self.__next - 1
+        while seq >= max(0, self.__next - size) and times[seq % size] >= cutoff:
+            seq -= 1
+        return self.__next - 1 - seq
+
+    def __scan(self, i, seconds):
+        values, size = self.__values[i], self.capacity
+        count, total, low, high = 0, 0.0, None, None
+        for seq in range(self.__next - self.rows(seconds), self.__next):
+            value = values[seq % size]
+            if value == value:
+                count += 1
+                total += value
+                low = value if low is None or value < low else low
+                high = value if high is None or value > high else high
+        return WindowStats(count, total / count, low, high) if count else NO_STATS
+
+    def summary(self, key=600):
+        """
+        A text message's worth: altitude and temperature over the last key seconds, or since the mark
+        key (a flight phase) if it's a name.
+        """
+        if isinstance(key, str):
+            if key not in self.marks:
+                return "No {0} yet.".format(key)
+            stats = lambda column: self.since(key, column)
+            label = "Since {0}".format(key)
+        else:
+            stats = lambda column: self.stats(column, key)
+            label = "Last {0}min".format(int(key // 60)) if key >= 60 else "Last {0}s".format(int(key))
+        altitude, temperature = stats('altitude'), stats('temperature')
+        parts = [label + ":"]
+        if altitude.count:
+            parts.append("alt {0:.0f}-{1:.0f}m avg {2:.0f}m,".format(altitude.min, altitude.max, altitude.mean))
+        if temperature.count:
+            parts.append("temp {0:.1f} to {1:.1f}C avg {2:.1f}C,".format(temperature.min, temperature.max,
+                                                                        temperature.mean))
+        parts.append("{0} rows".format(max(altitude.count, temperature.count)))
+        return " ".join(parts)
+
+    def register_metrics(self, metrics):
+        def per_window(column, field):
+            return lambda: {"{0}s".format(s): getattr(self.stats(column, s), field) for s in self.__windows}
+        metrics.gauge("window_rows", "Records in each window (how fast they're coming in).",
+                      lambda: {"{0}s".format(s): self.rows(s) for s in self.__windows}, label="window")
+        metrics.gauge("window_altitude_max_meters", "Highest altitude in each window.",
+                      per_window('altitude', 'max'), label="window")
+        metrics.gauge("window_temperature_min_celsius", "Lowest temperature in each window.",
+                      per_window('temperature', 'min'), label="window")
+        metrics.gauge("window_temperature_mean_celsius", "Average temperature in each window.",
+                      per_window('temperature', 'mean'), label="window")
+        metrics.gauge("window_capacity_records", "How many records the ring holds.", lambda: self.capacity)
+
+    def log_summary(self):
+        logging.info("Windows: {0} records, {1}".format(len(self), self.summary(max(self.__windows))))
+
+
+if __name__ == "__main__":
+    # Check the windows against going through the records, and time them.
+    import random
+    from time import perf_counter
+
+    Row = namedtuple('Row', WINDOW_COLUMNS)
+    rng = random.Random(1)
+    store = TelemetryWindows(max_bytes=512 * 1024)
+    rows = []
+    start = perf_counter()
+    for n in range(20000):
+        t = n * 0.7
+        altitude = 5.0 * t + rng.gauss(0, 5) if t < 6000 else max(300.0, 30000 - 20 * (t - 6000))
+        row = Row(*[altitude, -40 + rng.gauss(0, 3)] + [rng.gauss(0, 1) if rng.random() > 0.1 else None
+                                                        for _ in WINDOW_COLUMNS[2:]])
+        store.add(t, row)
+        if n == 8000:
+            store.mark('burst')
+        rows.append((t, row))
+    elapsed = perf_counter() - start
+    print("{0} records, ring of {1}, {2:.1f}us per record".format(len(rows), store.capacity,
+                                                                  elapsed / len(rows) * 1e6))
+    kept = rows[-store.capacity:]
+    for seconds in WINDOWS + (300,):
+        for column in ('altitude', 'temperature', 'speed'):
+            values = [getattr(row, column) for t, row in kept if t >= rows[-1][0] - seconds
+                      and getattr(row, column) is not None]
+            expected = WindowStats(len(values), sum(values) / len(values), min(values), max(values))
+            got = store.stats(column, seconds)
+            assert got.count == expected.count and got.min == expected.min and got.max == expected.max and \
+                abs(got.mean - expected.mean) < 1e-6, (seconds, column, got, expected)
+    print(store.summary(600))
+    print(store.summary('burst'))
@@ -14,6 +14,7 @@
   Includes
 */
 #include <avr/pgmspace.h>
+#include <util/crc16.h>
 
 #include <SPI.h>
 
@@ -59,6 +60,120 @@ const double badTemp = -3.14E03;
 // How we're going to control how often we actually querry data.
 uint32_t timer = millis();
 
+/*
+  Binary protocol. See HighaltHardware/ArduinoProtocol.py for the other end.
+  If the first thing the Pi sends is a 'B', each row goes out as a frame instead of text:
+  COBS(type, payload, CRC16 low, CRC16 high) then a zero. About 60 bytes instead of 150,
+  and the Pi can tell when one's been damaged.
+  If it's an 'M', each sensor gets a stream of its own instead, read as often as it can be
+  (see HighaltHardware/SensorStreams.py):
+    'I' IMU, every IMU_INTERVAL_MS
+    'P' barometer and thermocouple, each time the barometer finishes an altitude reading
+    'G' GPS, each time an RMC sentence comes in
+  Nothing in that loop waits on a sensor.
+  'N' is the same, except the GPS's sentences are forwarded as they are (frame 'N': millis()
+  when the $ came in, then the sentence) for the Pi to parse, instead of the 'G' stream.
+*/
+#define PROTOCOL_VERSION 2
+#define FRAME_SCHEMA 'S'
+#define FRAME_RECORD 'R'
+#define FRAME_NMEA 'N'
+#define STREAM_IMU 'I'
+#define STREAM_BARO 'P'
+#define STREAM_GPS 'G'
+#define IMU_INTERVAL_MS 20
+// The biggest payload: millis() and the longest NMEA sentence.
+#define MAX_PAYLOAD 96
+bool binary = false;
+bool streams = false;
+bool nmea = false;
+// RMC and GGA with every fix, GSA with every fifth (once a second). All of them every time is more
+// than 9600 baud can carry at 5 Hz.
+#define PMTK_SET_NMEA_OUTPUT_RMCGGAGSA "$PMTK314,0,1,0,1,5,0,0,0,0,0,0,0,0,0,0,0,0,0,0*2D"
+
+// One entry per field of SensorFrame, in order: name:struct type:scale. The value sent is the
+// real value times scale. Sent at startup, one frame per field.
+const char SCHEMA[] PROGMEM =
+  "millis:I:1,gps_year:B:1,gps_month:B:1,gps_day:B:1,gps_hour:B:1,gps_minute:B:1,gps_second:B:1,"
+  "gps_millis:H:1,gps_fix:B:1,latitude:i:10000000,longitude:i:10000000,speed:H:100,angle:H:100,"
+  "gps_altitude:i:100,accel_x:h:100,accel_y:h:100,accel_z:h:100,mag_x:h:1000,mag_y:h:1000,mag_z:h:1000,"
+  "gyro_x:h:100,gyro_y:h:100,gyro_z:h:100,lsm_temp:h:100,pressure:I:4,baro_altitude:i:100,baro_temp:h:100,"
+  "k_temp:h:4";
+const uint8_t SCHEMA_FIELDS = 28;
+
+struct __attribute__((packed)) SensorFrame {
+  uint8_t version;
+  uint32_t millis;
+  uint8_t gps_year, gps_month, gps_day, gps_hour, gps_minute, gps_second;
+  uint16_t gps_millis;
+  uint8_t gps_fix;
+  int32_t latitude, longitude;   // degrees * 1e7
+  uint16_t speed, angle;         // knots, degrees * 100
+  int32_t gps_altitude;          // cm
+  int16_t accel[3];              // m/s^2 * 100
+  int16_t mag[3];                // gauss * 1000
+  int16_t gyro[3];               // dps * 100
+  int16_t lsm_temp;              // C * 100
+  uint32_t pressure;             // Pa * 4
+  int32_t baro_altitude;         // cm
+  int16_t baro_temp;             // C * 100
+  int16_t k_temp;                // C * 4
+};
+SensorFrame frame;
+
+// The streams' schemas and frames. Same units as SensorFrame.
+const char IMU_SCHEMA[] PROGMEM =
+  "millis:I:1,accel_x:h:100,accel_y:h:100,accel_z:h:100,mag_x:h:1000,mag_y:h:1000,mag_z:h:1000,"
+  "gyro_x:h:100,gyro_y:h:100,gyro_z:h:100,lsm_temp:h:100";
+const uint8_t IMU_FIELDS = 11;
+const char BARO_SCHEMA[] PROGMEM =
+  "millis:I:1,pressure:I:4,baro_altitude:i:100,baro_temp:h:100,k_temp:h:4";
+const uint8_t BARO_FIELDS = 5;
+const char GPS_SCHEMA[] PROGMEM =
+  "millis:I:1,gps_year:B:1,gps_month:B:1,gps_day:B:1,gps_hour:B:1,gps_minute:B:1,gps_second:B:1,"
+  "gps_millis:H:1,gps_fix:B:1,latitude:i:10000000,longitude:i:10000000,speed:H:100,angle:H:100,"
+  "gps_altitude:i:100";
+const uint8_t GPS_FIELDS = 14;
+
+struct __attribute__((packed)) ImuFrame {
+  uint8_t version;
+  uint32_t millis;
+  int16_t accel[3];
+  int16_t mag[3];
+  int16_t gyro[3];
+  int16_t lsm_temp;
+};
+
+struct __attribute__((packed)) BaroFrame {
+  uint8_t version;
+  uint32_t millis;
+  uint32_t pressure;
+  int32_t baro_altitude;
+  int16_t baro_temp;
+  int16_t k_temp;
+};
+
+struct __attribute__((packed)) GpsFrame {
+  uint8_t version;
+  uint32_t millis;
+  uint8_t gps_year, gps_month, gps_day, gps_hour, gps_minute, gps_second;
+  uint16_t gps_millis;
+  uint8_t gps_fix;
+  int32_t latitude, longitude;
+  uint16_t speed, angle;
+  int32_t gps_altitude;
+};
+
+// Stream mode's schedule.
+uint32_t last_imu = 0;
+bool baro_busy = false;
+bool baro_altimeter = false;
+float last_pressure = 0;
+// The sentence being forwarded, in 'N' mode.
+char nmea_line[84];
+uint8_t nmea_len = 0;
+uint32_t nmea_millis = 0;
+
 void setup() {
   Serial.begin(115200);
   Serial.println("Made it to setup.");
@@ -117,11 +232,20 @@ void loop() {
     // wait for a something from serial
     if(Serial.available() > 0 ) {
       run_once = false;
+      // 'B' asks for the binary frames, 'M' for the streams. Anything else (like "Hello.") gets text.
+      char c = Serial.read();
+      nmea = (c == 'N');
+      streams = nmea || (c == 'M');
+      binary = streams || (c == 'B');
       run_once_connected();
     }    
   }
   
   while(!run_once) {
+    if (streams) {
+      poll_streams();
+      continue;
+    }
     // Handle strange events with the timer by resetting it.
     if (timer > millis()) timer = millis();
     
@@ -129,13 +253,17 @@ void loop() {
       // GPS
       readGPS();
       
-      // print something
-      Serial.print(String(timer) + ",");
-      get_gps_data();
-      print_lsm_data();
-      get_barometric_data();
-      print_therm();
-      Serial.println("");
+      if (binary) {
+        send_record();
+      } else {
+        // print something
+        Serial.print(String(timer) + ",");
+        get_gps_data();
+        print_lsm_data();
+        get_barometric_data();
+        print_therm();
+        Serial.println("");
+      }
       timer = millis();
     }
   }
@@ -143,6 +271,22 @@ void loop() {
 
 
 void run_once_connected() {
+  if (binary) {
+    // End whatever text came before, so the first frame starts clean.
+    Serial.write((uint8_t)0);
+    if (streams) {
+      send_schema(STREAM_IMU, IMU_SCHEMA, IMU_FIELDS);
+      send_schema(STREAM_BARO, BARO_SCHEMA, BARO_FIELDS);
+      if (nmea) {
+        GPS.sendCommand(PMTK_SET_NMEA_OUTPUT_RMCGGAGSA);
+      } else {
+        send_schema(STREAM_GPS, GPS_SCHEMA, GPS_FIELDS);
+      }
+    } else {
+      send_schema(FRAME_RECORD, SCHEMA, SCHEMA_FIELDS);
+    }
+    return;
+  }
   Serial.print(F("Arduino: Millis, GPS: Date, Time, GPS Fix, Latitude, Longitude, speed (knots), angle, altitude, "));
   Serial.print(F("LSM: accel x, y, z, mag x, y, z, gyro x, y, z, temp, "));
   Serial.print(F("Barometere: Pressure (kPa), Alt (m), Temp (C), "));
@@ -284,3 +428,235 @@ void print_therm() {
 //  printSep();
   Serial.print(c);
 }
+
+
+/*
+  Binary frames
+*/
+// COBS: replace each zero with the distance to the next one, so the only zeros on the wire
+// are the ones that end frames. Frames here are always under 254 bytes.
+uint8_t cobs_encode(const uint8_t *in, uint8_t len, uint8_t *out) {
+  uint8_t code_at = 0, code = 1, o = 1;
+  for (uint8_t i = 0; i < len; i++) {
+    if (in[i] == 0) {
+      out[code_at] = code;
+      code_at = o++;
+      code = 1;
+    } else {
+      out[o++] = in[i];
+      code++;
+    }
+  }
+  out[code_at] = code;
+  return o;
+}
+
+void send_frame(uint8_t type, const uint8_t *payload, uint8_t len) {
+  uint8_t raw[MAX_PAYLOAD + 3];
+  uint8_t out[sizeof(raw) + 2];
+  if (len > MAX_PAYLOAD) return;
+  raw[0] = type;
+  memcpy(raw + 1, payload, len);
+  // CRC-16/CCITT over the type and payload.
+  uint16_t crc = 0xFFFF;
+  for (uint8_t i = 0; i < len + 1; i++) {
+    crc = _crc_xmodem_update(crc, raw[i]);
+  }
+  raw[len + 1] = crc & 0xFF;
+  raw[len + 2] = crc >> 8;
+  Serial.write(out, cobs_encode(raw, len + 3, out));
+  Serial.write((uint8_t)0);
+}
+
+// One frame per schema entry: version, stream, index, count, then the entry's text.
+void send_schema(uint8_t stream, const char *schema, uint8_t count) {
+  uint8_t entry[32];
+  uint8_t index = 0, len = 4;
+  for (uint16_t i = 0; ; i++) {
+    char c = pgm_read_byte(&schema[i]);
+    if (c == ',' || c == '\0') {
+      entry[0] = PROTOCOL_VERSION;
+      entry[1] = stream;
+      entry[2] = index++;
+      entry[3] = count;
+      send_frame(FRAME_SCHEMA, entry, len);
+      len = 4;
+      if (c == '\0') break;
+    } else if (len < sizeof(entry)) {
+      entry[len++] = c;
+    }
+  }
+}
+
+void send_record() {
+  frame.version = PROTOCOL_VERSION;
+  frame.millis = timer;
+  frame.gps_year = GPS.year;
+  frame.gps_month = GPS.month;
+  frame.gps_day = GPS.day;
+  frame.gps_hour = GPS.hour;
+  frame.gps_minute = GPS.minute;
+  frame.gps_second = GPS.seconds;
+  frame.gps_millis = GPS.milliseconds;
+  frame.gps_fix = GPS.fix;
+  // Without a fix, the Pi ignores these.
+  frame.latitude = lround(GPS.latitudeDegrees * 1e7);
+  frame.longitude = lround(GPS.longitudeDegrees * 1e7);
+  frame.speed = lround(GPS.speed * 100);
+  frame.angle = lround(GPS.angle * 100);
+  frame.gps_altitude = lround(GPS.altitude * 100);
+
+  lsm.getEvent(&accel, &mag, &gyro, &temp);
+  frame.accel[0] = lround(accel.acceleration.x * 100);
+  frame.accel[1] = lround(accel.acceleration.y * 100);
+  frame.accel[2] = lround(accel.acceleration.z * 100);
+  frame.mag[0] = lround(mag.magnetic.x * 1000);
+  frame.mag[1] = lround(mag.magnetic.y * 1000);
+  frame.mag[2] = lround(mag.magnetic.z * 1000);
+  frame.gyro[0] = lround(gyro.gyro.x * 100);
+  frame.gyro[1] = lround(gyro.gyro.y * 100);
+  frame.gyro[2] = lround(gyro.gyro.z * 100);
+  frame.lsm_temp = lround(temp.temperature * 100);
+
+  frame.pressure = lround(barometer.getPressure() * 4);
+  frame.baro_altitude = lround(barometer.getAltitude() * 100);
+  frame.baro_temp = lround(barometer.getTemperature() * 100);
+
+  double c = thermocouple.readCelsius();
+  if( isnan(c) ) {
+    c = badTemp;
+  }
+  frame.k_temp = lround(c * 4);
+
+  send_frame(FRAME_RECORD, (const uint8_t *)&frame, sizeof(frame));
+}
+
+
+/*
+  Stream mode
+*/
+// One pass of the stream loop: whatever's due, without waiting on anything.
+void poll_streams() {
+  if (nmea) {
+    forward_nmea();
+  } else {
+    read_gps();
+  }
+
+  uint32_t now = millis();
+  if (now - last_imu >= IMU_INTERVAL_MS) {
+    last_imu = now;
+    send_imu(now);
+  }
+
+  // The barometer takes about half a second per reading (at the default oversampling), so start
+  // one and come back for it. It does pressure or altitude, not both: alternate, and send a
+  // sample after each altitude. Needs the 2.x Adafruit_MPL3115A2 library.
+  if (!baro_busy) {
+    barometer.setMode(baro_altimeter ? MPL3115A2_ALTIMETER : MPL3115A2_BAROMETER);
+    barometer.startOneShot();
+    baro_busy = true;
+  } else if (barometer.conversionComplete()) {
+    baro_busy = false;
+    if (baro_altimeter) {
+      send_baro(millis());
+    } else {
+      last_pressure = barometer.getLastConversionResults(MPL3115A2_PRESSURE);
+    }
+    baro_altimeter = !baro_altimeter;
+  }
+}
+
+// Take whatever the GPS has sent. SoftwareSerial only buffers 64 characters, about 65ms at 9600 baud.
+void read_gps() {
+  while (mySerial.available()) {
+    GPS.read();
+  }
+  if (GPS.newNMEAreceived()) {
+    char *sentence = GPS.lastNMEA();
+    // GGA comes in too, but RMC has everything but the altitude, and that's kept from the last GGA.
+    if (GPS.parse(sentence) && strstr(sentence, "RMC")) {
+      send_gps();
+    }
+  }
+}
+
+// The same, but a character at a time into nmea_line, and each sentence goes to the Pi as it is.
+void forward_nmea() {
+  while (mySerial.available()) {
+    char c = mySerial.read();
+    if (c == '$') {
+      nmea_len = 0;
+      nmea_millis = millis();
+    }
+    if (c == '\r' || c == '\n') {
+      if (nmea_len > 0 && nmea_line[0] == '$') {
+        send_nmea();
+      }
+      nmea_len = 0;
+    } else if (nmea_len < sizeof(nmea_line)) {
+      nmea_line[nmea_len++] = c;
+    }
+  }
+}
+
+void send_nmea() {
+  uint8_t payload[4 + sizeof(nmea_line)];
+  memcpy(payload, &nmea_millis, 4);
+  memcpy(payload + 4, nmea_line, nmea_len);
+  send_frame(FRAME_NMEA, payload, 4 + nmea_len);
+}
+
+void send_imu(uint32_t now) {
+  ImuFrame f;
+  f.version = PROTOCOL_VERSION;
+  f.millis = now;
+  lsm.getEvent(&accel, &mag, &gyro, &temp);
+  f.accel[0] = lround(accel.acceleration.x * 100);
+  f.accel[1] = lround(accel.acceleration.y * 100);
+  f.accel[2] = lround(accel.acceleration.z * 100);
+  f.mag[0] = lround(mag.magnetic.x * 1000);
+  f.mag[1] = lround(mag.magnetic.y * 1000);
+  f.mag[2] = lround(mag.magnetic.z * 1000);
+  f.gyro[0] = lround(gyro.gyro.x * 100);
+  f.gyro[1] = lround(gyro.gyro.y * 100);
+  f.gyro[2] = lround(gyro.gyro.z * 100);
+  f.lsm_temp = lround(temp.temperature * 100);
+  send_frame(STREAM_IMU, (const uint8_t *)&f, sizeof(f));
+}
+
+void send_baro(uint32_t now) {
+  BaroFrame f;
+  f.version = PROTOCOL_VERSION;
+  f.millis = now;
+  f.pressure = lround(last_pressure * 4);
+  f.baro_altitude = lround(barometer.getLastConversionResults(MPL3115A2_ALTITUDE) * 100);
+  f.baro_temp = lround(barometer.getLastConversionResults(MPL3115A2_TEMPERATURE) * 100);
+  double c = thermocouple.readCelsius();
+  if( isnan(c) ) {
+    c = badTemp;
+  }
+  f.k_temp = lround(c * 4);
+  send_frame(STREAM_BARO, (const uint8_t *)&f, sizeof(f));
+}
+
+void send_gps() {
+  GpsFrame f;
+  f.version = PROTOCOL_VERSION;
+  f.millis = millis();
+  f.gps_year = GPS.year;
+  f.gps_month = GPS.month;
+  f.gps_day = GPS.day;
+  f.gps_hour = GPS.hour;
+  f.gps_minute = GPS.minute;
+  f.gps_second = GPS.seconds;
+  f.gps_millis = GPS.milliseconds;
+  f.gps_fix = GPS.fix;
+  // Without a fix, the Pi ignores these.
+  f.latitude = lround(GPS.latitudeDegrees * 1e7);
+  f.longitude = lround(GPS.longitudeDegrees * 1e7);
+  f.speed = lround(GPS.speed * 100);
+  f.angle = lround(GPS.angle * 100);
+  f.gps_altitude = lround(GPS.altitude * 100);
+  send_frame(STREAM_GPS, (const uint8_t *)&f, sizeof(f));
+}
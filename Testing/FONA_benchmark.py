@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+############################
+# FONA_benchmark.py
+#
+# Benchmarks and soak tests the FONA driver against the simulated modem, so it runs on
+# any Linux machine. From the top of the repository:
+#
+#   python3 -m Testing.FONA_benchmark [-n <count>] [-d <delay>] [-e <error rate>] [-s <seconds>]
+#                                     [-r <texts per minute>]
+#
+# Runs four things:
+#   1. Round trip times for plain status commands.
+#   2. How long it takes to list an inbox of <count> messages (multi-line, quoted and
+#      non-ASCII ones included), in plain text and in UCS2, and whether they all come back intact.
+#   3. Texts that say OK, ERROR or RING, or have blank lines in them, listed and read one at a
+#      time. These used to cut the listing short.
+#   4. End to end: <count> texts arrive, how long until each reply is sent. With -s, keeps
+#      texts arriving for that many seconds instead (a soak test). The outbox rate limit is
+#      raised to -r (default 600/min) so it measures the driver rather than the limit.
+#
+############################
+
+import sys
+import getopt
+import logging
+from time import sleep, monotonic, perf_counter
+from HighaltHardware.FonaSimulator import FonaSimulator
+from HighaltHardware.AdafruitFONA import Fona, FonaThread
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_commands(sim, count):
+    fona = Fona(serial_port=sim.port_name)
+    for i in range(count):
+        fona.keep_alive()
+        fona.refresh_status("signal_strength")
+        fona.refresh_status("battery_state")
+    print("Command round trips ({0} each):".format(count))
+    for name, histogram in sorted(fona.command_latency.items()):
+        print("  {0:10} {1}".format(name, histogram))
+    fona.disconnect()
+
+
+# Some of everything the listing parser has to cope with.
+def inbox_text(i):
+    kind = i % 4
+    if kind == 1:
+        return "Line one of {0}\nline two, with a comma\nline three".format(i)
+    if kind == 2:
+        return 'Quoted "{0}", commas, and +CMGL: look-alikes'.format(i)
+    if kind == 3:
+        return "Où êtes-vous? {0} \u6c14\u7403".format(i)
+    return "Where are you? {0}".format(i)
+
+
+def bench_inbox(sim, count):
+    fona = Fona(serial_port=sim.port_name)
+    for charset in ("IRA", "UCS2"):
+        fona.set_charset(charset)
+        texts = {}
+        for i in range(count):
+            number = "+1415555{0:04d}".format(i)
+            # Without UCS2, anything outside ASCII would be mangled anyway.
+            text = inbox_text(i) if charset == "UCS2" else inbox_text(i).encode("ascii", "replace").decode()
+            # The SIM only holds so many.
+            if sim.store_message(number, text) is not None:
+                texts[number.replace("+", "")] = text
+        start = perf_counter()
+        first = None
+        correct = 0
+        parsed = 0
+        for msg in fona.iter_text_messages(include_read=True, leave_unread=True):
+            if first is None:
+                first = perf_counter() - start
+            parsed += 1
+            correct += texts.get(msg.sender_number) == msg.text_message
+        elapsed = perf_counter() - start
+        print("Inbox listing ({0}): {1} of {2} messages parsed, {3} exactly right, "
+              "first after {4:.1f} ms, all in {5:.1f} ms".format(charset, parsed, len(texts), correct,
+                                                               (first or 0) * 1000, elapsed * 1000))
+        fona.delete_all_messages()
+    fona.set_charset("IRA")
+    fona.disconnect()
+
+
+# Bodies that look like result codes or URCs, in an order that used to lose messages.
+AWKWARD_TEXTS = ["OK", "Where are you?", "ERROR", "RING", "First line\n\nthird line", "\nstarts blank", "OK"]
+
+
+def check_awkward_bodies(sim):
+    fona = Fona(serial_port=sim.port_name)
+    fona.delete_all_messages()
+    texts = {}
+    for i, text in enumerate(AWKWARD_TEXTS):
+        texts[sim.store_message("+1415557{0:04d}".format(i), text)] = text
+    listed = {int(msg.message_number): msg.text_message
+              for msg in fona.iter_text_messages(include_read=True, leave_unread=True)}
+    failures = 0
+    for index, text in sorted(texts.items()):
+        msg = fona.read_message(index, leave_unread=True)
+        read = msg.text_message if msg is not None else None
+        if listed.get(index) != text or read != text:
+            failures += 1
+            print("  FAILED: {0!r} was listed as {1!r} and read as {2!r}".format(text, listed.get(index), read))
+    print("Awkward bodies: {0} of {1} came back intact".format(len(texts) - failures, len(texts)))
+    fona.delete_all_messages()
+    fona.disconnect()
+    return failures == 0
+
+
+def bench_end_to_end(sim, count, soak_seconds, rate):
+    fona_thread = FonaThread(sim.port_name, gps_coord_locaiton="37.77, -122.41", max_texts_per_minute=rate)
+    sim.ri_callback = fona_thread.ring
+    fona_thread.start()
+    sleep(1)
+
+    arrivals = {}
+    start = monotonic()
+    i = 0
+    while (soak_seconds and monotonic() - start < soak_seconds) or (not soak_seconds and i < count):
+        number = "1415556{0:04d}".format(i)
+        arrivals[number] = monotonic()
+        sim.deliver_message("+" + number, "Where are you?")
+        i += 1
+        # Spread them out a bit, the way real texts would arrive.
+        sleep(0.2)
+
+    # Give the last ones time to get out.
+    deadline = monotonic() + 30
+    while len(sim.sent) < len(arrivals) and monotonic() < deadline:
+        sleep(0.5)
+    fona_thread.stop()
+    fona_thread.join(10)
+
+    latencies = [sent_at - arrivals[number] for number, _, sent_at in sim.sent if number in arrivals]
+    print("End to end: {0} texts, {1} replies sent".format(len(arrivals), len(latencies)))
+    print("  reply latency p50={0:.2f}s p90={1:.2f}s max={2:.2f}s".format(percentile(latencies, 0.5),
+                                                                         percentile(latencies, 0.9),
+                                                                         max(latencies) if latencies else 0))
+    print("  modem commands handled: {0}".format(sim.command_count))
+
+
+def process_args(inargs):
+    count = 20
+    delay = 0.0
+    error_rate = 0.0
+    soak = 0
+    rate = 600
+    usage = """
+    -n, --num       How many commands/messages to use.
+    -d, --delay     Simulated modem response delay, in seconds.
+    -e, --errors    Chance (0-1) of the modem answering ERROR.
+    -s, --soak      Keep texts arriving for this many seconds.
+    -r, --rate      Outbox send limit, texts per minute.
+    """
+    try:
+        opts, args = getopt.getopt(inargs, "hn:d:e:s:r:", ["num", "delay", "errors", "soak", "rate"])
+    except getopt.GetoptError as err:
+        print(err.msg)
+        print(usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit(0)
+        elif opt == "-n":
+            count = int(arg)
+        elif opt == "-d":
+            delay = float(arg)
+        elif opt == "-e":
+            error_rate = float(arg)
+        elif opt == "-s":
+            soak = float(arg)
+        elif opt == "-r":
+            rate = float(arg)
+    return count, delay, error_rate, soak, rate
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s:%(message)s',
+                        level=logging.WARNING)
+    num, response_delay, errors, soak_time, send_rate = process_args(sys.argv[1:])
+    simulator = FonaSimulator(response_delay=response_delay, error_rate=errors, seed=1)
+    simulator.start()
+    try:
+        bench_commands(simulator, num)
+        bench_inbox(simulator, num)
+        check_awkward_bodies(simulator)
+        bench_end_to_end(simulator, num, soak_time, send_rate)
+    finally:
+        simulator.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+############################
+# Uplink_benchmark.py
+#
+# Pushes synthetic sensor records through the GPRS uplink: TelemetryUplink -> FONA driver ->
+# simulated modem -> a real HTTP POST to uplink_receiver on this machine. From the top of
+# the repository:
+#
+#   python3 -m Testing.Uplink_benchmark [-n <records>] [-b <batch size>] [-g <link drop rate>]
+#
+# Reports how many records made it, how many batches had to be retried and the throughput.
+# With -g, the simulated link drops that often, so the spool and retries get a workout.
+#
+############################
+
+import sys
+import getopt
+import asyncio
+import logging
+from time import monotonic
+from HighaltHardware.FonaSimulator import FonaSimulator
+from HighaltHardware.AdafruitFONA import Fona
+from HighaltHardware.FonaDriver import AsyncFona
+from HighaltHardware.FonaUplink import TelemetryUplink
+from HighaltHardware.HighaltArduino import SensorRecord
+from uplink_receiver import UplinkReceiver
+
+
+def fake_record(i):
+    line = "{0},12/3/2016,10:{1:02d}:{2:02d}.000,1,37.{3:05d},-122.41000,0.5,90.0,{4:.1f}," \
+           "0.01,0.02,9.81,0.1,0.2,0.3,0.01,0.02,0.03,21.5,1013.25,{4:.1f},21.0,20.5".format(
+               i * 1000, (i // 60) % 60, i % 60, i % 100000, 100 + i * 0.5)
+    return SensorRecord.from_line(line)
+
+
+async def bench_uplink(sim, receiver, count, batch_size):
+    fona = Fona(serial_port=sim.port_name)
+    driver = AsyncFona(fona)
+    uplink = TelemetryUplink(driver, receiver.url, "wholesale", batch_size=batch_size, max_batch_age=1)
+    driver_task = asyncio.ensure_future(driver.run())
+    uplink_task = asyncio.ensure_future(uplink.run(interval=1))
+    for i in range(count):
+        uplink.add_record(fake_record(i))
+
+    start = monotonic()
+    deadline = start + 300
+    while receiver.records < count and monotonic() < deadline:
+        await asyncio.sleep(0.5)
+    elapsed = monotonic() - start
+    uplink.stop()
+    await uplink_task
+    await driver.submit(fona.close_bearer)
+    driver.stop()
+    await driver_task
+    fona.disconnect()
+
+    print("Uplink: {0} of {1} records received in {2:.1f}s".format(receiver.records, count, elapsed))
+    print("  batches={0} retries={1} dropped={2} bytes={3} ({4:.0f} bytes/record)".format(
+        uplink.batches_sent, uplink.retries, uplink.dropped, uplink.bytes_sent,
+        uplink.bytes_sent / uplink.records_sent if uplink.records_sent else 0))
+    print("  throughput while sending: {0:.0f} B/s, {1:.0f} records/s".format(
+        uplink.throughput, uplink.records_sent / uplink.send_time if uplink.send_time else 0))
+    print("  HTTP posts made by the modem: {0}".format(sim.http_posts))
+
+
+def process_args(inargs):
+    count = 500
+    batch_size = 50
+    drop_rate = 0.0
+    usage = """
+    -n, --num       How many records to send.
+    -b, --batch     Records per batch.
+    -g, --gprs      Chance (0-1) of the GPRS link dropping during a POST.
+    """
+    try:
+        opts, args = getopt.getopt(inargs, "hn:b:g:", ["num", "batch", "gprs"])
+    except getopt.GetoptError as err:
+        print(err.msg)
+        print(usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit(0)
+        elif opt == "-n":
+            count = int(arg)
+        elif opt == "-b":
+            batch_size = int(arg)
+        elif opt == "-g":
+            drop_rate = float(arg)
+    return count, batch_size, drop_rate
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s:%(message)s',
+                        level=logging.WARNING)
+    num, size, drops = process_args(sys.argv[1:])
+    simulator = FonaSimulator(gprs_drop_rate=drops, seed=1)
+    simulator.start()
+    server = UplinkReceiver(port=0)
+    server.start()
+    try:
+        asyncio.get_event_loop().run_until_complete(bench_uplink(simulator, server, num, size))
+    finally:
+        server.stop()
+        simulator.close()
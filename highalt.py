@@ -1,11 +1,24 @@
 #!/usr/bin/env python3
 
 import os
+import signal
 import datetime
 import logging
-from time import sleep
-from HighaltHardware.HighaltArduino import ArduinoThreadSupervisor
-from HighaltHardware.AdafruitFONA import FonaThread
+from time import monotonic
+# Startup times in the log are measured from here.
+bootStart = monotonic()
+from HighaltHardware.HighaltLogging import AsyncLogging
+from HighaltHardware.HighaltStorage import data_dirs
+from HighaltHardware.HighaltRuntime import Runtime
+from HighaltHardware.HighaltWatchdog import Watchdog, HardwareWatchdog
+from HighaltHardware.HighaltMetrics import MetricsRegistry, MetricsExporter, cpu_temperature, free_disk
+from HighaltHardware.TelemetryBus import TelemetryBus, TOPIC_SENSOR
+from HighaltHardware.HighaltArduino import ArduinoReader
+from HighaltHardware.FlightState import FlightMonitor
+from HighaltHardware.FlightClock import ClockMonitor
+from HighaltHardware.TelemetryWindow import TelemetryWindows
+from HighaltHardware.HighaltProcesses import SharedRecord, RecordPipe, RecordReceiver, ChildProcess, \
+    register_process_metrics, log_process_cpu
 
 
 # Create the directories we're going to store things in.
@@ -17,9 +30,8 @@ def create_data_dirs():
     date_dir = d.strftime('%Y-%m-%d')
     # Time format: 24-hour HH-MM-SS
     time_dir = d.strftime('%H-%M-%S')
-    # Create the dirs, root\date\time.
-    video_data_dir = os.path.join(rootDir, date_dir, time_dir, 'video')
-    sensor_data_dir = os.path.join(rootDir, date_dir, time_dir, 'sensors')
+    # Create the dirs, root\date\time. Video may be on its own partition.
+    video_data_dir, sensor_data_dir = data_dirs(rootDir, date_dir, time_dir, videoRootDir)
     # Exist ok means that if the dirs already exist, don't freak out.
     os.makedirs(video_data_dir, exist_ok=True)
     os.makedirs(sensor_data_dir, exist_ok=True)
@@ -27,9 +39,150 @@ def create_data_dirs():
     return video_data_dir, sensor_data_dir
 
 
+################################
+# Each part of the system. In one process they all go on the same runtime; in multi-process
+# mode each gets a process (and runtime) of its own.
+################################
+def setup_ingest(runtime, metrics, bus, port, sensor_dir, stream_dir, binary=False, streams=False, nmea=False,
+                 gps_port=None):
+    if gps_port:
+        # Only imported if the GPS is on the Pi.
+        from HighaltHardware.HighaltGps import GpsReader
+        logging.info("Adding GPS.")
+        gps = runtime.add(GpsReader(gps_port, stream_dir, bus=bus))
+        gps.register_metrics(metrics)
+    logging.info("Adding Arduino.")
+    arduino = runtime.add(ArduinoReader(port, sensor_dir, bus=bus, binary=binary,
+                                        stream_dir=stream_dir if streams else None, nmea=nmea,
+                                        gps_from_bus=bool(gps_port)))
+    arduino.register_metrics(metrics)
+    # Each record's flight time (and UTC), written out as the clock stream.
+    clock = runtime.add(ClockMonitor(bus, stream_dir))
+    clock.register_metrics(metrics)
+    # Altitude, rate and flight phase from each record, written out as the flight stream.
+    flight = runtime.add(FlightMonitor(bus, stream_dir))
+    flight.register_metrics(metrics)
+    return arduino
+
+
+def setup_windows(runtime, metrics, bus, timed=True):
+    # The last few hours of records in memory, for the STATS text and the metrics.
+    windows = TelemetryWindows()
+    windows.listen(bus, timed)
+    windows.register_metrics(metrics)
+    runtime.call_every(600, windows.log_summary)
+    return windows
+
+
+def setup_camera(runtime, metrics, bus, video_dir):
+    # Only imported if there's a camera.
+    from HighaltHardware.HighaltCamera import CameraRecorder
+    logging.info("Adding Camera.")
+    camera = runtime.add(CameraRecorder(video_dir, 600, 30, bus=bus))
+    camera.register_metrics(metrics)
+    return camera
+
+
+def setup_fona(runtime, metrics, bus, port, telemetry_source, uplink_url, uplink_apn, uplink_spool, key_pin=None,
+               windows=None):
+    # Only imported if there's a FONA.
+    from HighaltHardware.AdafruitFONA import FonaService
+    logging.info("Adding Fona.")
+    fona = FonaService(port, 4,
+                       telemetry_source=telemetry_source,
+                       uplink_url=uplink_url, uplink_apn=uplink_apn,
+                       uplink_spool=uplink_spool,
+                       bus=bus,
+                       key_pin=key_pin,
+                       windows=windows)
+    if fona.uplink:
+        bus.listen(TOPIC_SENSOR, fona.uplink.add_record)
+    fona.register_metrics(metrics)
+    return runtime.add(fona)
+
+
+# These run in the child processes.
+def ingest_process(runtime, metrics, port, sensor_dir, stream_dir, shared_name, pipe, binary, streams, nmea, gps_port):
+    bus = TelemetryBus()
+    # Every record goes into shared memory for anyone who wants the latest, and down the pipe
+    # (if there is one) for anyone who wants them all.
+    shared = SharedRecord(shared_name)
+    bus.listen(TOPIC_SENSOR, shared.write)
+    if pipe:
+        bus.listen(TOPIC_SENSOR, pipe.send)
+        metrics.counter("pipe_dropped_total", "Records the FONA process didn't keep up with.",
+                        lambda: pipe.dropped)
+    setup_ingest(runtime, metrics, bus, port, sensor_dir, stream_dir, binary, streams, nmea, gps_port)
+    setup_windows(runtime, metrics, bus)
+
+
+def camera_process(runtime, metrics, video_dir):
+    setup_camera(runtime, metrics, TelemetryBus(), video_dir)
+
+
+def fona_process(runtime, metrics, port, shared_name, pipe, uplink_url, uplink_apn, uplink_spool, key_pin):
+    bus = TelemetryBus()
+    if pipe:
+        # The uplink wants every record.
+        receiver = runtime.add(RecordReceiver(pipe, bus))
+        metrics.counter("records_received_total", "Records that came over from the ingest process.",
+                        lambda: receiver.received)
+        telemetry_source = receiver.recent_records
+    else:
+        # Replies only need the latest.
+        shared = SharedRecord(shared_name)
+        telemetry_source = lambda: [record for record in (shared.read(),) if record]
+        # The flight estimate wants each record once, so only new ones go on the bus.
+        last_sequence = [0]
+
+        def publish_new():
+            sequence = shared.sequence
+            if sequence != last_sequence[0] and not sequence & 1:
+                last_sequence[0] = sequence
+                record = shared.read()
+                if record:
+                    bus.publish(TOPIC_SENSOR, record)
+        runtime.call_every(0.5, publish_new)
+    # Its own estimate for the replies (the ingest process writes the flight stream), and its
+    # own windows for STATS, timed as the records come over.
+    runtime.add(FlightMonitor(bus))
+    windows = setup_windows(runtime, metrics, bus, timed=False)
+    setup_fona(runtime, metrics, bus, port, telemetry_source, uplink_url, uplink_apn, uplink_spool, key_pin, windows)
+
+
 if __name__ == "__main__":
     # Set our root directory
     rootDir = 'E:\\David\\highalt' if os.name == 'nt' else '/data/highalt'
+    # Set this to put the video on a separate partition from the sensor data. None keeps it under rootDir.
+    videoRootDir = None
+    # Bulk telemetry over GPRS. Set the URL (e.g. of uplink_receiver.py) to turn it on.
+    uplinkUrl = None
+    uplinkApn = 'wholesale'
+    # Where to serve the metrics. None turns the socket off (the file is always written).
+    metricsSocket = None if os.name == 'nt' else '/tmp/highalt_metrics.sock'
+    # Run the Arduino, camera and FONA in processes of their own, so a slow moment in one can't
+    # hold up the others. Each gets its own highalt.<name>.log and metrics.<name>.prom.
+    multiProcess = False
+    # Have the Arduino send binary frames (with CRCs) instead of text. Needs the current sketch.
+    arduinoBinary = False
+    # Have it send each sensor as a stream of its own, as fast as that sensor goes (IMU at 50 Hz,
+    # GPS at 5 Hz), instead of one row every 700ms. They're written to streams/ next to sensors/;
+    # the sensor files get a row for each barometer reading, put together from the streams.
+    arduinoStreams = False
+    # In stream mode, have the Arduino forward the GPS's NMEA sentences for us to parse, which gets
+    # satellites, HDOP and fix quality too. Kept as they are in streams/nmea.
+    arduinoNmea = False
+    # Or, with the GPS wired to the Pi, its port (e.g. '/dev/serial0'). The rows get their GPS
+    # fields from it.
+    gpsPort = None
+    # The watchdog recovers anything that goes quiet for longer than its stall limit: 10s for
+    # the Arduino, 30s for the camera and 150s for the FONA. Override them here, e.g.
+    # dict(Arduino=5).
+    stallTimeouts = {}
+    # GPIO (BCM) wired to the FONA's KEY pin, so it can be power cycled if it stops answering.
+    fonaKeyPin = None
+    # Set to '/dev/watchdog' to have the Pi reboot if the main loop ever hangs.
+    hardwareWatchdog = None
 
     # Setup our logging. We want to do this early so we can cover everything.
     # Debug level options:
@@ -39,14 +192,24 @@ if __name__ == "__main__":
     # ERROR
     # CRITICAL
     debugLevel = logging.INFO
-    logging.basicConfig(filename=os.path.join(rootDir, 'highalt.log'),
-                        format='%(asctime)s %(levelname)s:%(message)s',
-                        level=debugLevel)
+    # The log file gets debugLevel and up, written on a thread of its own. Debug records are
+    # all kept in memory too, and written out to a debug-*.log file in rootDir when
+    # something logs an error, or on `kill -USR1 <pid>`.
+    asyncLogging = AsyncLogging(os.path.join(rootDir, 'highalt.log'), level=debugLevel)
+    asyncLogging.start()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: asyncLogging.dump("SIGUSR1"))
+
+    # Everything runs on one event loop. The runtime restarts anything that falls over, and
+    # stops it all, newest first, on Ctrl-C or SIGTERM. It also times how long startup takes.
+    runtime = Runtime(started=bootStart)
+    runtime.mark("highalt", "logging")
 
     # Create the directories we're going to use.
     vDir, sDir = create_data_dirs()
     logging.info('Video dir: {0}'.format(vDir))
     logging.info('Sensor dir: {0}'.format(sDir))
+    runtime.mark("highalt", "data dirs")
 
     #################################
     # Camera Thread section
@@ -59,7 +222,6 @@ if __name__ == "__main__":
     logging.info("Architecture: {0}".format(arch))
     logging.info("OS Name: {0}".format(op_sys))
     if arch == 'armv7l':
-        from HighaltHardware.HighaltCamera import CamThreadSupervisor
         logging.info('Enabling camera.')
         usingCamera = True
     else:
@@ -74,53 +236,77 @@ if __name__ == "__main__":
     fona_port = '/dev/ttyAMA0' if arch == 'armv7l' else None
 
     ################################
-    # Establish and control the threads we've set up
+    # Set up the subsystems and run them
     ################################
 
-    ArduinoSupThread = None
-    CamSupThread = None
-    FonaSupervisor = None
+    # How the subsystems share what they know.
+    bus = TelemetryBus()
+    # What everything's counting, exported every few seconds and snapshotted every minute.
+    metrics = MetricsRegistry()
+    runtime.register_metrics(metrics)
+    metrics.gauge("cpu_temperature_celsius", "CPU temperature.", cpu_temperature)
+    metrics.gauge("data_free_bytes", "Free space where the sensor data goes.", lambda: free_disk(sDir))
+    metrics.gauge("video_free_bytes", "Free space where the video goes.", lambda: free_disk(vDir))
+    # In multi-process mode, the latest record comes through shared memory.
+    shared = SharedRecord() if multiProcess else None
+    metrics.gauge("sensor_age_seconds", "Time since the last sensor record.",
+                  shared.age if shared else lambda: bus.age(TOPIC_SENSOR))
 
     # TODO: Delete before actual use.
     # Don't actually turn on the camera for right now.
     # usingCamera = False
 
-    # Supervise the threads, recreating if needed
-    stop = False
     try:
-        logging.info("Starting Arduino thread.")
-        ArduinoSupThread = ArduinoThreadSupervisor(arduino_port, sDir)
-        ArduinoSupThread.start()
-        logging.info("Sleeping while we wait for the Arduino to get going.")
-        sleep(5)
-        if usingCamera:
-            logging.info("Starting Camera thread.")
-            CamSupThread = CamThreadSupervisor(vDir, 600, 30)
-            CamSupThread.start()
-        if fona_port:
-            logging.info("Starting Fona thread.")
-            FonaSupervisor = FonaThread(fona_port, 4, ArduinoSupThread.current_gps_coords)
-            FonaSupervisor.start()
-        while not stop:
+        # Added first so it's stopped last, and its final snapshot has everyone's last numbers.
+        runtime.add(MetricsExporter(metrics,
+                                    text_path=os.path.join(rootDir, 'metrics.prom'),
+                                    socket_path=metricsSocket,
+                                    snapshot_path=os.path.join(os.path.dirname(sDir), 'metrics.jsonl')))
+        # Everything starts at once. Each one tells the runtime when it's ready, and the log
+        # gets a breakdown of how long each step took.
+        uplinkSpool = os.path.join(rootDir, 'uplink')
+        streamDir = os.path.join(os.path.dirname(sDir), 'streams')
+        if multiProcess:
+            # Records only need to go down a pipe if the uplink wants them all.
+            pipe = RecordPipe() if fona_port and uplinkUrl else None
+            processes = [("ingest", ingest_process, (arduino_port, sDir, streamDir, shared.name, pipe,
+                                                       arduinoBinary, arduinoStreams, arduinoNmea, gpsPort))]
+            if usingCamera:
+                processes.append(("camera", camera_process, (vDir,)))
+            if fona_port:
+                processes.append(("fona", fona_process, (fona_port, shared.name, pipe, uplinkUrl, uplinkApn,
+                                                         uplinkSpool, fonaKeyPin)))
+            children = []
+            for name, setup, args in processes:
+                children.append(runtime.add(ChildProcess(
+                    name, setup, args,
+                    log_path=os.path.join(rootDir, 'highalt.{0}.log'.format(name)),
+                    log_level=debugLevel,
+                    metrics_path=os.path.join(rootDir, 'metrics.{0}.prom'.format(name)),
+                    stall_timeouts=stallTimeouts)))
+            register_process_metrics(metrics, children)
+            runtime.call_every(600, log_process_cpu, children)
+            # The children stop together, each within its own deadline.
+            runtime.shutdown_deadline = ChildProcess.stop_timeout
+        else:
+            arduino = setup_ingest(runtime, metrics, bus, arduino_port, sDir, streamDir, arduinoBinary,
+                                   arduinoStreams, arduinoNmea, gpsPort)
+            windows = setup_windows(runtime, metrics, bus)
             if usingCamera:
-                CamSupThread.join(5)
-                pass
+                setup_camera(runtime, metrics, bus, vDir)
             if fona_port:
-                FonaSupervisor.join(5)
-            ArduinoSupThread.join(5)
-
-    except KeyboardInterrupt:
-        logging.warning("Received keyboard interrupt. Shutting down.")
-        stop = True
-        ArduinoSupThread.stop()
-        FonaSupervisor.stop()
-        CamSupThread.stop()
-    except NameError as err:
-        logging.warning("Thread Control - Name Error:")
-        logging.warning(err.args)
-    # except AttributeError as err:
-    #    logging.warning("Thread Control - Attribute Error:")
-    #    for i in err.args:
-    #        logging.warning(i)
+                setup_fona(runtime, metrics, bus, fona_port, arduino.recent_records, uplinkUrl, uplinkApn,
+                           uplinkSpool, fonaKeyPin, windows)
+        # Added last, so it's stopped first and doesn't take the others stopping for stalls.
+        watchdog = runtime.add(Watchdog(runtime, stall_timeouts=stallTimeouts,
+                                        hardware=HardwareWatchdog(hardwareWatchdog) if hardwareWatchdog else None))
+        watchdog.register_metrics(metrics)
+        runtime.mark("highalt", "subsystems added")
+        # Note how everything's doing every ten minutes.
+        runtime.call_every(600, runtime.log_status)
+        runtime.run()
     finally:
+        if shared:
+            shared.close()
+        asyncLogging.stop()
         logging.shutdown()
@@ -34,7 +34,8 @@ do_start () {
 }
 do_stop () {
     log_daemon_msg "Stopping system $DAEMON_NAME daemon"
-    start-stop-daemon --stop --pidfile $PIDFILE --retry 10
+    # highalt gets up to 20s to write out its data and close its files on SIGTERM.
+    start-stop-daemon --stop --pidfile $PIDFILE --retry TERM/30/KILL/5
     log_end_msg $?
 }
 
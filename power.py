@@ -3,6 +3,7 @@
 import time
 import RPi.GPIO as GPIO
 import os
+import signal
 import logging
 
 ############################
@@ -10,6 +11,10 @@ import logging
 #
 # Monitor GPIO pins for a change in voltage. On detection, call shutdown.
 #
+# Before halting, highalt gets a SIGTERM and some time to write out what it has buffered
+# and close its files (see Runtime.shutdown_deadline), so the last sensor file and video
+# segment aren't cut short.
+#
 # Some inspiration taken from here:
 # http://iot-projects.com/index.php?id=raspberry-pi-shutdown-button
 #
@@ -43,6 +48,44 @@ real_shutdown_cmd = "shutdown -h now"
 # Pin to use for power detection
 POWERPIN = 17
 
+# Where highalt_service.sh keeps highalt's PID.
+HIGHALT_PIDFILE = "/var/run/highalt.pid"
+# How long highalt gets to finish before we halt anyway. A bit more than its own deadline.
+SHUTDOWN_DEADLINE = 30
+
+
+############################
+# Let highalt finish up.
+############################
+def stop_highalt(pidfile=HIGHALT_PIDFILE, deadline=SHUTDOWN_DEADLINE):
+    """
+    Ask highalt to shut down and wait for it to exit.
+    :return: True if it exited in time (or wasn't running).
+    """
+    try:
+        with open(pidfile) as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        logging.info("No highalt PID file. Nothing to wait for.")
+        return True
+    start = time.monotonic()
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        logging.info("highalt isn't running.")
+        return True
+    logging.info("Asked highalt ({0}) to stop. Waiting up to {1}s.".format(pid, deadline))
+    while time.monotonic() - start < deadline:
+        try:
+            # Signal 0 only checks that it's still there.
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            logging.info("highalt stopped in {0:.1f}s.".format(time.monotonic() - start))
+            return True
+        time.sleep(0.2)
+    logging.warning("highalt still running after {0}s. Shutting down anyway.".format(deadline))
+    return False
+
 
 ############################
 # Start it all up, alt option.
@@ -67,6 +110,7 @@ def main():
         time.sleep(5)
         if GPIO.input(POWERPIN) == 0:
             logging.info("Pin still down after 5 min. Initiating shutdown.")
+            stop_highalt()
             os.system(real_shutdown_cmd)
         else:
             logging.info("Button was released. Resetting.")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import sys
+import getopt
+from datetime import datetime, timedelta
+from HighaltHardware.TelemetryCodec import decode_telemetry
+
+############################
+# telemetry_decode.py
+#
+# For the ground team. Decodes the telemetry texts the balloon sends back (the ones that
+# start with "HA1"):
+#
+#   telemetry_decode.py [-d YYYY-MM-DD] <message> [<message> ...]
+#
+# With no messages on the command line, reads one per line from stdin. -d gives the
+# date of the flight, so fix times can be shown as full UTC timestamps.
+#
+############################
+
+
+def process_args(inArgs):
+    day = None
+    usage = "Usage: telemetry_decode.py [-d YYYY-MM-DD] <message> [<message> ...]"
+    try:
+        opts, args = getopt.getopt(inArgs, "hd:", ["date"])
+    except getopt.GetoptError as err:
+        print(err.msg)
+        print("\n")
+        print(usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit(0)
+        elif opt == "-d":
+            day = datetime.strptime(arg, "%Y-%m-%d")
+    return day, args
+
+
+def format_time(seconds, day):
+    if day:
+        return (day + timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S UTC")
+    return "{0:02d}:{1:02d}:{2:02d} UTC".format(int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60))
+
+
+def print_message(message, day):
+    try:
+        telemetry = decode_telemetry(message)
+    except (ValueError, KeyError, IndexError) as err:
+        print("Couldn't decode {0}: {1}".format(message, err))
+        return
+    print("Message: {0}".format(message))
+    for name, unit in (('altitude', 'm'), ('vertical_rate', 'm/s'), ('temperature', 'C'), ('battery', '%')):
+        if telemetry[name] is not None:
+            print("  {0:14} {1} {2}".format(name.replace('_', ' ').capitalize() + ":", telemetry[name], unit))
+    if telemetry['phase'] is not None:
+        print("  {0:14} {1}".format("Phase:", telemetry['phase']))
+    print("  Fixes (newest first):")
+    for seconds, lat, lon in telemetry['fixes']:
+        print("    {0}  {1:.5f}, {2:.5f}".format(format_time(seconds, day), lat, lon))
+
+
+def main(argv):
+    day, messages = process_args(argv)
+    if not messages:
+        messages = [line for line in sys.stdin if line.strip()]
+    for message in messages:
+        print_message(message, day)
+
+
+############################
+# Start it all up.
+############################
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import getopt
+import logging
+from threading import Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from HighaltHardware.FonaUplink import decode_batch
+
+############################
+# uplink_receiver.py
+#
+# A stand-in for the server the GPRS uplink posts to. Good for testing on the ground, or
+# with FonaSimulator.
+#
+#   uplink_receiver.py [-p <port>] [-o <output file>]
+#
+# Every batch that comes in is unpacked and its records appended to the output file (a
+# CSV, like the ones on the SD card). Batches we've already seen are acknowledged again
+# but not written twice.
+#
+############################
+
+
+class UplinkHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = self.rfile.read(length)
+        try:
+            sequence, lines = decode_batch(payload)
+        except Exception as err:
+            logging.warning("Receiver: Bad batch: {0}".format(err))
+            self.__reply(400, "BAD")
+            return
+        self.server.store(sequence, lines)
+        self.__reply(200, "ACK {0}".format(sequence))
+
+    def __reply(self, status, text):
+        body = text.encode("ascii")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug("Receiver: " + fmt % args)
+
+
+class UplinkReceiver(HTTPServer):
+    def __init__(self, port=8080, output_file=None):
+        HTTPServer.__init__(self, ("", port), UplinkHandler)
+        self.output_file = output_file
+        self.sequences = set()
+        self.records = 0
+        self.__thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/telemetry".format(self.server_address[1])
+
+    def store(self, sequence, lines):
+        if sequence in self.sequences:
+            logging.info("Receiver: Batch {0} again. Already have it.".format(sequence))
+            return
+        self.sequences.add(sequence)
+        self.records += len(lines)
+        logging.info("Receiver: Batch {0}, {1} records.".format(sequence, len(lines)))
+        if self.output_file:
+            with open(self.output_file, "at") as f:
+                for line in lines:
+                    f.write(line)
+                    f.write("\n")
+
+    def start(self):
+        # Serve in the background. For running next to the simulator.
+        self.__thread = Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def process_args(inArgs):
+    port = 8080
+    out = os.path.join(os.getcwd(), "uplink.csv")
+    usage = "Usage: uplink_receiver.py [-p <port>] [-o <output file>]"
+    try:
+        opts, args = getopt.getopt(inArgs, "hp:o:", ["port", "output"])
+    except getopt.GetoptError as err:
+        print(err.msg)
+        print("\n")
+        print(usage)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit(0)
+        elif opt == "-p":
+            port = int(arg)
+        elif opt == "-o":
+            out = arg
+    return port, out
+
+
+############################
+# Start it all up.
+############################
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s:%(message)s',
+                        level=logging.INFO)
+    listen_port, output = process_args(sys.argv[1:])
+    receiver = UplinkReceiver(listen_port, output)
+    print("Listening on port {0}, writing to {1}".format(listen_port, output))
+    try:
+        receiver.serve_forever()
+    except KeyboardInterrupt:
+        receiver.server_close()